@@ -0,0 +1,147 @@
+import numpy as np
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest-neighbour index over L2-normalized gallery rows.
+
+    The gallery is partitioned by spherical k-means into `nlist` cells. A query only scores the rows
+    of its `nprobe` closest cells, and the shortlist is re-ranked exactly with GallerySearchEngine,
+    so the reported scores are the same as those of an exhaustive search.
+
+    Args:
+        centroids (np.array): (nlist, D) float32 L2-normalized cell centroids.
+        assignments (np.array): Cell id of every gallery row, in row order.
+    """
+
+    def __init__(self, centroids, assignments):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        self._lists = None
+
+    @classmethod
+    def train(cls, matrix, nlist=None, iterations=10, sample_size=None, seed=0, block_size=65536):
+        """
+        Trains the cell centroids on a sample of the gallery and assigns every row to a cell.
+
+        Args:
+            matrix (np.array): (N, D) L2-normalized gallery rows (may be memory-mapped).
+            nlist (int): Number of cells. Defaults to 4 * sqrt(N).
+            iterations (int): Number of k-means iterations.
+            sample_size (int): Number of rows used for training. Defaults to 256 rows per cell.
+            seed (int): Seed for sampling and initialization.
+            block_size (int): Number of rows scored at once while assigning.
+
+        Returns:
+            IVFIndex: The trained index.
+        """
+        n = len(matrix)
+        if n == 0:
+            raise ValueError("Cannot train an IVF index on an empty gallery.")
+        nlist = min(n, nlist or max(1, int(4 * np.sqrt(n))))
+        sample_size = min(n, sample_size or 256 * nlist)
+
+        rng = np.random.default_rng(seed)
+        # Sorted sample indices keep reads from a memory-mapped matrix sequential
+        sample = np.asarray(matrix[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            labels = _nearest(sample, centroids, block_size)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=nlist)
+
+            # Reseed empty cells with random sample rows
+            empty = np.flatnonzero(counts == 0)
+            sums[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+            centroids = _normalize(sums)
+
+        return cls(centroids, _nearest(matrix, centroids, block_size))
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.assignments)
+
+    def assign(self, vectors, block_size=65536):
+        """
+        Returns the cell id of each of the given L2-normalized rows.
+
+        Args:
+            vectors (np.array): (M, D) L2-normalized rows.
+            block_size (int): Number of rows scored at once.
+
+        Returns:
+            np.array: (M,) int32 cell ids.
+        """
+        return _nearest(np.atleast_2d(vectors), self.centroids, block_size)
+
+    def add(self, assignments):
+        """
+        Registers cell assignments for rows appended to the gallery.
+
+        Args:
+            assignments (np.array): Cell ids of the new rows, in row order.
+        """
+        self.assignments = np.concatenate([self.assignments, np.asarray(assignments, dtype=np.int32)])
+        self._lists = None
+
+    def candidates(self, query, nprobe=8):
+        """
+        Returns the gallery rows stored in the `nprobe` cells closest to the query.
+
+        Args:
+            query (np.array): A single embedding of shape (D,).
+            nprobe (int): Number of cells to scan; higher values trade latency for recall.
+
+        Returns:
+            np.array: Sorted gallery row positions.
+        """
+        query = np.asarray(query, dtype=np.float32).ravel()
+        query = query / (np.linalg.norm(query) or 1)
+        nprobe = min(nprobe, self.nlist)
+        cell_scores = self.centroids @ query
+        cells = np.argpartition(-cell_scores, nprobe - 1)[:nprobe]
+
+        order, offsets = self._inverted_lists()
+        shortlist = [order[offsets[cell]:offsets[cell + 1]] for cell in cells]
+        return np.sort(np.concatenate(shortlist)) if shortlist else np.empty(0, dtype=np.int64)
+
+    def search(self, engine, query, nprobe=8, k=None, threshold=None, metric="cosine"):
+        """
+        Searches one query through the index and re-ranks the shortlist exactly.
+
+        Args:
+            engine (GallerySearchEngine): Engine over the same gallery rows as the index.
+            query (np.array): A single embedding of shape (D,).
+            nprobe (int): Number of cells to scan.
+            k (int): Keep only the k best results, ordered from best to worst.
+            threshold (float): A threshold to determine a match (see GallerySearchEngine.search).
+            metric (str): The similarity metric to use ("cosine" or "euclidean").
+
+        Returns:
+            list: (row index, score) tuples, as returned by GallerySearchEngine.search.
+        """
+        shortlist = self.candidates(query, nprobe=nprobe)
+        return engine.search_rows(query, shortlist, k=k, threshold=threshold, metric=metric)
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(self.assignments, minlength=self.nlist))])
+            self._lists = (order, offsets)
+        return self._lists
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.where(norms > 0, norms, 1)).astype(np.float32)
+
+def _nearest(vectors, centroids, block_size):
+    """Assigns each row to the centroid with the highest inner product, scoring rows in blocks."""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        labels[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return labels
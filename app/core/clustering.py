@@ -0,0 +1,136 @@
+import numpy as np
+from app.core.metrics import timed
+
+class UnionFind:
+    """
+    Disjoint sets over the integers 0..n-1, with vectorized find and union.
+
+    Args:
+        n (int): Number of elements.
+    """
+
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+
+    def find(self, nodes):
+        """
+        Returns the root of each node, compressing the paths of the given nodes.
+
+        Args:
+            nodes (np.array): Element ids.
+
+        Returns:
+            np.array: Root ids, in the order of nodes.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        roots = self.parent[nodes]
+        while True:
+            grandparents = self.parent[roots]
+            if np.array_equal(grandparents, roots):
+                break
+            roots = grandparents
+        self.parent[nodes] = roots
+        return roots
+
+    def union(self, a, b):
+        """
+        Merges the sets of every pair (a[i], b[i]).
+
+        The roots touched by the pairs are grouped into connected components in one call, and the
+        smallest root of each component becomes the parent of the others.
+
+        Args:
+            a (np.array): Element ids.
+            b (np.array): Element ids, paired with a.
+        """
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        roots_a, roots_b = self.find(a), self.find(b)
+        differ = roots_a != roots_b
+        if not differ.any():
+            return
+        roots_a, roots_b = roots_a[differ], roots_b[differ]
+
+        nodes, inverse = np.unique(np.concatenate([roots_a, roots_b]), return_inverse=True)
+        m = len(roots_a)
+        graph = coo_matrix((np.ones(m, dtype=np.int8), (inverse[:m], inverse[m:])), shape=(len(nodes), len(nodes)))
+        _, components = connected_components(graph, directed=False)
+        smallest = np.full(components.max() + 1, np.iinfo(np.int64).max)
+        np.minimum.at(smallest, components, nodes)
+        self.parent[nodes] = smallest[components]
+
+    def roots(self):
+        """Returns the root of every element."""
+        return self.find(np.arange(len(self.parent)))
+
+@timed("cluster_embeddings")
+def cluster_embeddings(matrix, norms, threshold, metric="cosine", memory_bytes=512 << 20, labels=None):
+    """
+    Groups gallery rows into clusters: two rows are linked if their score passes the threshold,
+    and clusters are the connected components of that graph (single linkage).
+
+    The N x N score matrix is never held in memory: rows are scored in blocks against the rows
+    before them, block sizes are chosen to fit memory_bytes, and the links of each block are merged
+    into a union-find structure before the next block is scored.
+
+    When labels are given for the first rows (a previous clustering), only the rows after them are
+    scored, against every row; their clusters are merged with the existing ones they link to. The
+    result is the same as clustering every row from scratch, provided the labelled rows are unchanged.
+
+    Args:
+        matrix (np.array): (N, D) L2-normalized rows (may be memory-mapped), as returned by load_gallery().
+        norms (np.array): Original norms of the rows.
+        threshold (float): Score a pair must pass to be linked (>= for cosine, <= for Euclidean).
+        metric (str): The similarity metric to use ("cosine" or "euclidean").
+        memory_bytes (int): Approximate memory budget for a block of scores.
+        labels (np.array): Cluster ids of the first len(labels) rows, from a previous clustering.
+
+    Returns:
+        np.array: (N,) int64 cluster ids. Existing clusters keep their smallest id when merged, and
+                  new clusters are numbered after the largest existing id.
+    """
+    if metric not in ("cosine", "euclidean"):
+        raise ValueError("Unsupported metric. Choose either 'cosine' or 'euclidean'.")
+    n = len(matrix)
+    start = 0 if labels is None else len(labels)
+    union_find = UnionFind(n)
+    if start:
+        # Link every labelled row to the first row of its cluster
+        labels = np.asarray(labels, dtype=np.int64)
+        _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+        union_find.parent[:start] = first[inverse]
+
+    norms = np.asarray(norms, dtype=np.float32)
+    # 4 bytes per score plus 1 byte per mask entry
+    block_size = int(max(1, memory_bytes // (5 * max(n, 1))))
+    for block_start in range(start, n, block_size):
+        block_end = min(n, block_start + block_size)
+        block = np.asarray(matrix[block_start:block_end], dtype=np.float32)
+        # Pairs with earlier rows and within the block; later rows are paired by their own blocks
+        scores = block @ np.asarray(matrix[:block_end], dtype=np.float32).T
+        if metric == "cosine":
+            linked = scores >= threshold
+        else:
+            block_norms = norms[block_start:block_end, None]
+            column_norms = norms[None, :block_end]
+            squared = block_norms ** 2 + column_norms ** 2 - 2 * block_norms * column_norms * scores
+            linked = np.sqrt(np.maximum(squared, 0)) <= threshold
+        rows, columns = np.nonzero(linked)
+        del scores, linked
+        union_find.union(rows + block_start, columns)
+
+    return _label_components(union_find.roots(), labels)
+
+def _label_components(roots, labels):
+    """Turns union-find roots into cluster ids, keeping the smallest existing id of each component."""
+    n, start = len(roots), 0 if labels is None else len(labels)
+    unset = np.iinfo(np.int64).max
+    component_ids = np.full(n, unset, dtype=np.int64)
+    if start:
+        np.minimum.at(component_ids, roots[:start], labels)
+
+    new_roots = np.unique(roots[component_ids[roots] == unset])
+    next_id = int(labels.max()) + 1 if start else 0
+    component_ids[new_roots] = np.arange(next_id, next_id + len(new_roots))
+    return component_ids[roots]
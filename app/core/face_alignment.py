@@ -1,6 +1,8 @@
 import cv2
 import numpy as np
+from app.core.metrics import timed
 
+@timed("align_face")
 def align_face(img, face):
     """
     Aligns the face in the image using the detected keypoints.
@@ -54,3 +56,66 @@ def align_face(img, face):
     cropped_face = aligned_img[y:y+height, x:x+width]
     
     return cropped_face
+
+# Reference positions of the 5 MTCNN landmarks in a 112x112 aligned face (ArcFace template)
+LANDMARK_NAMES = ('left_eye', 'right_eye', 'nose', 'mouth_left', 'mouth_right')
+REFERENCE_LANDMARKS = np.array([
+    [38.2946, 51.6963],
+    [73.5318, 51.5014],
+    [56.0252, 71.7366],
+    [41.5493, 92.3655],
+    [70.7299, 92.2041],
+], dtype=np.float32)
+REFERENCE_SIZE = 112
+
+@timed("align_faces")
+def align_faces(img, faces, output_size=(160, 160)):
+    """
+    Aligns all faces of an image directly to the model input size, into one array for the model.
+
+    Each face is mapped with the similarity transform (rotation, uniform scale, translation) that
+    best fits its 5 landmarks onto a reference template, and warped on its own with only its output
+    pixels computed, so the cost depends on the output size rather than on the size of the source
+    image. A single remap over the stacked sampling maps of all faces was measured no faster: the
+    time goes into gathering the source pixels, not into the per-face calls.
+
+    Args:
+        img (numpy.ndarray): The original image.
+        faces (list): Face detection results with 'box' and 'keypoints'.
+        output_size (tuple): (width, height) of the aligned faces, e.g. the model input size.
+
+    Returns:
+        aligned_faces (numpy.ndarray): An (N, height, width, channels) array of aligned faces.
+    """
+    width, height = output_size
+    aligned = np.empty((len(faces), height, width) + img.shape[2:], dtype=img.dtype)
+    for i, face in enumerate(faces):
+        cv2.warpAffine(img, face_transform(face, output_size), (width, height), dst=aligned[i],
+                       flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+    return aligned
+
+def face_transform(face, output_size=(160, 160)):
+    """
+    Computes the 2x3 affine matrix mapping a face of the original image to an aligned face.
+
+    Falls back to scaling the bounding box onto the output when the landmarks are incomplete.
+
+    Args:
+        face (dict): A face detection result with 'box' and 'keypoints'.
+        output_size (tuple): (width, height) of the aligned face.
+
+    Returns:
+        numpy.ndarray: The 2x3 float32 transform.
+    """
+    width, height = output_size
+    keypoints = face.get('keypoints', {})
+    if all(name in keypoints for name in LANDMARK_NAMES):
+        src = np.array([keypoints[name] for name in LANDMARK_NAMES], dtype=np.float32)
+        dst = REFERENCE_LANDMARKS * np.array([width, height], dtype=np.float32) / REFERENCE_SIZE
+        M, _ = cv2.estimateAffinePartial2D(src, dst, method=cv2.LMEDS)
+        if M is not None:
+            return M.astype(np.float32)
+
+    x, y, box_w, box_h = (float(v) for v in face['box'])
+    return np.array([[width / max(box_w, 1.0), 0, -x * width / max(box_w, 1.0)],
+                     [0, height / max(box_h, 1.0), -y * height / max(box_h, 1.0)]], dtype=np.float32)
@@ -1,7 +1,17 @@
 import cv2
-from mtcnn import MTCNN
-import matplotlib.pyplot as plt
+import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
+from app.core.metrics import FACES_BUCKETS, observe, timed
+from app.core.model_registry import get_detector, lend_detector
+
+# Tiled detection: faces found twice across a seam are merged when their boxes overlap by more than
+# TILE_IOU_THRESHOLD (IoU), or when TILE_CONTAINMENT of the smaller box lies inside the larger one
+TILE_IOU_THRESHOLD = 0.4
+TILE_CONTAINMENT = 0.8
+# Detections this close to a tile's inner edge may be cut by it
+SEAM_MARGIN = 2
+DEFAULT_TILE_OVERLAP = 256
 
 class ImagePathError(Exception):
     """Custom exception raised when no image path is provided."""
@@ -9,14 +19,23 @@ class ImagePathError(Exception):
         self.message = message
         super().__init__(self.message)
 
-def detect_faces(image_path, save_output=False, output_filename="detected_image.jpg"):
+@timed("detect_faces")
+def detect_faces(image_path, save_output=False, output_filename="detected_image.jpg", max_side=None, tile_size=None,
+                 tile_overlap=DEFAULT_TILE_OVERLAP, tile_workers=1):
     """
     Detect faces in the given image and optionally save the output image with bounding boxes.
     
     Args:
-        image_path (str): Path to the input image.
+        image_path (str or numpy.ndarray): Path to the input image, or an already-decoded BGR image
+            (as returned by cv2.imread) so callers can avoid reading the file twice.
         save_output (bool): If True, save the output image with detected face boxes.
         output_filename (str): The filename to use when saving the output image.
+        max_side (int): If set, detection runs on a copy downscaled so that its longest side is at most
+            max_side pixels; boxes and keypoints are mapped back to full-resolution coordinates.
+        tile_size (int): If set, images larger than tile_size run through detect_faces_tiled instead,
+            which finds small faces at full resolution with memory bounded by the tile size.
+        tile_overlap (int): Overlap between neighbouring tiles, in pixels (see detect_faces_tiled).
+        tile_workers (int): Number of tiles detected in parallel (see detect_faces_tiled).
         
     Returns:
         list: A list of dictionaries, each containing the detected face's details.
@@ -25,45 +44,56 @@ def detect_faces(image_path, save_output=False, output_filename="detected_image.
         ImagePathError: If image_path is not provided.
         ValueError: If the image cannot be read from the provided path.
     """
-    # Check if an image path is provided
-    if not image_path:
-        raise ImagePathError()
+    if isinstance(image_path, np.ndarray):
+        img = image_path
+    else:
+        # Check if an image path is provided
+        if not image_path:
+            raise ImagePathError()
 
-    # Initialize the MTCNN face detector
-    detector = MTCNN()
-    
-    # Read the image using OpenCV
-    img = cv2.imread(image_path)
-    if img is None:
-        raise ValueError(f"Unable to read image at path: {image_path}")
-    
-    # Convert image from BGR (OpenCV default) to RGB for processing and visualization
-    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    
-    # Perform face detection
-    results = detector.detect_faces(img_rgb)
-    
-    # Debug: Print detected face details
-    for i, face in enumerate(results):
-        print(f"Face {i+1}: {face}")
-        # Each face dict contains:
-        # - 'box': [x, y, width, height]
-        # - 'confidence': detection confidence score
-        # - 'keypoints': facial landmarks (e.g., left_eye, right_eye, nose, mouth_left, mouth_right)
+        # Read the image using OpenCV
+        img = cv2.imread(image_path)
+        if img is None:
+            raise ValueError(f"Unable to read image at path: {image_path}")
+
+    # Reuse the process-wide MTCNN face detector
+    detector = get_detector()
     
-    # Draw bounding boxes on the image for each detected face
-    for face in results:
-        x, y, width, height = face['box']
-        cv2.rectangle(img_rgb, (x, y), (x + width, y + height), (0, 255, 0), 2)
+    if tile_size and max(img.shape[:2]) > tile_size:
+        # Tiles are converted one at a time, so the full image is only converted to RGB for the output
+        results = detect_faces_tiled(img, tile_size, overlap=tile_overlap, workers=tile_workers, max_side=max_side)
+        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB) if save_output else None
+    else:
+        # Convert image from BGR (OpenCV default) to RGB for processing and visualization
+        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        # Perform face detection, on a reduced-resolution copy for large images
+        detection_img, scale = downscale_for_detection(img_rgb, max_side)
+        results = detector.detect_faces(detection_img)
+        if scale != 1.0:
+            results = [_rescale_face(face, 1.0 / scale) for face in results]
+    observe("faces_per_image", len(results), buckets=FACES_BUCKETS)
     
+    # Each face dict contains:
+    # - 'box': [x, y, width, height]
+    # - 'confidence': detection confidence score
+    # - 'keypoints': facial landmarks (e.g., left_eye, right_eye, nose, mouth_left, mouth_right)
+
     # If save_output is True, save the image inside the current directory
     if save_output:
+        # Draw bounding boxes on the image for each detected face
+        for face in results:
+            x, y, width, height = face['box']
+            cv2.rectangle(img_rgb, (x, y), (x + width, y + height), (0, 255, 0), 2)
+
         output_dir = os.path.dirname(__file__)  # Ensure correct directory
         os.makedirs(output_dir, exist_ok=True)  # Create the directory if it doesn't exist
         
         output_path = os.path.join(output_dir, output_filename)
         
-        # Use plt.imsave to save an RGB image
+        # Use plt.imsave to save an RGB image; matplotlib is only needed here
+        import matplotlib.pyplot as plt
+
         plt.imsave(output_path, img_rgb)
         print(f"Output saved to: {output_path}")
     # else:
@@ -74,3 +104,163 @@ def detect_faces(image_path, save_output=False, output_filename="detected_image.
     #     plt.show()
     
     return results
+
+@timed("detect_faces_tiled")
+def detect_faces_tiled(img, tile_size, overlap=DEFAULT_TILE_OVERLAP, workers=1, max_side=None):
+    """
+    Detects faces tile by tile at full resolution, so that small faces are not lost to downscaling
+    and the detector's image pyramid never grows beyond one tile.
+
+    Neighbouring tiles overlap by at least `overlap` pixels, so every face smaller than the overlap
+    lies whole inside some tile; its detections cut by a seam are dropped. Faces too large for the
+    overlap are found by one more pass on a copy downscaled to max_side (or tile_size) pixels.
+    Duplicates are then merged by non-maximum suppression (see merge_detections).
+
+    Args:
+        img (numpy.ndarray): The decoded BGR image.
+        tile_size (int): Side of the square tiles, in pixels.
+        overlap (int): Overlap between neighbouring tiles, at most half a tile.
+        workers (int): Number of tiles detected in parallel threads; only that many tiles are in
+                       memory (as RGB copies with their image pyramids) at once. MTCNN is not
+                       thread-safe, so each thread detects with a detector of its own (see lend_detector).
+        max_side (int): Longest side of the downscaled copy searched for large faces; defaults to tile_size.
+
+    Returns:
+        list: Detection results in full-image coordinates, most confident first.
+    """
+    detector = get_detector()
+    height, width = img.shape[:2]
+    overlap = _tile_overlap(overlap, tile_size)
+    tiles = [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+             for y in _tile_starts(height, tile_size, overlap) for x in _tile_starts(width, tile_size, overlap)]
+
+    def detect_tile(tile, tile_detector):
+        x0, y0, x1, y1 = tile
+        faces = tile_detector.detect_faces(cv2.cvtColor(img[y0:y1, x0:x1], cv2.COLOR_BGR2RGB))
+        faces = [_offset_face(face, x0, y0) for face in faces]
+        return [face for face in faces if not _cut_by_seam(face['box'], tile, width, height, overlap)]
+
+    def detect_lent_tile(tile):
+        with lend_detector() as tile_detector:
+            return detect_tile(tile, tile_detector)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = [face for faces in executor.map(detect_lent_tile, tiles) for face in faces]
+    else:
+        results = [face for tile in tiles for face in detect_tile(tile, detector)]
+
+    overview, scale = downscale_for_detection(img, max_side or tile_size)
+    results += [_rescale_face(face, 1.0 / scale)
+                for face in detector.detect_faces(cv2.cvtColor(overview, cv2.COLOR_BGR2RGB))]
+    return merge_detections(results)
+
+def merge_detections(faces, iou_threshold=TILE_IOU_THRESHOLD, containment=TILE_CONTAINMENT):
+    """
+    Merges duplicate detections of the same face by greedy non-maximum suppression.
+
+    A detection is dropped when a more confident one overlaps it by more than iou_threshold, or
+    covers more than `containment` of the smaller of the two boxes (e.g. a face partly cut by a seam).
+
+    Args:
+        faces (list): Detection results ('box' as [x, y, width, height], 'confidence').
+        iou_threshold (float): Intersection over union above which two boxes are the same face.
+        containment (float): Share of the smaller box inside the other above which they are the same face.
+
+    Returns:
+        list: The remaining detections, most confident first.
+    """
+    if not faces:
+        return []
+    boxes = np.array([face['box'] for face in faces], dtype=np.float32)
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+    areas = np.maximum(boxes[:, 2] * boxes[:, 3], 1e-6)
+
+    keep = []
+    for i in np.argsort([-face['confidence'] for face in faces], kind='stable'):
+        if keep:
+            kept = np.array(keep)
+            overlap_w = np.clip(np.minimum(x2[i], x2[kept]) - np.maximum(x1[i], x1[kept]), 0, None)
+            overlap_h = np.clip(np.minimum(y2[i], y2[kept]) - np.maximum(y1[i], y1[kept]), 0, None)
+            intersection = overlap_w * overlap_h
+            iou = intersection / (areas[i] + areas[kept] - intersection)
+            contained = intersection / np.minimum(areas[i], areas[kept])
+            if np.any((iou > iou_threshold) | (contained > containment)):
+                continue
+        keep.append(i)
+    return [faces[i] for i in keep]
+
+def detector_version(max_side=None, tiling=None):
+    """
+    Returns the identifier stored with cached detections, e.g. "mtcnn", "mtcnn@1600" or
+    "mtcnn@1600+tile1024o256" (tiles of 1024 pixels overlapping by 256).
+
+    Args:
+        max_side (int): Longest image side used for detection (see detect_faces).
+        tiling (dict): Tiled detection settings passed to detect_faces ('tile_size', 'tile_overlap', ...),
+                       if enabled.
+    """
+    version = f"mtcnn@{max_side}" if max_side else "mtcnn"
+    tiling = tiling or {}
+    tile_size = tiling.get('tile_size')
+    if not tile_size:
+        return version
+    return f"{version}+tile{tile_size}o{_tile_overlap(tiling.get('tile_overlap', DEFAULT_TILE_OVERLAP), tile_size)}"
+
+def _tile_overlap(overlap, tile_size):
+    """The overlap detect_faces_tiled uses: at least 0 and at most half a tile."""
+    return min(max(int(overlap), 0), tile_size // 2)
+
+def downscale_for_detection(img, max_side=None):
+    """
+    Downscales an image so that its longest side is at most max_side pixels.
+
+    Args:
+        img (numpy.ndarray): The decoded image.
+        max_side (int): Maximum length of the longest side. None or 0 disables downscaling.
+
+    Returns:
+        tuple: (image, scale) where scale is the factor applied to the input (1.0 if unchanged).
+    """
+    h, w = img.shape[:2]
+    if not max_side or max(h, w) <= max_side:
+        return img, 1.0
+    scale = max_side / max(h, w)
+    resized = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    return resized, scale
+
+def _tile_starts(length, tile_size, overlap):
+    """Offsets of the tiles along one side, spread evenly so the last tile ends at the image edge."""
+    if length <= tile_size:
+        return [0]
+    count = -(-(length - tile_size) // (tile_size - overlap)) + 1
+    return [round(i * (length - tile_size) / (count - 1)) for i in range(count)]
+
+def _cut_by_seam(box, tile, width, height, overlap):
+    """
+    Whether a detection may be cut by an inner edge of its tile. Only faces smaller than the overlap
+    are dropped, as they lie whole inside the neighbouring tile.
+    """
+    x, y, w, h = box
+    if max(w, h) >= overlap:
+        return False
+    x0, y0, x1, y1 = tile
+    return (x0 > 0 and x <= x0 + SEAM_MARGIN) or (y0 > 0 and y <= y0 + SEAM_MARGIN) or \
+        (x1 < width and x + w >= x1 - SEAM_MARGIN) or (y1 < height and y + h >= y1 - SEAM_MARGIN)
+
+def _offset_face(face, dx, dy):
+    """Maps a detection result from tile coordinates to full-image coordinates."""
+    face = dict(face)
+    x, y, w, h = face['box']
+    face['box'] = [x + dx, y + dy, w, h]
+    face['keypoints'] = {name: (px + dx, py + dy) for name, (px, py) in face.get('keypoints', {}).items()}
+    return face
+
+def _rescale_face(face, factor):
+    """Maps a detection result back to the coordinates of an image `factor` times larger."""
+    face = dict(face)
+    face['box'] = [int(round(v * factor)) for v in face['box']]
+    face['keypoints'] = {name: (int(round(x * factor)), int(round(y * factor)))
+                         for name, (x, y) in face.get('keypoints', {}).items()}
+    return face
@@ -0,0 +1,164 @@
+import cv2
+import numpy as np
+
+class Track:
+    """
+    A face followed across video frames.
+
+    Only a few observations of a track are embedded: the `samples_per_track` best ones by
+    detection quality, whose aligned crops are kept until the track is embedded.
+
+    Args:
+        track_id (int): Identifier of the track within its video.
+        face (dict): The detection that started the track ('box', 'confidence', 'keypoints').
+        frame_index (int): Frame the track starts at.
+    """
+
+    def __init__(self, track_id, face, frame_index):
+        self.id = track_id
+        self.box = np.asarray(face['box'], dtype=np.float32)
+        self.start_frame = self.end_frame = frame_index
+        self.detections = 0
+        self.missed = 0
+        self.best_face, self.best_quality = face, -1.0
+        self.samples = []
+
+    def observe(self, face, frame_index):
+        """Records a detection matched to the track."""
+        self.box = np.asarray(face['box'], dtype=np.float32)
+        self.end_frame = frame_index
+        self.detections += 1
+        self.missed = 0
+        quality = face_quality(face)
+        if quality > self.best_quality:
+            self.best_face, self.best_quality = face, quality
+
+    def wants_sample(self, face, samples_per_track):
+        """Returns True if an aligned crop of this detection should be kept for embedding."""
+        return len(self.samples) < samples_per_track or face_quality(face) > min(q for q, _ in self.samples)
+
+    def add_sample(self, face, crop, samples_per_track):
+        """Keeps the aligned crop of a detection, replacing the lowest-quality sample if the track has enough."""
+        self.samples.append((face_quality(face), crop))
+        if len(self.samples) > samples_per_track:
+            self.samples.pop(min(range(len(self.samples)), key=lambda i: self.samples[i][0]))
+
+class FaceTracker:
+    """
+    Associates the faces detected on sampled frames into tracks.
+
+    Detections are matched to the current track boxes by IoU, greedily from the best overlap. Between
+    two detection frames, track boxes can be moved with sparse optical flow (see `follow`), so faces
+    that move far between detections still overlap their track.
+
+    Args:
+        iou_threshold (float): Minimum IoU between a detection and a track box to match them.
+        max_missed (int): Detection frames a track may go unmatched before it ends.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed=1):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.active = []
+        self._next_id = 0
+        self._previous = None
+
+    def update(self, faces, frame_index):
+        """
+        Matches the faces detected on a frame to the active tracks and starts tracks for the others.
+
+        Args:
+            faces (list): Detections of the frame ('box', 'confidence', 'keypoints').
+            frame_index (int): Index of the frame.
+
+        Returns:
+            tuple: (assignments, finished) where assignments holds one (track, face) pair per detection
+                   and finished the tracks that ended because they were missed too often.
+        """
+        boxes = np.array([face['box'] for face in faces], dtype=np.float32).reshape(-1, 4)
+        overlaps = box_iou(np.array([track.box for track in self.active]).reshape(-1, 4), boxes)
+
+        assignments, matched_tracks, matched_faces = [], set(), set()
+        for t, f in zip(*np.unravel_index(np.argsort(-overlaps, axis=None), overlaps.shape)):
+            if overlaps[t, f] < self.iou_threshold:
+                break
+            if t in matched_tracks or f in matched_faces:
+                continue
+            matched_tracks.add(t)
+            matched_faces.add(f)
+            self.active[t].observe(faces[f], frame_index)
+            assignments.append((self.active[t], faces[f]))
+
+        finished, active = [], []
+        for t, track in enumerate(self.active):
+            if t not in matched_tracks:
+                track.missed += 1
+            (finished if track.missed > self.max_missed else active).append(track)
+        for f, face in enumerate(faces):
+            if f not in matched_faces:
+                track = Track(self._next_id, face, frame_index)
+                self._next_id += 1
+                track.observe(face, frame_index)
+                active.append(track)
+                assignments.append((track, face))
+        self.active = active
+        return assignments, finished
+
+    def follow(self, gray, frame_index, scale=1.0):
+        """
+        Moves the active track boxes by the median optical flow of corner points inside them.
+
+        Args:
+            gray (numpy.ndarray): The frame in grayscale, possibly downscaled.
+            frame_index (int): Index of the frame; tracks whose box moved are extended to it.
+            scale (float): Size of `gray` relative to the frame (boxes are in frame coordinates).
+        """
+        previous, self._previous = self._previous, gray
+        if previous is None or previous.shape != gray.shape or not self.active:
+            return
+        for track in self.active:
+            x, y, w, h = (track.box * scale).astype(int)
+            x0, y0 = max(x, 0), max(y, 0)
+            roi = previous[y0:y + h, x0:x + w]
+            if roi.size == 0:
+                continue
+            points = cv2.goodFeaturesToTrack(roi, maxCorners=20, qualityLevel=0.01, minDistance=3)
+            if points is None:
+                continue
+            points = (points + np.array([x0, y0], dtype=np.float32)).astype(np.float32)
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(previous, gray, points, None, winSize=(15, 15), maxLevel=2)
+            found = status.ravel() == 1
+            if found.sum() < 3:
+                continue
+            shift = np.median((moved - points).reshape(-1, 2)[found], axis=0) / scale
+            track.box[:2] += shift
+            track.end_frame = frame_index
+
+    def reset(self):
+        """Ends every active track (e.g. at a scene cut) and returns them."""
+        finished, self.active, self._previous = self.active, [], None
+        return finished
+
+def face_quality(face):
+    """Scores a detection for embedding: confident detections of large faces first."""
+    _, _, w, h = face['box']
+    return float(face.get('confidence', 0.0)) * min(w, h)
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Computes the intersection over union of every pair of (x, y, w, h) boxes.
+
+    Args:
+        boxes_a (np.array): (A, 4) boxes.
+        boxes_b (np.array): (B, 4) boxes.
+
+    Returns:
+        np.array: (A, B) IoU values.
+    """
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(1, -1, 4)
+    width = np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    height = np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    intersection = np.maximum(width, 0) * np.maximum(height, 0)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+    return intersection / np.maximum(union, 1e-6)
@@ -1,24 +1,77 @@
-from deepface import DeepFace
 import numpy as np
+from app.core.metrics import count, timed
+from app.core.model_registry import get_embedding_model
 
+# Identifies how an aligned face is turned into an embedding: fed straight to the model with the
+# preprocessing of DeepFace's "skip" detector backend. Older versions called DeepFace.represent, which
+# ran an OpenCV detection on the aligned crop first and so embedded a slightly different crop. Stored
+# embeddings are tagged with their pipeline; those of another one are still searched, and replaced
+# when their faces are re-embedded (see database.get_faces_missing_embeddings).
+EMBEDDING_PIPELINE = "skip-v1"
+
+@timed("extract_face_embedding")
 def extract_face_embedding(face_img, model_name="Facenet"):
     """
     Extracts the embedding of an aligned face image using the specified model.
     
     Args:
-        face_img (numpy.ndarray): The aligned face image in RGB format.
+        face_img (numpy.ndarray): The aligned face image in BGR format, as decoded by OpenCV.
         model_name (str): Name of the model to use. Options include "Facenet", "ArcFace", "VGG-Face", etc.
         
     Returns:
         numpy.ndarray: The embedding vector for the face.
     """
-    # DeepFace expects a BGR image by default, but you can pass RGB if enforce_detection is off
-    # We use enforce_detection=False since the face is already detected and aligned
+    # The face is already detected and aligned, so it is fed to the shared model directly,
+    # using the same preprocessing as DeepFace.represent with detector_backend="skip".
     try:
-        # The `represent` function returns a list of dictionaries; we take the first result.
-        representation = DeepFace.represent(face_img, model_name=model_name, enforce_detection=False)
-        embedding = representation[0]["embedding"]
+        model = get_embedding_model(model_name)
+        count("faces_embedded_total")
+        embedding = model.forward(_preprocess(face_img, model))
         # Ensure the embedding is a numpy array
         return np.array(embedding)
     except Exception as e:
         raise RuntimeError(f"Error extracting embedding: {e}")
+
+@timed("extract_face_embeddings")
+def extract_face_embeddings(faces, model_name="Facenet", batch_size=32):
+    """
+    Extracts the embeddings of many aligned face images with batched forward passes.
+
+    Args:
+        faces (list): Aligned face images in BGR format, of any size.
+        model_name (str): Name of the model to use. Options include "Facenet", "ArcFace", "VGG-Face", etc.
+        batch_size (int): Number of faces per forward pass. The last batch is zero-padded to this size
+                          so the model always sees the same input shape.
+
+    Returns:
+        numpy.ndarray: An (N, D) float32 array with one embedding per face, in input order.
+    """
+    try:
+        model = get_embedding_model(model_name)
+        count("faces_embedded_total", len(faces))
+        if not len(faces):
+            return np.empty((0, model.output_shape), dtype=np.float32)
+
+        # Clients without a Keras model (e.g. Dlib, SFace) only support one face per call
+        if not callable(getattr(model, "model", None)):
+            return np.array([model.forward(_preprocess(face, model)) for face in faces], dtype=np.float32)
+
+        batches = []
+        for start in range(0, len(faces), batch_size):
+            batch = np.concatenate([_preprocess(face, model) for face in faces[start:start + batch_size]])
+            filled = len(batch)
+            if filled < batch_size:
+                batch = np.concatenate([batch, np.zeros((batch_size - filled,) + batch.shape[1:], dtype=batch.dtype)])
+            batches.append(np.asarray(model.model(batch, training=False))[:filled])
+        return np.concatenate(batches).astype(np.float32)
+    except Exception as e:
+        raise RuntimeError(f"Error extracting embeddings: {e}")
+
+def _preprocess(face_img, model):
+    """Converts a BGR face crop into the (1, h, w, 3) input expected by the model."""
+    from deepface.modules import preprocessing
+
+    img = face_img[:, :, ::-1]  # bgr to rgb
+    target_size = model.input_shape
+    img = preprocessing.resize_image(img=img, target_size=(target_size[1], target_size[0]))
+    return preprocessing.normalize_input(img=img, normalization="base")
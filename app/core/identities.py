@@ -0,0 +1,106 @@
+import numpy as np
+from app.core.metrics import timed
+from app.core.similarity_matching import GallerySearchEngine
+
+AGGREGATIONS = ("mean", "medoid")
+
+def aggregate_templates(embeddings, method="mean", count=1, iterations=10):
+    """
+    Aggregates the embeddings of an identity's reference images into one or more templates.
+
+    With more than one template, the references are first grouped by spherical k-means (e.g. with
+    and without glasses, or years apart), and each group is aggregated into its own template.
+
+    Args:
+        embeddings (np.array): (R, D) embeddings of the identity's reference images.
+        method (str): "mean" (the average embedding, which smooths out pose and lighting) or "medoid"
+                      (the reference most similar to the others, robust to outlier photos).
+        count (int): Number of templates; identities with fewer references get one per reference.
+        iterations (int): Number of k-means iterations when count > 1.
+
+    Returns:
+        np.array: (T, D) float32 templates, with T = min(count, R).
+
+    Raises:
+        ValueError: If method is not one of AGGREGATIONS.
+    """
+    if method not in AGGREGATIONS:
+        raise ValueError(f"Unsupported aggregation '{method}'. Choose one of {', '.join(AGGREGATIONS)}.")
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    normalized = embeddings / np.where(norms > 0, norms, 1)
+
+    groups = _group_references(normalized, min(max(count, 1), len(embeddings)), iterations)
+    templates = []
+    for members in groups:
+        if method == "mean":
+            templates.append(embeddings[members].mean(axis=0))
+        else:
+            similarities = normalized[members] @ normalized[members].T
+            templates.append(embeddings[members[np.argmax(similarities.sum(axis=1))]])
+    return np.array(templates, dtype=np.float32)
+
+@timed("label_faces")
+def label_faces(matrix, norms, templates, template_identities, metric="cosine", memory_bytes=256 << 20):
+    """
+    Finds the best-matching identity of every gallery row, scoring the rows against all templates
+    with one matrix product per block of rows.
+
+    Args:
+        matrix (np.array): (N, D) L2-normalized gallery rows (may be memory-mapped).
+        norms (np.array): Row norms of the original embeddings.
+        templates (np.array): (T, D) identity templates.
+        template_identities (np.array): Identity id of each template.
+        metric (str): The similarity metric to use ("cosine" or "euclidean").
+        memory_bytes (int): Memory budget for a block of rows and its scores.
+
+    Returns:
+        tuple: (identities, scores) with the identity id of each row's best template and its score.
+    """
+    if metric not in ("cosine", "euclidean"):
+        raise ValueError("Unsupported metric. Choose either 'cosine' or 'euclidean'.")
+    template_identities = np.asarray(template_identities, dtype=np.int64)
+    engine = GallerySearchEngine(template_identities, templates)
+    identities = np.empty(len(matrix), dtype=np.int64)
+    scores = np.empty(len(matrix), dtype=np.float32)
+    if len(matrix) == 0 or len(templates) == 0:
+        return identities[:0], scores[:0]
+
+    block_rows = max(1, memory_bytes // (4 * (len(templates) + matrix.shape[1])))
+    for start in range(0, len(matrix), block_rows):
+        block = np.asarray(matrix[start:start + block_rows], dtype=np.float32)
+        if metric == "euclidean":
+            block = block * np.asarray(norms[start:start + block_rows], dtype=np.float32)[:, None]
+        block_scores = engine.score(block, metric=metric)
+        best = np.argmax(block_scores, axis=1) if metric == "cosine" else np.argmin(block_scores, axis=1)
+        identities[start:start + len(block)] = template_identities[best]
+        scores[start:start + len(block)] = block_scores[np.arange(len(block)), best]
+    return identities, scores
+
+def _group_references(normalized, count, iterations):
+    """Splits the references into `count` groups by spherical k-means, seeded by farthest-point sampling."""
+    if count <= 1:
+        return [np.arange(len(normalized))]
+
+    similarities = normalized @ normalized.T
+    seeds = [int(np.argmax(similarities.sum(axis=1)))]
+    while len(seeds) < count:
+        farthest = int(np.argmin(similarities[:, seeds].max(axis=1)))
+        if farthest in seeds:
+            # The remaining references duplicate the seeds
+            break
+        seeds.append(farthest)
+    count = len(seeds)
+    centres = normalized[seeds]
+    for _ in range(iterations):
+        assignments = np.argmax(normalized @ centres.T, axis=1)
+        # Seeds stay in their own group, so no group ends up empty
+        assignments[seeds] = np.arange(count)
+        updated = np.array([normalized[assignments == group].mean(axis=0) for group in range(count)])
+        updated /= np.maximum(np.linalg.norm(updated, axis=1, keepdims=True), 1e-12)
+        if np.allclose(updated, centres):
+            break
+        centres = updated
+    assignments = np.argmax(normalized @ centres.T, axis=1)
+    assignments[seeds] = np.arange(count)
+    return [np.flatnonzero(assignments == group) for group in range(count)]
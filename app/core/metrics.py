@@ -0,0 +1,271 @@
+import bisect
+import functools
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+# Upper bounds of the histogram buckets, in seconds for latencies and in faces for faces per image
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FACES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+SINKS = ("none", "jsonl", "prometheus")
+PROFILERS = ("none", "cprofile", "sample")
+
+# Hooks check this flag first, so that they cost one attribute lookup when metrics are disabled
+_enabled = False
+_lock = threading.Lock()
+_histograms = {}
+_counters = Counter()
+_config = {}
+_settings = {}
+
+class Histogram:
+    """
+    A cumulative histogram with fixed bucket bounds, as exported by Prometheus.
+
+    Args:
+        buckets (tuple): Increasing upper bounds of the buckets; an implicit +Inf bucket follows.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Returns (upper bound, count of values <= bound) pairs, ending with ("+Inf", count)."""
+        total, pairs = 0, []
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+def timed(op):
+    """
+    Decorator recording the latency of every call in the `latency_seconds` histogram (labelled
+    with `op`), and failed calls in the `errors_total` counter.
+
+    Args:
+        op (str): Name of the operation, e.g. "detect_faces".
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except BaseException:
+                count("errors_total", label=op)
+                raise
+            finally:
+                observe("latency_seconds", time.perf_counter() - start, label=op)
+        return wrapper
+    return decorator
+
+def observe(name, value, label=None, buckets=LATENCY_BUCKETS):
+    """
+    Records a value in a histogram. Does nothing when metrics are disabled.
+
+    Args:
+        name (str): Name of the histogram, e.g. "faces_per_image".
+        value (float): The observed value.
+        label (str): Optional `op` label, to keep one histogram per operation.
+        buckets (tuple): Bucket bounds, used when the histogram is first created.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get((name, label))
+        if histogram is None:
+            histogram = _histograms[(name, label)] = Histogram(buckets)
+        histogram.observe(value)
+
+def count(name, n=1, label=None):
+    """
+    Increments a counter. Does nothing when metrics are disabled.
+
+    Args:
+        name (str): Name of the counter, e.g. "faces_embedded_total".
+        n (int): Increment.
+        label (str): Optional `op` label.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[(name, label)] += n
+
+def configure(sink="none", path=None, interval=10.0, profiler="none", profile_path=None):
+    """
+    Enables the metrics and the profiler of this process.
+
+    Metrics are exported every `interval` seconds and when the process exits. Child processes
+    (e.g. the ingestion pipeline workers) write to their own files, with the pid before the extension.
+
+    Args:
+        sink (str): "none", "jsonl" (appends one JSON line per metric and export) or "prometheus"
+                    (rewrites a textfile for the node_exporter textfile collector).
+        path (str): Output file of the sink. Defaults to metrics.jsonl or metrics.prom.
+        interval (float): Seconds between two exports; 0 only exports at exit.
+        profiler (str): "none", "cprofile" (writes pstats to profile_path) or "sample" (samples the
+                        stacks of every thread and writes them in the collapsed format used by
+                        flame graph tools).
+        profile_path (str): Output file of the profiler. Defaults to profile.prof or profile.folded.
+    """
+    global _enabled
+    _settings.update(sink=sink, path=path, interval=interval, profiler=profiler, profile_path=profile_path)
+    if sink not in SINKS:
+        print(f"Error: Invalid METRICS_SINK '{sink}'. Use one of {', '.join(SINKS)}.")
+        sink = "none"
+    if profiler not in PROFILERS:
+        print(f"Error: Invalid PROFILER '{profiler}'. Use one of {', '.join(PROFILERS)}.")
+        profiler = "none"
+
+    if sink != "none":
+        default_path = "metrics.jsonl" if sink == "jsonl" else "metrics.prom"
+        _config.update(sink=sink, path=_process_path(path or default_path))
+        _enabled = True
+        _at_exit(export)
+        if interval and interval > 0:
+            threading.Thread(target=_export_periodically, args=(interval,), daemon=True).start()
+
+    if profiler == "cprofile":
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+        _at_exit(_dump_cprofile, profile, _process_path(profile_path or "profile.prof"))
+    elif profiler == "sample":
+        sampler = _StackSampler()
+        sampler.start()
+        _at_exit(sampler.dump, _process_path(profile_path or "profile.folded"))
+
+def enabled():
+    """Returns True if metrics are being recorded."""
+    return _enabled
+
+def settings():
+    """
+    Returns the arguments configure was called with in this process, so that spawned child
+    processes, which start unconfigured, can be configured the same way.
+
+    Returns:
+        dict: Keyword arguments for configure; empty if it was not called.
+    """
+    return dict(_settings)
+
+def snapshot():
+    """
+    Returns the current value of every metric.
+
+    Returns:
+        list: One dict per histogram (name, op, count, sum, buckets) or counter (name, op, value).
+    """
+    with _lock:
+        histograms = [(key, h.count, h.sum, h.cumulative()) for key, h in _histograms.items()]
+        counters = list(_counters.items())
+    records = [{'name': name, 'op': op, 'type': 'histogram', 'count': n, 'sum': total,
+                'buckets': {str(bound): c for bound, c in buckets}}
+               for (name, op), n, total, buckets in histograms]
+    records += [{'name': name, 'op': op, 'type': 'counter', 'value': value} for (name, op), value in counters]
+    return records
+
+def export():
+    """Writes the current metrics to the configured sink."""
+    if not _enabled:
+        return
+    records = snapshot()
+    try:
+        if _config['sink'] == "jsonl":
+            now, pid = time.time(), os.getpid()
+            with open(_config['path'], 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(dict(record, ts=now, pid=pid)) + "\n" for record in records)
+        else:
+            # Written to a temporary file and renamed, so the collector never reads a partial file
+            tmp_path = _config['path'] + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(_prometheus_text(records))
+            os.replace(tmp_path, _config['path'])
+    except OSError as e:
+        print(f"Error exporting metrics to '{_config['path']}': {e}")
+
+def _export_periodically(interval):
+    while True:
+        time.sleep(interval)
+        export()
+
+def _prometheus_text(records):
+    lines, typed = [], set()
+    for record in sorted(records, key=lambda r: (r['name'], r['op'] or "")):
+        name = "photoscan_" + re.sub(r"[^a-zA-Z0-9_]", "_", record['name'])
+        labels = f'op="{record["op"]}"' if record['op'] else ""
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {record['type']}")
+        if record['type'] == "counter":
+            lines.append(f"{name}{{{labels}}} {record['value']}")
+            continue
+        for bound, value in record['buckets'].items():
+            bucket_labels = ",".join(filter(None, [labels, f'le="{bound}"']))
+            lines.append(f"{name}_bucket{{{bucket_labels}}} {value}")
+        lines.append(f"{name}_sum{{{labels}}} {record['sum']}")
+        lines.append(f"{name}_count{{{labels}}} {record['count']}")
+    return "\n".join(lines) + "\n"
+
+def _at_exit(fn, *args):
+    """Runs fn at exit, also in multiprocessing children, which skip atexit handlers."""
+    multiprocessing.util.Finalize(None, fn, args=args, exitpriority=10)
+
+def _process_path(path):
+    """Adds the pid before the extension of a path in child processes, so processes don't overwrite each other."""
+    if multiprocessing.parent_process() is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.{os.getpid()}{extension}"
+
+def _dump_cprofile(profile, path):
+    profile.disable()
+    profile.dump_stats(path)
+    print(f"Profile written to '{path}' (view it with `python -m pstats {path}`).")
+
+class _StackSampler(threading.Thread):
+    """Samples the Python stacks of every other thread at a fixed interval and counts identical stacks."""
+
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        self._stopped.set()
+        self.join()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.writelines(f"{stack} {samples}\n" for stack, samples in self.stacks.most_common())
+        print(f"Stack samples written to '{path}' (collapsed format, e.g. for flamegraph.pl or speedscope).")
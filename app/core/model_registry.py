@@ -0,0 +1,100 @@
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+# Models are built lazily, once per process, and shared by every caller in that process.
+# mtcnn and deepface (which load TensorFlow) are only imported when a model is first built,
+# so that modes that never run a model, such as searching stored embeddings, start quickly.
+_lock = threading.Lock()
+_detector = None
+# Extra detectors for detecting in parallel threads, idle until lent out by lend_detector
+_idle_detectors = []
+_embedding_models = {}
+
+def get_detector():
+    """
+    Returns the process-wide MTCNN face detector, building it on first use.
+
+    An MTCNN instance must not be called from several threads at once; threads detecting in
+    parallel each borrow their own detector with lend_detector instead.
+
+    Returns:
+        MTCNN: The shared detector.
+    """
+    global _detector
+    with _lock:
+        if _detector is None:
+            from mtcnn import MTCNN
+
+            _detector = MTCNN()
+    return _detector
+
+@contextmanager
+def lend_detector():
+    """
+    Lends an MTCNN face detector that no other thread uses until it is returned.
+
+    Idle detectors are reused, and a new one is only built when every detector is lent out, so a
+    process holds at most as many extra detectors as threads ever detected at once.
+
+    Yields:
+        MTCNN: A detector for the calling thread only.
+    """
+    with _lock:
+        if _idle_detectors:
+            detector = _idle_detectors.pop()
+        else:
+            from mtcnn import MTCNN
+
+            detector = MTCNN()
+    try:
+        yield detector
+    finally:
+        with _lock:
+            _idle_detectors.append(detector)
+
+def get_embedding_model(model_name="Facenet"):
+    """
+    Returns the process-wide DeepFace recognition model with the given name, building it on first use.
+
+    Args:
+        model_name (str): Name of the model. Options include "Facenet", "ArcFace", "VGG-Face", etc.
+
+    Returns:
+        The DeepFace facial recognition client, exposing `input_shape` and `forward`.
+    """
+    with _lock:
+        if model_name not in _embedding_models:
+            from deepface import DeepFace
+
+            _embedding_models[model_name] = DeepFace.build_model(model_name)
+    return _embedding_models[model_name]
+
+def get_input_size(model_name="Facenet"):
+    """
+    Returns the input size of an embedding model, e.g. to align faces directly to it.
+
+    Args:
+        model_name (str): Name of the model.
+
+    Returns:
+        tuple: (width, height) in pixels.
+    """
+    width, height = get_embedding_model(model_name).input_shape
+    return int(width), int(height)
+
+def warm_up(model_names=("Facenet",), detector=True):
+    """
+    Builds the detector and embedding models and runs each once on a blank input, so that graph
+    construction is paid up front instead of on the first real image.
+
+    Args:
+        model_names (iterable): Names of the embedding models to warm up.
+        detector (bool): If True, also warm up the MTCNN detector.
+    """
+    from app.core.feature_extraction import extract_face_embedding
+
+    if detector:
+        get_detector().detect_faces(np.zeros((160, 160, 3), dtype=np.uint8))
+    for model_name in model_names:
+        extract_face_embedding(np.zeros((160, 160, 3), dtype=np.uint8), model_name=model_name)
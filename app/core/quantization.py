@@ -0,0 +1,295 @@
+import numpy as np
+from app.core.metrics import timed
+from app.core.similarity_matching import GallerySearchEngine, _safe_norms
+
+# "none" searches the float32 gallery matrix directly
+QUANTIZATION_MODES = ("none", "float16", "int8", "pq")
+
+# Arrays with one entry per gallery row, appended to as rows are added; the other arrays
+# (the product quantization codebooks) are trained once
+ROW_ARRAYS = ("codes", "scales", "errors")
+
+# Accumulated float32 rounding of approximate and exact scores, added to the error bounds
+_SCORE_SLACK = 1e-5
+# Gallery rows decompressed at once to be scored: small enough for the float32 block to stay in the
+# CPU cache, so decompressing it costs less than reading the float32 rows from memory would
+DECODE_BLOCK_ROWS = 2048
+# Largest (queries x gallery rows) matrix of approximate scores computed at once
+MAX_BLOCK_SCORES = 1 << 26
+
+class QuantizedGallery:
+    """
+    Compressed copy of the L2-normalized gallery rows, scored without decompressing the gallery.
+
+    Modes:
+        - "float16": rows stored as half-precision floats (2 bytes per dimension).
+        - "int8": rows scaled by their largest absolute value and rounded to int8 (1 byte per
+          dimension plus one float32 scale per row).
+        - "pq": product quantization; rows are split into `subspaces` sub-vectors, each replaced by
+          the id of its nearest centroid among 256 (1 byte per sub-vector).
+
+    Every row also keeps the norm of its quantization error, which bounds how far its approximate
+    score can be from the exact one, so that threshold searches can shortlist rows without misses.
+
+    Args:
+        mode (str): "float16", "int8" or "pq".
+        arrays (dict): 'codes' and 'errors', plus 'scales' (int8) or 'codebooks' (pq).
+    """
+
+    def __init__(self, mode, arrays):
+        if mode not in QUANTIZATION_MODES[1:]:
+            raise ValueError(f"Invalid quantization mode '{mode}'. Use one of {', '.join(QUANTIZATION_MODES[1:])}.")
+        self.mode = mode
+        self.arrays = dict(arrays)
+
+    @classmethod
+    @timed("quantize_gallery")
+    def encode(cls, matrix, mode, subspaces=None, iterations=10, sample_size=65536, seed=0, block_size=65536):
+        """
+        Compresses gallery rows, training the product quantization codebooks first if needed.
+
+        Args:
+            matrix (np.array): (N, D) L2-normalized gallery rows (may be memory-mapped).
+            mode (str): "float16", "int8" or "pq".
+            subspaces (int): Number of PQ sub-vectors (bytes per row); must divide D. Defaults to D / 8.
+            iterations (int): Number of k-means iterations per PQ subspace.
+            sample_size (int): Number of rows the PQ codebooks are trained on.
+            seed (int): Seed for sampling and initialization.
+            block_size (int): Number of rows encoded at once.
+
+        Returns:
+            QuantizedGallery: The compressed gallery.
+        """
+        gallery = cls(mode, {})
+        if mode == "pq":
+            gallery.arrays['codebooks'] = _train_codebooks(matrix, subspaces, iterations, sample_size, seed)
+        gallery.arrays.update(gallery.encode_rows(matrix, block_size))
+        return gallery
+
+    def encode_rows(self, rows, block_size=65536):
+        """
+        Compresses rows with this gallery's codebooks, without adding them.
+
+        Args:
+            rows (np.array): (M, D) L2-normalized rows (may be memory-mapped).
+            block_size (int): Number of rows encoded at once.
+
+        Returns:
+            dict: The per-row arrays of the rows (see ROW_ARRAYS).
+        """
+        blocks = [_encode(self.mode, np.asarray(rows[start:start + block_size], dtype=np.float32),
+                          self.arrays.get('codebooks'))
+                  for start in range(0, len(rows), block_size)]
+        if not blocks:
+            blocks = [_encode(self.mode, np.empty((0, rows.shape[1]), dtype=np.float32), self.arrays.get('codebooks'))]
+        return {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]}
+
+    def add(self, arrays):
+        """
+        Appends the per-row arrays of new gallery rows, as returned by encode_rows().
+
+        Args:
+            arrays (dict): Per-row arrays of the rows, in row order.
+        """
+        for name, values in arrays.items():
+            self.arrays[name] = np.concatenate([self.arrays[name], values])
+
+    def __len__(self):
+        return len(self.arrays['codes'])
+
+    @property
+    def errors(self):
+        """Norm of the quantization error of every row."""
+        return self.arrays['errors']
+
+    @property
+    def nbytes(self):
+        """Memory held by the compressed gallery, in bytes."""
+        return sum(values.nbytes for values in self.arrays.values())
+
+    def decode(self, rows=None):
+        """
+        Returns the approximations of gallery rows.
+
+        Args:
+            rows (np.array): Row positions. Defaults to every row.
+
+        Returns:
+            np.array: (M, D) float32 approximations.
+        """
+        rows = slice(None) if rows is None else rows
+        codes = self.arrays['codes'][rows]
+        if self.mode == "float16":
+            return codes.astype(np.float32)
+        if self.mode == "int8":
+            return codes.astype(np.float32) * self.arrays['scales'][rows, None]
+        codebooks = self.arrays['codebooks']
+        return np.concatenate([codebooks[m][codes[:, m]] for m in range(len(codebooks))], axis=1)
+
+    def scores(self, queries, block_size=DECODE_BLOCK_ROWS):
+        """
+        Computes approximate cosine similarities of L2-normalized queries against every gallery row.
+
+        float16 and int8 rows are decompressed to float32 one block at a time and scored with a
+        float32 matrix product: NumPy has no BLAS for integer or half-precision products, and its
+        integer dot products are slower than decompressing a cached block.
+
+        Args:
+            queries (np.array): (Q, D) L2-normalized queries.
+            block_size (int): Number of gallery rows decompressed at once (float16 and int8).
+
+        Returns:
+            np.array: A (Q, N) float32 matrix of approximate cosine similarities.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        codes = self.arrays['codes']
+        if self.mode == "pq":
+            # One table of sub-vector inner products per query and subspace, summed over the codes
+            codebooks = self.arrays['codebooks']
+            sub_queries = queries.reshape(len(queries), len(codebooks), -1)
+            tables = np.einsum('qmd,mkd->qmk', sub_queries, codebooks)
+            scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+            for m in range(len(codebooks)):
+                scores += tables[:, m, codes[:, m]]
+            return scores
+
+        scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), block_size):
+            block = codes[start:start + block_size].astype(np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+        if self.mode == "int8":
+            scores *= self.arrays['scales'][None, :]
+        return scores
+
+class QuantizedSearchEngine(GallerySearchEngine):
+    """
+    A GallerySearchEngine that scores queries on a compressed gallery and re-ranks a shortlist exactly.
+
+    Only the compressed gallery is scanned, so the full-precision matrix can stay on disk as a memory
+    map: it is only read for the shortlisted rows, whose scores are then the exact ones.
+
+    Shortlists:
+        - with a threshold, every row whose score could pass it given its quantization error bound,
+          so no match is missed;
+        - with k, the rerank * k best rows by approximate score (among those above).
+
+    Args:
+        ids (list): Identifiers for the gallery rows, in row order.
+        embeddings (np.array): (N, D) L2-normalized full-precision rows (may be memory-mapped).
+        norms (np.array): Row norms of the original embeddings.
+        quantized (QuantizedGallery): Compressed copy of the same rows.
+        rerank (int): Number of rows re-ranked per requested result when k is given.
+    """
+
+    def __init__(self, ids, embeddings, norms, quantized, rerank=4):
+        super().__init__(ids, embeddings, norms=norms)
+        self.quantized = quantized
+        self.rerank = rerank
+
+    @timed("quantized_search")
+    def search(self, queries, k=None, threshold=None, metric="cosine", block_size=1024):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if metric not in ("cosine", "euclidean"):
+            raise ValueError("Unsupported metric. Choose either 'cosine' or 'euclidean'.")
+        if len(self) == 0:
+            return [[] for _ in range(len(queries))]
+        if k is None and threshold is None:
+            # Every row is returned: nothing to shortlist
+            return super().search(queries, metric=metric, block_size=block_size)
+
+        query_norms = np.linalg.norm(queries, axis=1)
+        normalized = queries / _safe_norms(query_norms)[:, None]
+        # Bounds the approximate score matrix by its size, not only by the number of queries
+        block_size = max(1, min(block_size, MAX_BLOCK_SCORES // len(self)))
+        results = []
+        for start in range(0, len(queries), block_size):
+            approximate = self.quantized.scores(normalized[start:start + block_size])
+            for i, row in enumerate(approximate):
+                query = queries[start + i]
+                shortlist = self._shortlist(row, query_norms[start + i], k, threshold, metric)
+                results.append(self.search_rows(query, shortlist, k=k, threshold=threshold, metric=metric))
+        return results
+
+    def _shortlist(self, approximate, query_norm, k, threshold, metric):
+        """Selects the rows to re-rank from the approximate cosine similarities of one query."""
+        candidates = np.arange(len(approximate))
+        if threshold is not None:
+            # For a unit query, |exact - approximate| <= the norm of the row's quantization error
+            upper = np.minimum(approximate + self.quantized.errors + _SCORE_SLACK, 1)
+            passing = upper >= threshold if metric == "cosine" else \
+                self._distances(upper, query_norm) <= threshold + _SCORE_SLACK
+            candidates = np.flatnonzero(passing)
+
+        limit = k * self.rerank if k is not None else None
+        if limit is not None and len(candidates) > limit:
+            keyed = -approximate[candidates] if metric == "cosine" else \
+                self._distances(approximate[candidates], query_norm, candidates)
+            candidates = candidates[np.argpartition(keyed, limit - 1)[:limit]]
+        return candidates
+
+    def _distances(self, cosine_scores, query_norm, rows=None):
+        norms = self.norms if rows is None else self.norms[rows]
+        squared = query_norm ** 2 + norms ** 2 - 2 * query_norm * norms * cosine_scores
+        return np.sqrt(np.maximum(squared, 0))
+
+def _encode(mode, rows, codebooks=None):
+    """Compresses a block of rows and measures the norm of each row's quantization error."""
+    if mode == "float16":
+        codes = rows.astype(np.float16)
+        approximations = codes.astype(np.float32)
+        arrays = {'codes': codes}
+    elif mode == "int8":
+        scales = (np.abs(rows).max(axis=1) / 127).astype(np.float32) if len(rows) else np.empty(0, np.float32)
+        codes = np.clip(np.rint(rows / _safe_norms(scales)[:, None]), -127, 127).astype(np.int8)
+        approximations = codes.astype(np.float32) * scales[:, None]
+        arrays = {'codes': codes, 'scales': scales}
+    else:
+        sub_rows = rows.reshape(len(rows), len(codebooks), -1)
+        codes = np.empty((len(rows), len(codebooks)), dtype=np.uint8)
+        for m, codebook in enumerate(codebooks):
+            codes[:, m] = _nearest(np.ascontiguousarray(sub_rows[:, m]), codebook)
+        approximations = np.concatenate([codebooks[m][codes[:, m]] for m in range(len(codebooks))], axis=1) \
+            if len(rows) else np.empty_like(rows)
+        arrays = {'codes': codes}
+    arrays['errors'] = np.linalg.norm(rows - approximations, axis=1).astype(np.float32)
+    return arrays
+
+def _train_codebooks(matrix, subspaces, iterations, sample_size, seed, centroids=256):
+    """Trains one k-means codebook of up to 256 centroids per subspace on a sample of the rows."""
+    n, dim = matrix.shape
+    if n == 0:
+        raise ValueError("Cannot train product quantization codebooks on an empty gallery.")
+    subspaces = subspaces or max(1, dim // 8)
+    if dim % subspaces:
+        raise ValueError(f"The number of PQ subspaces ({subspaces}) must divide the embedding dimension ({dim}).")
+
+    rng = np.random.default_rng(seed)
+    # Sorted sample indices keep reads from a memory-mapped matrix sequential
+    sample = np.asarray(matrix[np.sort(rng.choice(n, min(n, sample_size), replace=False))], dtype=np.float32)
+    sample = sample.reshape(len(sample), subspaces, -1)
+    centroids = min(centroids, len(sample))
+
+    codebooks = np.empty((subspaces, centroids, dim // subspaces), dtype=np.float32)
+    for m in range(subspaces):
+        vectors = np.ascontiguousarray(sample[:, m])
+        codebook = vectors[rng.choice(len(vectors), centroids, replace=False)].copy()
+        for _ in range(iterations):
+            labels = _nearest(vectors, codebook)
+            # One bincount per dimension is much faster than np.add.at on the sub-vectors
+            sums = np.stack([np.bincount(labels, weights=vectors[:, d], minlength=centroids)
+                             for d in range(vectors.shape[1])], axis=1)
+            counts = np.bincount(labels, minlength=centroids)
+            # Empty centroids keep their position
+            filled = counts > 0
+            codebook[filled] = sums[filled] / counts[filled, None]
+        codebooks[m] = codebook
+    return codebooks
+
+def _nearest(vectors, codebook, block_size=8192):
+    """Returns the id of the closest (Euclidean) codebook entry of each vector."""
+    labels = np.empty(len(vectors), dtype=np.int64)
+    squared_norms = (codebook ** 2).sum(axis=1)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        labels[start:start + len(block)] = np.argmin(squared_norms[None, :] - 2 * block @ codebook.T, axis=1)
+    return labels
@@ -0,0 +1,138 @@
+import multiprocessing as mp
+import os
+import zlib
+from contextlib import contextmanager
+import numpy as np
+from app.core import metrics
+from app.core.metrics import timed
+from app.core.similarity_matching import GallerySearchEngine
+
+# Thread limits of the BLAS libraries NumPy may be linked against: search workers already split
+# the gallery between the cores, so each of them runs its matrix products on a single thread
+_BLAS_THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")
+
+# Process pool shared by every sharded engine of the process, and its number of workers
+_pool = None
+_pool_workers = 0
+# Engines over the shards opened by a search worker: (gallery, shard) -> (split, count, engine, rows)
+_open_shards = {}
+
+def shard_of(filenames, shards):
+    """
+    Assigns gallery rows to shards by a hash of the image they belong to, so every face of an
+    image lands in the same shard.
+
+    Args:
+        filenames (list): Group image filename of every row.
+        shards (int): Number of shards.
+
+    Returns:
+        np.array: The shard of every row.
+    """
+    return np.fromiter((zlib.crc32(filename.encode('utf-8')) % shards for filename in filenames), dtype=np.int64,
+                       count=len(filenames))
+
+class ShardedSearchEngine(GallerySearchEngine):
+    """
+    A GallerySearchEngine whose rows are split into shards, searched in parallel by a process pool.
+
+    Each worker scans whole shards, memory-mapped so their pages are shared between processes, and
+    only returns its local top-k or threshold matches. These are merged into the results an exact
+    search over the full gallery returns, with row indices into the full gallery.
+
+    Args:
+        ids (list): Identifiers for the gallery rows, in row order.
+        embeddings (np.array): (N, D) L2-normalized rows of the full gallery (may be memory-mapped); only
+                               read by `score` and `search_rows`.
+        norms (np.array): Row norms of the original embeddings.
+        shards (list): Shard descriptors: dicts with the 'matrix', 'norms' and 'rows' (position of each
+                       row in the full gallery) .npy paths, the 'count' of rows of the shard, and the
+                       'gallery', 'shard' index and 'split' identifier the open files are cached by.
+        workers (int): Number of search processes, at most one per shard; 0 uses one per CPU. With a
+                       single worker the shards are searched one after the other in this process.
+    """
+
+    def __init__(self, ids, embeddings, norms, shards, workers=0):
+        super().__init__(ids, embeddings, norms=norms)
+        self.shards = [shard for shard in shards if shard['count']]
+        self.workers = max(1, min(workers or os.cpu_count() or 1, len(self.shards)))
+
+    @timed("sharded_search")
+    def search(self, queries, k=None, threshold=None, metric="cosine", block_size=1024):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if metric not in ("cosine", "euclidean"):
+            raise ValueError("Unsupported metric. Choose either 'cosine' or 'euclidean'.")
+        if not self.shards:
+            return [[] for _ in range(len(queries))]
+
+        tasks = [(shard, queries, k, threshold, metric, block_size) for shard in self.shards]
+        if self.workers > 1:
+            partials = _search_pool(self.workers).starmap(_search_shard, tasks)
+        else:
+            partials = [_search_shard(*task) for task in tasks]
+        higher_is_better = metric == "cosine"
+        return [_merge([partial[i] for partial in partials], k, higher_is_better) for i in range(len(queries))]
+
+def _search_shard(shard, queries, k, threshold, metric, block_size):
+    """Searches one shard and returns, per query, the gallery rows and scores of its local results."""
+    key = (shard['gallery'], shard['shard'])
+    cached = _open_shards.get(key)
+    if cached is None or cached[:2] != (shard['split'], shard['count']):
+        # A new split replaced the files and an append grew them: drop the memory maps they supersede,
+        # including those of shards the new split no longer has
+        for stale in [other for other, (split, _, _, _) in _open_shards.items()
+                      if other[0] == shard['gallery'] and split != shard['split']]:
+            del _open_shards[stale]
+        # Rows past `count` may be an uncommitted append
+        matrix = np.load(shard['matrix'], mmap_mode='r')[:shard['count']]
+        norms = np.load(shard['norms'], mmap_mode='r')[:shard['count']]
+        rows = np.load(shard['rows'], mmap_mode='r')[:shard['count']]
+        cached = (shard['split'], shard['count'], GallerySearchEngine(range(shard['count']), matrix, norms=norms),
+                  np.asarray(rows))
+        _open_shards[key] = cached
+    _, _, engine, rows = cached
+
+    results = []
+    for matches in engine.search(queries, k=k, threshold=threshold, metric=metric, block_size=block_size):
+        local = np.fromiter((index for index, _ in matches), dtype=np.int64, count=len(matches))
+        scores = np.fromiter((score for _, score in matches), dtype=np.float64, count=len(matches))
+        results.append((rows[local], scores))
+    return results
+
+def _merge(partials, k, higher_is_better):
+    """Merges the local results of every shard for one query: the k best, or all of them in gallery order."""
+    rows = np.concatenate([rows for rows, _ in partials])
+    scores = np.concatenate([scores for _, scores in partials])
+    if k is None:
+        order = np.argsort(rows, kind="stable")
+    else:
+        order = np.argsort(-scores if higher_is_better else scores, kind="stable")[:k]
+    return [(int(rows[i]), float(scores[i])) for i in order]
+
+def _search_pool(workers):
+    """Returns the process pool of search workers, started on first use."""
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.terminate()
+        with _single_threaded_blas():
+            # TensorFlow may be loaded in this process and is not fork-safe, so workers are always spawned,
+            # and they start with metrics disabled, so they are handed this process's settings
+            _pool = mp.get_context("spawn").Pool(workers, initializer=_configure_worker,
+                                                 initargs=(metrics.settings(),))
+        _pool_workers = workers
+    return _pool
+
+def _configure_worker(metrics_settings):
+    metrics.configure(**metrics_settings)
+
+@contextmanager
+def _single_threaded_blas():
+    """Sets the BLAS thread limits that are not set already while processes are started."""
+    missing = [name for name in _BLAS_THREAD_VARIABLES if name not in os.environ]
+    os.environ.update({name: "1" for name in missing})
+    try:
+        yield
+    finally:
+        for name in missing:
+            os.environ.pop(name, None)
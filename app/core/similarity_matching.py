@@ -1,5 +1,11 @@
 import numpy as np
-from scipy.spatial.distance import cosine, euclidean
+from app.core.metrics import timed
+
+# float32 rounding of the scores from the gallery matrix product, per embedding dimension. Rows whose
+# float32 score is within this margin of the threshold or of the k-th best score are rescored exactly.
+_FLOAT32_EPS = float(np.finfo(np.float32).eps)
+# Number of gallery rows rescored in float64 at once
+EXACT_BLOCK_ROWS = 65536
 
 def compute_cosine_similarity(embedding1, embedding2):
     """
@@ -12,6 +18,8 @@ def compute_cosine_similarity(embedding1, embedding2):
     Returns:
         float: Cosine similarity value between -1 and 1.
     """
+    from scipy.spatial.distance import cosine
+
     # The cosine function from scipy returns the cosine distance.
     # To convert it to similarity, we can subtract from 1.
     return 1 - cosine(embedding1, embedding2)
@@ -27,8 +35,224 @@ def compute_euclidean_distance(embedding1, embedding2):
     Returns:
         float: Euclidean distance.
     """
+    from scipy.spatial.distance import euclidean
+
     return euclidean(embedding1, embedding2)
 
+class GallerySearchEngine:
+    """
+    Scores a whole gallery of embeddings against one or more queries with a single matrix product.
+
+    The gallery is kept as one float32 matrix of L2-normalized rows plus the original row norms,
+    so cosine similarity and Euclidean distance are both derived from the same dot products. The
+    results of `search` are then rescored in float64, as compute_cosine_similarity and
+    compute_euclidean_distance do on float64 embeddings: the float32 scores only select the candidates.
+    The rows are rescored from the original embeddings when the engine is built from them, and
+    otherwise from the normalized rows times their norms, which are accurate to float32 precision.
+
+    Args:
+        ids (list): Identifiers for the gallery rows (e.g., filenames), in row order.
+        embeddings (np.array): Gallery embeddings with shape (N, D).
+        norms (np.array): Row norms of the original embeddings. When given, `embeddings` is assumed
+                          to be normalized already and is used as-is without copying.
+    """
+
+    def __init__(self, ids, embeddings, norms=None):
+        self.ids = list(ids)
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim != 2:
+            matrix = matrix.reshape(len(self.ids), -1)
+
+        self._embeddings = None
+        if norms is None:
+            # The original rows are kept for rescoring (without a copy unless they were not float32)
+            self._embeddings = matrix
+            norms = np.linalg.norm(matrix, axis=1)
+            matrix = matrix / _safe_norms(norms)[:, None]
+
+        self.matrix = matrix
+        self.norms = np.asarray(norms, dtype=np.float32)
+        self._max_norm = float(self.norms.max()) if len(self.norms) else 0.0
+
+    @classmethod
+    def from_dict(cls, group_embeddings):
+        """
+        Builds an engine from a dictionary of identifiers to embedding vectors.
+
+        Args:
+            group_embeddings (dict): Keys are identifiers, values are embedding vectors.
+
+        Returns:
+            GallerySearchEngine: The engine, with rows in the dictionary's iteration order.
+        """
+        ids = list(group_embeddings.keys())
+        if not ids:
+            return cls([], np.empty((0, 0), dtype=np.float32))
+        return cls(ids, np.stack([np.asarray(e, dtype=np.float32) for e in group_embeddings.values()]))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def score(self, queries, metric="cosine"):
+        """
+        Computes the scores of every query against every gallery row.
+
+        Args:
+            queries (np.array): A single embedding of shape (D,) or a batch of shape (Q, D).
+            metric (str): The similarity metric to use ("cosine" or "euclidean").
+
+        Returns:
+            np.array: A (Q, N) float32 matrix of cosine similarities or Euclidean distances. Distances
+                      between near-identical vectors are only accurate to about sqrt(eps) times
+                      the norms; `search` rescores its results exactly.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        query_norms = np.linalg.norm(queries, axis=1)
+        cosine_scores = (queries / _safe_norms(query_norms)[:, None]) @ self.matrix.T
+
+        if metric == "cosine":
+            return cosine_scores
+        if metric == "euclidean":
+            # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 * ||a|| * ||b|| * cos(a, b)
+            squared = (query_norms[:, None] ** 2 + self.norms[None, :] ** 2
+                       - 2 * query_norms[:, None] * self.norms[None, :] * cosine_scores)
+            return np.sqrt(np.maximum(squared, 0)).astype(np.float32)
+        raise ValueError("Unsupported metric. Choose either 'cosine' or 'euclidean'.")
+
+    @timed("gallery_search")
+    def search(self, queries, k=None, threshold=None, metric="cosine", block_size=1024):
+        """
+        Finds the best gallery rows for each query.
+
+        Args:
+            queries (np.array): A single embedding of shape (D,) or a batch of shape (Q, D).
+            k (int): Keep only the k best results per query, ordered from best to worst.
+                     If None, every result passing the threshold is kept in gallery order.
+            threshold (float): A threshold to determine a match.
+                               - For cosine, higher values indicate similarity (e.g., 0.8).
+                               - For Euclidean, lower values indicate similarity.
+            metric (str): The similarity metric to use ("cosine" or "euclidean").
+            block_size (int): Number of queries scored per matrix product, bounding memory to
+                              block_size x N scores.
+
+        Returns:
+            list: One list per query of (row index, score) tuples. Scores are computed in float64 as
+                  compute_cosine_similarity and compute_euclidean_distance do, so the cosine
+                  similarity involving a zero vector is nan (and never passes a threshold).
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if metric not in ("cosine", "euclidean"):
+            raise ValueError("Unsupported metric. Choose either 'cosine' or 'euclidean'.")
+        if len(self) == 0:
+            return [[] for _ in range(len(queries))]
+
+        higher_is_better = metric == "cosine"
+        results = []
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start + block_size]
+            for query, row in zip(block, self.score(block, metric=metric)):
+                candidates = _candidates(row, k, threshold, higher_is_better, self._margin(query, metric))
+                exact = self.exact_scores(query, candidates, metric)
+                results.append([(int(candidates[i]), score)
+                                for i, score in _select(exact, k, threshold, higher_is_better)])
+        return results
+
+    def exact_scores(self, query, rows, metric="cosine"):
+        """
+        Scores one query against gallery rows in float64, as compute_cosine_similarity and
+        compute_euclidean_distance do on the original embeddings.
+
+        Args:
+            query (np.array): A single embedding of shape (D,).
+            rows (np.array): Gallery row positions, preferably sorted.
+            metric (str): The similarity metric to use ("cosine" or "euclidean").
+
+        Returns:
+            np.array: float64 scores of the rows; nan for cosine similarities involving a zero vector.
+        """
+        query = np.asarray(query, dtype=np.float64).ravel()
+        scores = np.empty(len(rows), dtype=np.float64)
+        for start in range(0, len(rows), EXACT_BLOCK_ROWS):
+            block = rows[start:start + EXACT_BLOCK_ROWS]
+            if self._embeddings is not None:
+                gallery = np.asarray(self._embeddings[block], dtype=np.float64)
+            else:
+                gallery = np.asarray(self.matrix[block], dtype=np.float64) * \
+                    np.asarray(self.norms[block], dtype=np.float64)[:, None]
+            if metric == "cosine":
+                # Same formula as scipy's cosine distance, subtracted from 1
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    distances = 1.0 - (gallery @ query) / np.sqrt((gallery * gallery).sum(axis=1) * (query @ query))
+                scores[start:start + len(block)] = 1 - np.clip(distances, 0.0, 2.0)
+            else:
+                scores[start:start + len(block)] = np.linalg.norm(gallery - query, axis=1)
+        return scores
+
+    def _margin(self, query, metric):
+        """Bound on the float32 rounding of the scores of one query, see _FLOAT32_EPS."""
+        dim = self.matrix.shape[1]
+        if metric == "cosine":
+            return 4 * dim * _FLOAT32_EPS
+        # The squared distance is a difference of terms of size |a|^2 + |b|^2, so its rounding is
+        # relative to them, and becomes up to its square root on the distance
+        squared_norms = float(np.dot(query, query)) + self._max_norm ** 2
+        return float(np.sqrt(4 * dim * _FLOAT32_EPS * squared_norms))
+
+    def search_rows(self, query, rows, k=None, threshold=None, metric="cosine"):
+        """
+        Scores a single query exactly against a shortlist of gallery rows (e.g., from an ANN index).
+
+        Args:
+            query (np.array): A single embedding of shape (D,).
+            rows (np.array): Gallery row positions to score.
+            k (int): Keep only the k best results, ordered from best to worst.
+            threshold (float): A threshold to determine a match (see `search`).
+            metric (str): The similarity metric to use ("cosine" or "euclidean").
+
+        Returns:
+            list: (row index, score) tuples with row indices into the full gallery.
+        """
+        rows = np.sort(np.asarray(rows, dtype=np.int64))
+        subset = GallerySearchEngine(rows, self.matrix[rows], norms=self.norms[rows])
+        return [(int(rows[i]), score) for i, score in subset.search(query, k=k, threshold=threshold, metric=metric)[0]]
+
+def _safe_norms(norms):
+    """Replaces zero norms by one so that zero vectors stay zero after normalization."""
+    return np.where(norms > 0, norms, 1).astype(np.float32)
+
+def _candidates(scores, k, threshold, higher_is_better, margin):
+    """
+    Selects the rows whose exact score could pass the threshold or rank in the top k, given float32
+    scores accurate to within `margin`. Returns sorted row positions.
+    """
+    keyed = -scores if higher_is_better else scores
+    if threshold is not None:
+        passing = np.flatnonzero(keyed <= (-threshold if higher_is_better else threshold) + margin)
+    else:
+        passing = np.arange(len(scores))
+
+    if k is not None and k < len(passing):
+        kth = np.partition(keyed[passing], k - 1)[k - 1]
+        passing = passing[keyed[passing] <= kth + 2 * margin]
+    return passing
+
+def _select(scores, k, threshold, higher_is_better):
+    """Applies the threshold and top-k selection to one row of scores."""
+    if threshold is not None:
+        passing = np.flatnonzero(scores >= threshold if higher_is_better else scores <= threshold)
+    else:
+        passing = np.arange(len(scores))
+
+    if k is not None and k < len(passing):
+        keyed = -scores[passing] if higher_is_better else scores[passing]
+        passing = passing[np.argpartition(keyed, k - 1)[:k]]
+    if k is not None:
+        keyed = -scores[passing] if higher_is_better else scores[passing]
+        passing = passing[np.argsort(keyed, kind="stable")]
+
+    return [(int(i), float(scores[i])) for i in passing]
+
+@timed("match_embeddings")
 def match_embeddings(group_embeddings, reference_embedding, metric="cosine", threshold=None):
     """
     Matches a set of group embeddings against a single reference embedding.
@@ -46,18 +270,7 @@ def match_embeddings(group_embeddings, reference_embedding, metric="cosine", thr
         dict: A dictionary with keys as group image identifiers and values as the computed similarity
               (or distance) scores for those that pass the threshold.
     """
-    matches = {}
-
-    for group_id, group_embedding in group_embeddings.items():
-        if metric == "cosine":
-            similarity = compute_cosine_similarity(group_embedding, reference_embedding)
-            if threshold is None or similarity >= threshold:
-                matches[group_id] = similarity
-        elif metric == "euclidean":
-            distance = compute_euclidean_distance(group_embedding, reference_embedding)
-            if threshold is None or distance <= threshold:
-                matches[group_id] = distance
-        else:
-            raise ValueError("Unsupported metric. Choose either 'cosine' or 'euclidean'.")
+    engine = GallerySearchEngine.from_dict(group_embeddings)
+    results = engine.search(reference_embedding, threshold=threshold, metric=metric)[0]
 
-    return matches
+    return {engine.ids[index]: score for index, score in results}
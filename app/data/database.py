@@ -1,119 +1,1381 @@
 import sqlite3
 import json
 import os
+import threading
+import time
 import numpy as np
+from app.core.feature_extraction import EMBEDDING_PIPELINE
+from app.core.metrics import timed
 
 # Define the database path (it will be created inside the app folder)
 DB_PATH = os.path.join(os.path.dirname(__file__), 'database.db')
 
-def init_db():
+# Embeddings are stored as raw little-endian float32 bytes; `dim` and `dtype` are kept per row.
+EMBEDDING_DTYPE = '<f4'
+
+# Embeddings are keyed by the model and alignment that produced them. Embeddings stored before
+# that key existed are attributed to the defaults, which were the only pipeline at the time.
+DEFAULT_MODEL_NAME = 'Facenet'
+DEFAULT_ALIGNMENT = 'legacy'
+
+# Embedding pipeline of the embeddings stored before they were tagged with one, which were computed
+# with DeepFace.represent (see feature_extraction.EMBEDDING_PIPELINE). They stay searchable until
+# MODE=add re-embeds them, which replaces them in place.
+LEGACY_EMBEDDING_PIPELINE = 'represent'
+
+# Applied to every pooled connection. WAL lets readers run alongside the writer and, with
+# synchronous=NORMAL, a commit appends to the log without an fsync (only checkpoints sync).
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Stay below SQLite's limit on the number of bound parameters
+_MAX_PARAMS = 500
+
+_local = threading.local()
+
+def get_connection(db_path=None):
+    """
+    Returns the connection to a database file shared by the calling process.
+
+    Connections are opened on first use and kept open, one per database path. They are also kept
+    per thread, since sqlite3 connections must not be shared between threads, and reopened in a
+    forked child rather than reused from the parent.
+
+    Args:
+        db_path (str): Path of the database file. Defaults to DB_PATH.
+
+    Returns:
+        sqlite3.Connection: The open connection.
+    """
+    db_path = db_path or DB_PATH
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+
+    conn = _local.connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        _local.connections[db_path] = conn
+    return conn
+
+def close_connections():
+    """Closes the connections opened by the calling thread."""
+    if getattr(_local, 'pid', None) == os.getpid():
+        for conn in _local.connections.values():
+            conn.close()
+    _local.pid = os.getpid()
+    _local.connections = {}
+
+def init_db(model_name=DEFAULT_MODEL_NAME):
+    """
+    Creates the tables and migrates databases written by older versions.
+
+    Args:
+        model_name (str): Model that produced the embeddings of older versions, which stored them
+                          without their model name (the configured MODEL_NAME).
+    """
     data_dir = os.path.dirname(DB_PATH)
     os.makedirs(data_dir, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('''CREATE TABLE IF NOT EXISTS reference_images (
                         id INTEGER PRIMARY KEY,
-                        filename TEXT UNIQUE,
-                        embedding BLOB
+                        filename TEXT,
+                        model_name TEXT NOT NULL,
+                        alignment TEXT NOT NULL,
+                        embedding BLOB,
+                        dim INTEGER,
+                        dtype TEXT,
+                        UNIQUE (filename, model_name, alignment)
                       )''')
     cursor.execute('''CREATE TABLE IF NOT EXISTS group_images (
                         id INTEGER PRIMARY KEY,
                         filename TEXT UNIQUE,
-                        embedding BLOB
+                        embedding BLOB,
+                        dim INTEGER,
+                        dtype TEXT,
+                        content_hash TEXT
+                      )''')
+    # One row per detected face of a group image: the cached detection, shared by every model
+    cursor.execute('''CREATE TABLE IF NOT EXISTS group_faces (
+                        id INTEGER PRIMARY KEY,
+                        image_id INTEGER NOT NULL REFERENCES group_images(id),
+                        face_index INTEGER NOT NULL,
+                        box_x INTEGER,
+                        box_y INTEGER,
+                        box_w INTEGER,
+                        box_h INTEGER,
+                        confidence REAL,
+                        keypoints TEXT,
+                        embedding BLOB,
+                        dim INTEGER,
+                        dtype TEXT,
+                        UNIQUE (image_id, face_index)
+                      )''')
+    # One embedding per group face and (model, alignment); each pair has its own gallery matrix
+    cursor.execute('''CREATE TABLE IF NOT EXISTS face_embeddings (
+                        face_id INTEGER NOT NULL REFERENCES group_faces(id),
+                        model_name TEXT NOT NULL,
+                        alignment TEXT NOT NULL,
+                        embedding BLOB NOT NULL,
+                        dim INTEGER NOT NULL,
+                        dtype TEXT NOT NULL,
+                        UNIQUE (face_id, model_name, alignment)
                       )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_face_embeddings_model ON face_embeddings (model_name, alignment)")
+    # Every change to a gallery bumps its generation so gallery matrix files can detect staleness
+    cursor.execute('''CREATE TABLE IF NOT EXISTS gallery_state (
+                        key TEXT PRIMARY KEY,
+                        value INTEGER
+                      )''')
+    # Files already seen by folder ingestion, so a re-scan only decodes new or changed files
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ingest_manifest (
+                        path TEXT PRIMARY KEY,
+                        content_hash TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL
+                      )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ingest_manifest_hash ON ingest_manifest (content_hash)")
+    # Cluster of every group face per (model, alignment), from MODE=cluster
+    cursor.execute('''CREATE TABLE IF NOT EXISTS face_clusters (
+                        face_id INTEGER NOT NULL REFERENCES group_faces(id),
+                        model_name TEXT NOT NULL,
+                        alignment TEXT NOT NULL,
+                        cluster_id INTEGER NOT NULL,
+                        UNIQUE (face_id, model_name, alignment)
+                      )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_face_clusters_cluster ON face_clusters (model_name, alignment, cluster_id)")
+    # Parameters of the last clustering; `stale` is set when clustered faces are removed, since
+    # that can split clusters and only a full re-clustering accounts for it
+    cursor.execute('''CREATE TABLE IF NOT EXISTS cluster_state (
+                        model_name TEXT NOT NULL,
+                        alignment TEXT NOT NULL,
+                        metric TEXT NOT NULL,
+                        threshold REAL NOT NULL,
+                        stale INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (model_name, alignment)
+                      )''')
+    # Time range of every face track of a video; the video is a group image and each track one of its faces
+    cursor.execute('''CREATE TABLE IF NOT EXISTS video_tracks (
+                        face_id INTEGER PRIMARY KEY REFERENCES group_faces(id),
+                        start_ms INTEGER NOT NULL,
+                        end_ms INTEGER NOT NULL,
+                        detections INTEGER NOT NULL,
+                        samples INTEGER NOT NULL
+                      )''')
+    # Identities made of several reference images, aggregated into templates per (model, alignment)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS identities (
+                        id INTEGER PRIMARY KEY,
+                        name TEXT UNIQUE NOT NULL
+                      )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS identity_references (
+                        identity_id INTEGER NOT NULL REFERENCES identities(id),
+                        filename TEXT NOT NULL,
+                        UNIQUE (identity_id, filename)
+                      )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS identity_templates (
+                        identity_id INTEGER NOT NULL REFERENCES identities(id),
+                        model_name TEXT NOT NULL,
+                        alignment TEXT NOT NULL,
+                        template_index INTEGER NOT NULL,
+                        embedding BLOB NOT NULL,
+                        dim INTEGER NOT NULL,
+                        dtype TEXT NOT NULL,
+                        UNIQUE (identity_id, model_name, alignment, template_index)
+                      )''')
+    # Best-matching identity of every group face and its score, from MODE=identify; the threshold is
+    # applied when the labels are read, so it can change without rescoring
+    cursor.execute('''CREATE TABLE IF NOT EXISTS face_identities (
+                        face_id INTEGER NOT NULL REFERENCES group_faces(id),
+                        model_name TEXT NOT NULL,
+                        alignment TEXT NOT NULL,
+                        identity_id INTEGER NOT NULL REFERENCES identities(id),
+                        score REAL NOT NULL,
+                        UNIQUE (face_id, model_name, alignment)
+                      )''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_face_identities_identity
+                      ON face_identities (model_name, alignment, identity_id, score)''')
+    # `version` changes with the templates; labels computed from other templates are recomputed
+    cursor.execute('''CREATE TABLE IF NOT EXISTS identity_state (
+                        model_name TEXT NOT NULL,
+                        alignment TEXT NOT NULL,
+                        version INTEGER NOT NULL DEFAULT 0,
+                        labels_version INTEGER,
+                        metric TEXT,
+                        PRIMARY KEY (model_name, alignment)
+                      )''')
+    for table in ("reference_images", "group_images"):
+        _migrate_json_embeddings(cursor, table)
+    _migrate_reference_images_key(cursor, model_name)
+    _add_column_if_missing(cursor, "group_faces", "detector", "TEXT")
+    _migrate_group_image_embeddings(cursor)
+    _migrate_face_embeddings(cursor, model_name)
+    _add_column_if_missing(cursor, "group_images", "content_hash", "TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_group_images_hash ON group_images (content_hash)")
+    _migrate_embedding_pipeline(cursor)
     conn.commit()
-    conn.close()
 
-def insert_reference_image(filename, embedding):
+def _add_column_if_missing(cursor, table, column, column_type):
+    columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+def _migrate_group_image_embeddings(cursor):
+    """
+    Moves the single per-image embedding stored by older versions into group_faces as face 0.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the open connection; the caller commits.
+    """
+    cursor.execute('''
+        INSERT INTO group_faces (image_id, face_index, embedding, dim, dtype)
+        SELECT id, 0, embedding, dim, dtype FROM group_images
+        WHERE embedding IS NOT NULL AND dtype IS NOT NULL
+    ''')
+    if cursor.rowcount > 0:
+        print(f"Migrated {cursor.rowcount} group image embeddings to the group_faces table.")
+        cursor.execute("UPDATE group_images SET embedding = NULL, dim = NULL, dtype = NULL")
+
+def _migrate_face_embeddings(cursor, model_name):
+    """
+    Moves the embeddings stored in group_faces by older versions into face_embeddings, under the
+    model that produced them and the legacy alignment.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the open connection; the caller commits.
+        model_name (str): Model that produced the embeddings.
+    """
+    cursor.execute('''
+        INSERT INTO face_embeddings (face_id, model_name, alignment, embedding, dim, dtype)
+        SELECT id, ?, ?, embedding, dim, dtype FROM group_faces
+        WHERE embedding IS NOT NULL AND dtype IS NOT NULL
+        ORDER BY id
+    ''', (model_name, DEFAULT_ALIGNMENT))
+    if cursor.rowcount > 0:
+        print(f"Migrated {cursor.rowcount} group face embeddings to the face_embeddings table "
+              f"(model '{model_name}', alignment '{DEFAULT_ALIGNMENT}').")
+        cursor.execute("UPDATE group_faces SET embedding = NULL, dim = NULL, dtype = NULL")
+        _bump_gallery_generation(cursor, model_name, DEFAULT_ALIGNMENT)
+
+def _migrate_embedding_pipeline(cursor):
+    """
+    Tags the embeddings stored by older versions with the legacy embedding pipeline.
+
+    They are still searched, so an upgraded gallery keeps its matches, but count as missing for the
+    current pipeline: the next MODE=add run re-embeds the group faces (detecting the images again
+    when the faces were stored without a box) and replaces them, and reference images are
+    re-embedded the next time they are used.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the open connection; the caller commits.
+    """
+    tagged = 0
+    for table in ("reference_images", "face_embeddings"):
+        _add_column_if_missing(cursor, table, "pipeline", "TEXT")
+        cursor.execute(f"UPDATE {table} SET pipeline = ? WHERE pipeline IS NULL", (LEGACY_EMBEDDING_PIPELINE,))
+        tagged += max(cursor.rowcount, 0)
+    if tagged:
+        print(f"Tagged {tagged} embeddings with the legacy '{LEGACY_EMBEDDING_PIPELINE}' pipeline; they are "
+              f"re-embedded with the '{EMBEDDING_PIPELINE}' pipeline by the next MODE=add run.")
+
+def _migrate_reference_images_key(cursor, model_name):
+    """
+    Rebuilds a reference_images table created by older versions, where filename alone was unique,
+    so that each reference can hold one embedding per model and alignment. The existing references
+    are kept under the model that produced them and the legacy alignment.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the open connection; the caller commits.
+        model_name (str): Model that produced the reference embeddings.
+    """
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(reference_images)")}
+    if "model_name" in columns:
+        return
+    cursor.execute("ALTER TABLE reference_images RENAME TO reference_images_old")
+    cursor.execute('''CREATE TABLE reference_images (
+                        id INTEGER PRIMARY KEY,
+                        filename TEXT,
+                        model_name TEXT NOT NULL,
+                        alignment TEXT NOT NULL,
+                        embedding BLOB,
+                        dim INTEGER,
+                        dtype TEXT,
+                        UNIQUE (filename, model_name, alignment)
+                      )''')
+    cursor.execute('''
+        INSERT INTO reference_images (id, filename, model_name, alignment, embedding, dim, dtype)
+        SELECT id, filename, ?, ?, embedding, dim, dtype FROM reference_images_old
+    ''', (model_name, DEFAULT_ALIGNMENT))
+    cursor.execute("DROP TABLE reference_images_old")
+
+def _migrate_json_embeddings(cursor, table):
+    """
+    Converts embeddings stored as JSON text by older versions into float32 bytes, in place.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the open connection; the caller commits.
+        table (str): The table name ('reference_images' or 'group_images').
+    """
+    for column, column_type in (("dim", "INTEGER"), ("dtype", "TEXT")):
+        _add_column_if_missing(cursor, table, column, column_type)
+
+    rows = cursor.execute(f"SELECT id, filename, embedding FROM {table} WHERE embedding IS NOT NULL AND dtype IS NULL").fetchall()
+    converted = []
+    for row_id, filename, embedding_json in rows:
+        try:
+            embedding_bytes, dim = _encode_embedding(json.loads(embedding_json))
+            converted.append((embedding_bytes, dim, EMBEDDING_DTYPE, row_id))
+        except Exception as e:
+            print(f"Error migrating embedding for {filename}: {e}")
+
+    if converted:
+        cursor.executemany(f"UPDATE {table} SET embedding = ?, dim = ?, dtype = ? WHERE id = ?", converted)
+        print(f"Migrated {len(converted)} embeddings in '{table}' to binary float32 storage.")
+
+def _encode_embedding(embedding):
+    """
+    Serializes an embedding to little-endian float32 bytes.
+
+    Args:
+        embedding (list or np.array): The face embedding vector.
+
+    Returns:
+        tuple: (bytes, dimension) of the serialized embedding.
+    """
+    array = np.asarray(embedding, dtype=EMBEDDING_DTYPE).ravel()
+    return array.tobytes(), array.size
+
+def _decode_embedding(embedding_bytes, dtype=EMBEDDING_DTYPE):
+    """
+    Deserializes an embedding without copying the underlying bytes.
+
+    Args:
+        embedding_bytes (bytes): The stored embedding.
+        dtype (str): The stored dtype; defaults to little-endian float32.
+
+    Returns:
+        np.array: A read-only view over the stored bytes.
+    """
+    return np.frombuffer(embedding_bytes, dtype=dtype or EMBEDDING_DTYPE)
+
+@timed("db_insert_reference_image")
+def insert_reference_image(filename, embedding, model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
     """
     Inserts or updates a reference image embedding into the database.
     
     Args:
         filename (str): The filename (or identifier) of the reference image.
         embedding (list or np.array): The face embedding vector.
+        model_name (str): Name of the model that produced the embedding.
+        alignment (str): Alignment the face was embedded with ("legacy" or "roi").
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    if hasattr(embedding, 'tolist'):
-        embedding = embedding.tolist()
-    embedding_json = json.dumps(embedding)
     try:
-        cursor.execute('''
-            INSERT OR REPLACE INTO reference_images (filename, embedding)
-            VALUES (?, ?)
-        ''', (filename, embedding_json))
-        conn.commit()
+        _insert_reference_images([(filename, embedding)], model_name, alignment)
     except Exception as e:
         print(f"Error inserting reference image {filename}: {e}")
-    finally:
-        conn.close()
 
-def get_all_reference_embeddings():
+@timed("db_insert_reference_images")
+def insert_reference_images(references, model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
     """
-    Retrieves all reference embeddings from the database.
+    Inserts or updates several reference image embeddings in one transaction.
+
+    Args:
+        references (list): (filename, embedding) tuples.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with ("legacy" or "roi").
+    """
+    try:
+        _insert_reference_images(references, model_name, alignment)
+    except Exception as e:
+        print(f"Error inserting {len(references)} reference images: {e}")
+
+def _insert_reference_images(references, model_name, alignment):
+    conn = get_connection()
+    rows = []
+    for filename, embedding in references:
+        embedding_bytes, dim = _encode_embedding(embedding)
+        rows.append((filename, model_name, alignment, embedding_bytes, dim, EMBEDDING_DTYPE, EMBEDDING_PIPELINE))
+    try:
+        conn.executemany('''
+            INSERT OR REPLACE INTO reference_images (filename, model_name, alignment, embedding, dim, dtype, pipeline)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+@timed("db_get_all_reference_embeddings")
+def get_all_reference_embeddings(model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT, filenames=None):
+    """
+    Retrieves all reference embeddings produced by a model from the database.
     
+    Args:
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+        filenames (list): If given, only retrieve the embeddings of these reference images.
+
     Returns:
         dict: A dictionary where keys are filenames and values are the embedding vectors.
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT filename, embedding FROM reference_images')
-    rows = cursor.fetchall()
+    if filenames is None:
+        cursor.execute('SELECT filename, embedding, dtype FROM reference_images WHERE model_name = ? AND alignment = ?',
+                       (model_name, alignment))
+        rows = cursor.fetchall()
+    else:
+        rows = []
+        filenames = list(filenames)
+        for start in range(0, len(filenames), _MAX_PARAMS):
+            chunk = filenames[start:start + _MAX_PARAMS]
+            cursor.execute(f'''
+                SELECT filename, embedding, dtype FROM reference_images
+                WHERE model_name = ? AND alignment = ? AND filename IN ({",".join("?" * len(chunk))})
+            ''', [model_name, alignment] + chunk)
+            rows.extend(cursor.fetchall())
     reference_embeddings = {}
-    for filename, embedding_json in rows:
+    for filename, embedding_bytes, dtype in rows:
         try:
-            embedding = json.loads(embedding_json)
-            reference_embeddings[filename] = embedding
+            reference_embeddings[filename] = _decode_embedding(embedding_bytes, dtype)
         except Exception as e:
             print(f"Error parsing embedding for {filename}: {e}")
-    conn.close()
     return reference_embeddings
 
-def get_all_group_embeddings():
+def get_all_group_embeddings(model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
     """
-    Retrieves all group image embeddings from the database.
+    Retrieves the embeddings produced by a model for every face of every group image.
     
+    Args:
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+
     Returns:
-        dict: A dictionary where keys are filenames and values are embedding vectors.
+        dict: A dictionary where keys are (filename, face index) tuples and values are embedding vectors.
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT filename, embedding FROM group_images")
+    cursor.execute('''
+        SELECT g.filename, f.face_index, e.embedding, e.dtype
+        FROM face_embeddings e
+        JOIN group_faces f ON f.id = e.face_id
+        JOIN group_images g ON g.id = f.image_id
+        WHERE e.model_name = ? AND e.alignment = ?
+        ORDER BY e.rowid
+    ''', (model_name, alignment))
     rows = cursor.fetchall()
-    conn.close()
 
     group_embeddings = {}
-    for filename, embedding_json in rows:
+    for filename, face_index, embedding_bytes, dtype in rows:
         try:
-            embedding = np.array(json.loads(embedding_json))  # Convert to NumPy array
-            group_embeddings[filename] = embedding
+            group_embeddings[(filename, face_index)] = _decode_embedding(embedding_bytes, dtype)
         except Exception as e:
             print(f"Error parsing embedding for {filename}: {e}")
 
     return group_embeddings
 
-def insert_group_image(filename, embedding):
+@timed("db_get_group_embedding_rows")
+def get_group_embedding_rows(model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
+    """
+    Retrieves a model's group face embeddings in insertion order, for rebuilding its gallery matrix.
+
+    Args:
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        tuple: (ids, filenames, embeddings, generation) where ids are group_faces ids, filenames are
+               the filenames of the images the faces belong to, embeddings is an (N, D) float32 array
+               and generation is the gallery generation the rows belong to.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT f.id, g.filename, e.embedding, e.dtype
+        FROM face_embeddings e
+        JOIN group_faces f ON f.id = e.face_id
+        JOIN group_images g ON g.id = f.image_id
+        WHERE e.model_name = ? AND e.alignment = ?
+        ORDER BY e.rowid
+    ''', (model_name, alignment))
+    rows = cursor.fetchall()
+    generation = _get_gallery_generation(cursor, model_name, alignment)
+
+    ids, filenames, embeddings = [], [], []
+    for row_id, filename, embedding_bytes, dtype in rows:
+        try:
+            embeddings.append(_decode_embedding(embedding_bytes, dtype))
+            ids.append(row_id)
+            filenames.append(filename)
+        except Exception as e:
+            print(f"Error parsing embedding for {filename}: {e}")
+
+    matrix = np.stack(embeddings).astype(np.float32) if embeddings else np.empty((0, 0), dtype=np.float32)
+    return ids, filenames, matrix, generation
+
+def get_gallery_state(model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
     """
-    Inserts a group image record into the database.
+    Retrieves the current generation of a model's gallery and its number of group face embeddings.
+
+    Args:
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        tuple: (generation, count).
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    generation = _get_gallery_generation(cursor, model_name, alignment)
+    count = cursor.execute("SELECT COUNT(*) FROM face_embeddings WHERE model_name = ? AND alignment = ?",
+                           (model_name, alignment)).fetchone()[0]
+    return generation, count
+
+def count_stale_embeddings(model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
+    """
+    Counts a model's embeddings of another embedding pipeline, which are still searched until they
+    are re-embedded.
+
+    Args:
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        tuple: (group faces, reference images) with an embedding of another pipeline.
+    """
+    cursor = get_connection().cursor()
+    return tuple(cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE model_name = ? AND alignment = ? AND pipeline != ?",
+                                (model_name, alignment, EMBEDDING_PIPELINE)).fetchone()[0]
+                 for table in ("face_embeddings", "reference_images"))
+
+def _generation_key(model_name, alignment):
+    return f"generation:{model_name}/{alignment}"
+
+def _get_gallery_generation(cursor, model_name, alignment):
+    row = cursor.execute("SELECT value FROM gallery_state WHERE key = ?",
+                         (_generation_key(model_name, alignment),)).fetchone()
+    return row[0] if row else 0
+
+def _bump_gallery_generation(cursor, model_name, alignment, changes=1):
+    cursor.execute('''
+        INSERT INTO gallery_state (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = value + excluded.value
+    ''', (_generation_key(model_name, alignment), changes))
+    return _get_gallery_generation(cursor, model_name, alignment)
+
+def _bump_gallery_generations(cursor, model_name, alignment, replaced):
+    """
+    Bumps the generations after group images were added, returning the new generation of the
+    given model's gallery.
+
+    Replacing an image removes its rows from every gallery, which an append cannot express:
+    it counts as two changes so those gallery matrices are rebuilt instead of appended to.
+    """
+    if replaced:
+        cursor.execute("UPDATE gallery_state SET value = value + 2 WHERE key LIKE 'generation:%' AND key != ?",
+                       (_generation_key(model_name, alignment),))
+    return _bump_gallery_generation(cursor, model_name, alignment, 2 if replaced else 1)
+
+@timed("db_insert_group_image")
+def insert_group_image(filename, faces, content_hash=None, model_name=DEFAULT_MODEL_NAME,
+                       alignment=DEFAULT_ALIGNMENT, detector=None):
+    """
+    Inserts a group image record, all of its detected faces and their embeddings into the database.
     
     Args:
         filename (str): The filename (or identifier) of the group image.
+        faces (list): One dict per face with 'box', 'confidence', 'keypoints' (as returned by
+                      detect_faces) and 'embedding' (the face embedding vector).
+        content_hash (str): Hash of the file contents, if known.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with ("legacy" or "roi").
+        detector (str): Version of the detector that found the faces (see face_detector.detector_version).
+
+    Returns:
+        tuple or None: (face ids, generation of the model's gallery after the insert), or None if
+                       the insert failed.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        face_ids, replaced = _insert_group_images(cursor, [(filename, faces, content_hash, detector)])
+        _insert_face_embeddings(cursor, [(face_ids[0], [face['embedding'] for face in faces])], model_name, alignment)
+        generation = _bump_gallery_generations(cursor, model_name, alignment, replaced)
+        conn.commit()
+        return face_ids[0], generation
+    except Exception as e:
+        conn.rollback()
+        print(f"Error inserting group image {filename}: {e}")
+        return None
+
+@timed("db_insert_video")
+def insert_video(filename, tracks, content_hash=None, model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT,
+                 detector=None):
+    """
+    Inserts a video as a group image whose faces are its face tracks, with their embeddings and time ranges.
+
+    Args:
+        filename (str): The filename (or identifier) of the video.
+        tracks (list): One face dict per track, as described in insert_group_image (the face being the
+                       track's best detection and the embedding its track embedding), with the added
+                       'start_ms', 'end_ms', 'detections' and 'samples' (number of embedded detections).
+        content_hash (str): Hash of the file contents, if known.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+        detector (str): Version of the detector that found the faces.
+
+    Returns:
+        tuple or None: (face ids, generation of the model's gallery after the insert), or None if
+                       the insert failed.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        face_ids, replaced = _insert_group_images(cursor, [(filename, tracks, content_hash, detector)])
+        _insert_face_embeddings(cursor, [(face_ids[0], [track['embedding'] for track in tracks])], model_name, alignment)
+        cursor.executemany("INSERT INTO video_tracks (face_id, start_ms, end_ms, detections, samples) VALUES (?, ?, ?, ?, ?)",
+                           [(face_id, int(track['start_ms']), int(track['end_ms']), int(track['detections']),
+                             int(track['samples'])) for face_id, track in zip(face_ids[0], tracks)])
+        generation = _bump_gallery_generations(cursor, model_name, alignment, replaced)
+        conn.commit()
+        return face_ids[0], generation
+    except Exception as e:
+        conn.rollback()
+        print(f"Error inserting video {filename}: {e}")
+        return None
+
+def get_video_tracks(face_ids):
+    """
+    Retrieves the time ranges of the given group faces that are video face tracks.
+
+    Args:
+        face_ids (list): group_faces ids.
+
+    Returns:
+        dict: Face id -> (start_ms, end_ms), for the faces that are video tracks.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    tracks = {}
+    face_ids = list(face_ids)
+    for start in range(0, len(face_ids), _MAX_PARAMS):
+        chunk = face_ids[start:start + _MAX_PARAMS]
+        cursor.execute(f"SELECT face_id, start_ms, end_ms FROM video_tracks WHERE face_id IN ({','.join('?' * len(chunk))})",
+                       chunk)
+        tracks.update((face_id, (start_ms, end_ms)) for face_id, start_ms, end_ms in cursor.fetchall())
+    return tracks
+
+@timed("db_add_face_embeddings")
+def add_face_embeddings(face_ids, embeddings, model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
+    """
+    Stores the embeddings a model produced for group faces that are already in the database.
+
+    Args:
+        face_ids (list): The group_faces ids.
+        embeddings (np.array): (N, D) embeddings, in the order of face_ids.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        int or None: The generation of the model's gallery after the insert, or None if it failed.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        # Embeddings of an older pipeline replaced in place are still in the gallery matrix, which
+        # an append cannot express: it counts as two changes so the matrix is rebuilt
+        upgraded = _has_face_embeddings(cursor, face_ids, model_name, alignment)
+        _insert_face_embeddings(cursor, [(face_ids, embeddings)], model_name, alignment)
+        generation = _bump_gallery_generation(cursor, model_name, alignment, 2 if upgraded else 1)
+        conn.commit()
+        return generation
+    except Exception as e:
+        conn.rollback()
+        print(f"Error inserting face embeddings: {e}")
+        return None
+
+def _insert_group_images(cursor, images):
+    """
+    Inserts group images and their detected faces with executemany, replacing images already stored
+    (together with the embeddings of their faces).
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the open connection; the caller commits.
+        images (list): (filename, faces, content_hash, detector) tuples with distinct filenames, where
+                       faces are as described in insert_group_image.
+
+    Returns:
+        tuple: (face_ids, replaced) where face_ids holds one list of group_faces ids per image and
+               replaced is True if any of the images was already stored.
+    """
+    filenames = [filename for filename, _, _, _ in images]
+    existing = _select_by_filename(cursor, "SELECT id FROM group_images WHERE filename IN ({})", filenames)
+    if existing:
+        cursor.executemany("DELETE FROM face_embeddings WHERE face_id IN (SELECT id FROM group_faces WHERE image_id = ?)",
+                           existing)
+        cursor.executemany("DELETE FROM face_clusters WHERE face_id IN (SELECT id FROM group_faces WHERE image_id = ?)",
+                           existing)
+        cursor.execute("UPDATE cluster_state SET stale = 1")
+        cursor.executemany("DELETE FROM face_identities WHERE face_id IN (SELECT id FROM group_faces WHERE image_id = ?)",
+                           existing)
+        cursor.executemany("DELETE FROM video_tracks WHERE face_id IN (SELECT id FROM group_faces WHERE image_id = ?)",
+                           existing)
+        cursor.executemany("DELETE FROM group_faces WHERE image_id = ?", existing)
+        cursor.executemany("DELETE FROM group_images WHERE id = ?", existing)
+
+    cursor.executemany("INSERT INTO group_images (filename, content_hash) VALUES (?, ?)",
+                       [(filename, content_hash) for filename, _, content_hash, _ in images])
+    image_ids = dict(_select_by_filename(cursor, "SELECT filename, id FROM group_images WHERE filename IN ({})",
+                                         filenames))
+
+    face_rows = []
+    for filename, faces, _, detector in images:
+        for face_index, face in enumerate(faces):
+            x, y, w, h = (int(v) for v in face['box'])
+            keypoints = {name: [int(v) for v in point] for name, point in face.get('keypoints', {}).items()}
+            face_rows.append((image_ids[filename], face_index, x, y, w, h, float(face.get('confidence', 0.0)),
+                              json.dumps(keypoints), detector))
+    cursor.executemany('''
+        INSERT INTO group_faces (image_id, face_index, box_x, box_y, box_w, box_h, confidence, keypoints, detector)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', face_rows)
+
+    # executemany does not report row ids, so read them back through the (image_id, face_index) key
+    face_ids = {}
+    ids = list(image_ids.values())
+    for start in range(0, len(ids), _MAX_PARAMS):
+        chunk = ids[start:start + _MAX_PARAMS]
+        cursor.execute(f"SELECT id, image_id, face_index FROM group_faces "
+                       f"WHERE image_id IN ({','.join('?' * len(chunk))})", chunk)
+        for face_id, image_id, face_index in cursor.fetchall():
+            face_ids[(image_id, face_index)] = face_id
+
+    face_ids = [[face_ids[(image_ids[filename], i)] for i in range(len(faces))] for filename, faces, _, _ in images]
+    return face_ids, bool(existing)
+
+def _insert_face_embeddings(cursor, batches, model_name, alignment):
+    """
+    Inserts face embeddings with executemany, in batch order.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the open connection; the caller commits.
+        batches (list): (face_ids, embeddings) tuples.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+    """
+    rows = []
+    for face_ids, embeddings in batches:
+        for face_id, embedding in zip(face_ids, embeddings):
+            embedding_bytes, dim = _encode_embedding(embedding)
+            rows.append((face_id, model_name, alignment, embedding_bytes, dim, EMBEDDING_DTYPE, EMBEDDING_PIPELINE))
+    # Replaces the embedding of another pipeline a face may still have
+    cursor.executemany('''
+        INSERT OR REPLACE INTO face_embeddings (face_id, model_name, alignment, embedding, dim, dtype, pipeline)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+def _has_face_embeddings(cursor, face_ids, model_name, alignment):
+    """Returns True if any of the group faces already has an embedding for the model (of any pipeline)."""
+    face_ids = list(face_ids)
+    for start in range(0, len(face_ids), _MAX_PARAMS):
+        chunk = face_ids[start:start + _MAX_PARAMS]
+        cursor.execute(f"SELECT 1 FROM face_embeddings WHERE model_name = ? AND alignment = ? "
+                       f"AND face_id IN ({','.join('?' * len(chunk))}) LIMIT 1", [model_name, alignment] + chunk)
+        if cursor.fetchone():
+            return True
+    return False
+
+def _select_by_filename(cursor, query, filenames):
+    """Runs a query with a `filename IN ({})` placeholder over filenames in parameter-limited chunks."""
+    rows = []
+    for start in range(0, len(filenames), _MAX_PARAMS):
+        chunk = filenames[start:start + _MAX_PARAMS]
+        cursor.execute(query.format(",".join("?" * len(chunk))), chunk)
+        rows.extend(cursor.fetchall())
+    return rows
+
+class BulkWriter:
+    """
+    Buffers group image, face embedding and manifest inserts and writes them in periodic transactions.
+
+    Pending rows are written with executemany once `batch_size` images are buffered or
+    `flush_interval` seconds have passed since the last write, and when the `with` block exits.
+    Every flush is a single transaction that bumps the gallery generation once, instead of one
+    commit per row.
+
+    Args:
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+        batch_size (int): Number of buffered group images that triggers a flush.
+        flush_interval (float): Seconds after which buffered rows are flushed on the next add.
+        on_flush (callable): Called after each committed flush with (images, generation), where
+                             images are (filename, face_ids, embeddings) tuples in gallery row order
+                             and generation is the model's gallery generation after the flush.
+
+    Example:
+        with BulkWriter("Facenet", "legacy", on_flush=append_faces) as writer:
+            writer.add_group_image(filename, faces, content_hash)
+            writer.add_manifest_entries([file])
+    """
+
+    def __init__(self, model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT, batch_size=256,
+                 flush_interval=2.0, on_flush=None):
+        self.model_name = model_name
+        self.alignment = alignment
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self._images = {}
+        self._embeddings = []
+        self._manifest = []
+        self._failed = False
+        self._last_flush = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add_group_image(self, filename, faces, content_hash=None, detector=None):
+        """
+        Buffers a group image with its faces and their embeddings (see insert_group_image).
+        A later add for the same filename replaces the buffered one.
+        """
+        self._images.pop(filename, None)
+        self._images[filename] = (faces, content_hash, detector)
+        self._maybe_flush()
+
+    def add_face_embeddings(self, filename, face_ids, embeddings):
+        """Buffers embeddings for stored faces of a group image (see add_face_embeddings)."""
+        self._embeddings.append((filename, list(face_ids), np.asarray(embeddings, dtype=np.float32)))
+        self._maybe_flush()
+
+    def add_manifest_entries(self, entries):
+        """
+        Buffers manifest entries (see record_manifest_entries). They are committed in the same
+        transaction as the group images buffered before them.
+        """
+        self._manifest.extend(entries)
+        self._maybe_flush()
+
+    @timed("db_bulk_flush")
+    def flush(self):
+        """
+        Writes every buffered row in one transaction.
+
+        The buffers are only cleared once the transaction is committed. After a failed flush the
+        rows stay buffered and are written again with the next flush, which an add only triggers
+        once `flush_interval` has passed, so a persistent error is not retried on every add.
+
+        Returns:
+            bool: True if the buffered rows were committed (or there were none), False if the
+                  transaction failed and was rolled back.
+        """
+        images = [(filename, faces, content_hash, detector)
+                  for filename, (faces, content_hash, detector) in self._images.items()]
+        embeddings, manifest = self._embeddings, self._manifest
+        self._last_flush = time.perf_counter()
+        if not images and not embeddings and not manifest:
+            return True
+
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            stored = []
+            replaced = False
+            if images:
+                face_ids, replaced = _insert_group_images(cursor, images)
+                stored = [(filename, ids, np.array([face['embedding'] for face in faces], dtype=np.float32))
+                          for (filename, faces, _, _), ids in zip(images, face_ids)]
+            stored += embeddings
+            generation = None
+            if stored:
+                # Embeddings of an older pipeline replaced in place count as replaced rows of this gallery
+                upgraded = _has_face_embeddings(cursor, [face_id for _, ids, _ in embeddings for face_id in ids],
+                                                self.model_name, self.alignment)
+                _insert_face_embeddings(cursor, [(ids, vectors) for _, ids, vectors in stored],
+                                        self.model_name, self.alignment)
+                generation = _bump_gallery_generations(cursor, self.model_name, self.alignment, replaced)
+                if upgraded and not replaced:
+                    generation = _bump_gallery_generation(cursor, self.model_name, self.alignment)
+            _insert_manifest_entries(cursor, manifest)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error writing {len(images)} group images, {len(embeddings)} embedding batches "
+                  f"and {len(manifest)} manifest entries: {e}")
+            self._failed = True
+            return False
+
+        self._images, self._embeddings, self._manifest = {}, [], []
+        self._failed = False
+        if stored and self.on_flush:
+            self.on_flush(stored, generation)
+        return True
+
+    def _maybe_flush(self):
+        if ((not self._failed and len(self._images) + len(self._embeddings) >= self.batch_size)
+                or time.perf_counter() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+@timed("db_get_faces_missing_embeddings")
+def get_faces_missing_embeddings(model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT, filename=None):
+    """
+    Retrieves the cached detections of group faces that have no embedding for a model yet, or only
+    one of another embedding pipeline, so they can be embedded without detecting the faces again.
+
+    Every face carries the version of the detector that found it, so that callers can detect the
+    faces again when it is not the current one. Faces stored without a box (migrated from the single
+    per-image embedding of older versions) cannot be aligned from the cache: they are returned with
+    a None box and detector, so their images are always detected again.
+
+    Args:
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces are embedded with.
+        filename (str): If given, only look at the faces of this group image.
+
+    Returns:
+        dict: Group image filename -> list of face dicts with 'id', 'face_index', 'box', 'confidence',
+              'keypoints' and 'detector' (None for faces stored before it was recorded), ordered by
+              face index.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT g.filename, f.id, f.face_index, f.box_x, f.box_y, f.box_w, f.box_h, f.confidence, f.keypoints,
+               f.detector
+        FROM group_faces f JOIN group_images g ON g.id = f.image_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM face_embeddings e
+            WHERE e.face_id = f.id AND e.model_name = ? AND e.alignment = ? AND e.pipeline = ?
+        ) {"AND g.filename = ?" if filename is not None else ""}
+        ORDER BY f.image_id, f.face_index
+    ''', (model_name, alignment, EMBEDDING_PIPELINE) + ((filename,) if filename is not None else ()))
+    missing = {}
+    for filename, face_id, face_index, x, y, w, h, confidence, keypoints, detector in cursor.fetchall():
+        missing.setdefault(filename, []).append({
+            'id': face_id,
+            'face_index': face_index,
+            'box': [x, y, w, h] if x is not None else None,
+            'confidence': confidence,
+            'keypoints': json.loads(keypoints) if keypoints else {},
+            'detector': detector,
+        })
+    return missing
+
+@timed("db_get_group_faces")
+def get_group_faces(face_ids):
+    """
+    Retrieves the image filename and detection details of the given group faces.
+
+    Args:
+        face_ids (list): group_faces ids.
+
+    Returns:
+        dict: Face id -> dict with 'filename', 'face_index', 'box', 'confidence' and 'keypoints'.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    faces = {}
+    face_ids = list(face_ids)
+    for start in range(0, len(face_ids), _MAX_PARAMS):
+        chunk = face_ids[start:start + _MAX_PARAMS]
+        cursor.execute(f'''
+            SELECT f.id, g.filename, f.face_index, f.box_x, f.box_y, f.box_w, f.box_h, f.confidence, f.keypoints
+            FROM group_faces f JOIN group_images g ON g.id = f.image_id
+            WHERE f.id IN ({",".join("?" * len(chunk))})
+        ''', chunk)
+        for face_id, filename, face_index, x, y, w, h, confidence, keypoints in cursor.fetchall():
+            faces[face_id] = {
+                'filename': filename,
+                'face_index': face_index,
+                'box': [x, y, w, h] if x is not None else None,
+                'confidence': confidence,
+                'keypoints': json.loads(keypoints) if keypoints else {},
+            }
+    return faces
+
+def get_face_clusters(model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
+    """
+    Retrieves the clusters of a model's group faces and the parameters they were computed with.
+
+    Args:
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        tuple: (labels, state) where labels maps face id -> cluster id, and state is a dict with
+               'metric', 'threshold' and 'stale', or None if the faces were never clustered.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    row = cursor.execute("SELECT metric, threshold, stale FROM cluster_state WHERE model_name = ? AND alignment = ?",
+                         (model_name, alignment)).fetchone()
+    state = {'metric': row[0], 'threshold': row[1], 'stale': bool(row[2])} if row else None
+    cursor.execute("SELECT face_id, cluster_id FROM face_clusters WHERE model_name = ? AND alignment = ?",
+                   (model_name, alignment))
+    return dict(cursor.fetchall()), state
+
+@timed("db_save_face_clusters")
+def save_face_clusters(face_ids, cluster_ids, metric, threshold, model_name=DEFAULT_MODEL_NAME,
+                       alignment=DEFAULT_ALIGNMENT, replace=False):
+    """
+    Stores the clusters of group faces, in one transaction.
+
+    Args:
+        face_ids (list): group_faces ids.
+        cluster_ids (list): Cluster id of each face.
+        metric (str): Similarity metric the faces were clustered with.
+        threshold (float): Similarity threshold the faces were clustered with.
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+        replace (bool): If True, the clusters of the model's other faces are removed first.
+
+    Returns:
+        bool: True if the clusters were stored.
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
-    if hasattr(embedding, 'tolist'):
-        embedding = embedding.tolist()
-    embedding_json = json.dumps(embedding)
     try:
+        if replace:
+            cursor.execute("DELETE FROM face_clusters WHERE model_name = ? AND alignment = ?", (model_name, alignment))
+        cursor.executemany('''
+            INSERT INTO face_clusters (face_id, model_name, alignment, cluster_id) VALUES (?, ?, ?, ?)
+            ON CONFLICT(face_id, model_name, alignment) DO UPDATE SET cluster_id = excluded.cluster_id
+        ''', ((int(face_id), model_name, alignment, int(cluster_id)) for face_id, cluster_id in zip(face_ids, cluster_ids)))
         cursor.execute('''
-            INSERT OR REPLACE INTO group_images (filename, embedding)
-            VALUES (?, ?)
-        ''', (filename, embedding_json))
+            INSERT INTO cluster_state (model_name, alignment, metric, threshold, stale) VALUES (?, ?, ?, ?, 0)
+            ON CONFLICT(model_name, alignment) DO UPDATE SET metric = excluded.metric,
+                threshold = excluded.threshold, stale = 0
+        ''', (model_name, alignment, metric, float(threshold)))
         conn.commit()
+        return True
     except Exception as e:
-        print(f"Error inserting reference image {filename}: {e}")
-    finally:
-        conn.close()
+        conn.rollback()
+        print(f"Error saving face clusters: {e}")
+        return False
+
+def add_identity_references(name, filenames):
+    """
+    Registers reference images as photos of an identity, creating the identity if needed.
+
+    Args:
+        name (str): Name of the identity.
+        filenames (list): Filenames the reference images are stored under in reference_images.
+
+    Returns:
+        int or None: The identity id, or None if the references could not be stored.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("INSERT OR IGNORE INTO identities (name) VALUES (?)", (name,))
+        identity_id = cursor.execute("SELECT id FROM identities WHERE name = ?", (name,)).fetchone()[0]
+        cursor.executemany("INSERT OR IGNORE INTO identity_references (identity_id, filename) VALUES (?, ?)",
+                           [(identity_id, filename) for filename in filenames])
+        conn.commit()
+        return identity_id
+    except Exception as e:
+        conn.rollback()
+        print(f"Error storing the references of identity '{name}': {e}")
+        return None
+
+def get_identity_references(model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
+    """
+    Retrieves the reference embeddings of every identity for a model.
+
+    Args:
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        dict: Identity id -> (name, list of embeddings), for the references embedded with the model.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT i.id, i.name, r.embedding, r.dtype
+        FROM identities i
+        JOIN identity_references m ON m.identity_id = i.id
+        JOIN reference_images r ON r.filename = m.filename AND r.model_name = ? AND r.alignment = ?
+        ORDER BY i.id, m.filename
+    ''', (model_name, alignment))
+    identities = {}
+    for identity_id, name, embedding_bytes, dtype in cursor.fetchall():
+        try:
+            identities.setdefault(identity_id, (name, []))[1].append(_decode_embedding(embedding_bytes, dtype))
+        except Exception as e:
+            print(f"Error parsing a reference embedding of identity '{name}': {e}")
+    return identities
+
+def get_identity_templates(model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
+    """
+    Retrieves the identity templates of a model.
+
+    Args:
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        tuple: (identity_ids, templates, names) where templates is a (T, D) float32 array, identity_ids
+               the identity of each template and names maps identity id -> name.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT t.identity_id, i.name, t.embedding, t.dtype
+        FROM identity_templates t JOIN identities i ON i.id = t.identity_id
+        WHERE t.model_name = ? AND t.alignment = ?
+        ORDER BY t.identity_id, t.template_index
+    ''', (model_name, alignment))
+    identity_ids, templates, names = [], [], {}
+    for identity_id, name, embedding_bytes, dtype in cursor.fetchall():
+        identity_ids.append(identity_id)
+        templates.append(_decode_embedding(embedding_bytes, dtype))
+        names[identity_id] = name
+    templates = np.stack(templates).astype(np.float32) if templates else np.empty((0, 0), dtype=np.float32)
+    return np.array(identity_ids, dtype=np.int64), templates, names
+
+@timed("db_save_identity_templates")
+def save_identity_templates(templates, model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
+    """
+    Replaces the identity templates of a model, which invalidates the face labels computed from them.
+
+    Args:
+        templates (dict): Identity id -> (T, D) templates.
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        bool: True if the templates were stored.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM identity_templates WHERE model_name = ? AND alignment = ?", (model_name, alignment))
+        rows = []
+        for identity_id, identity_templates in templates.items():
+            for template_index, template in enumerate(identity_templates):
+                embedding_bytes, dim = _encode_embedding(template)
+                rows.append((int(identity_id), model_name, alignment, template_index, embedding_bytes, dim,
+                             EMBEDDING_DTYPE))
+        cursor.executemany('''
+            INSERT INTO identity_templates (identity_id, model_name, alignment, template_index, embedding, dim, dtype)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        cursor.execute('''
+            INSERT INTO identity_state (model_name, alignment, version) VALUES (?, ?, 1)
+            ON CONFLICT(model_name, alignment) DO UPDATE SET version = version + 1
+        ''', (model_name, alignment))
+        conn.commit()
+        return True
+    except Exception as e:
+        conn.rollback()
+        print(f"Error saving identity templates: {e}")
+        return False
+
+def get_face_identities(model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
+    """
+    Retrieves which group faces of a model are labelled, and the state of the templates and labels.
+
+    Args:
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        tuple: (labelled, state) where labelled is the set of labelled face ids, and state is a dict with
+               'version' (of the templates), 'labels_version' (templates the labels were computed with)
+               and 'metric', or None if the model has no templates.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    row = cursor.execute("SELECT version, labels_version, metric FROM identity_state WHERE model_name = ? AND alignment = ?",
+                         (model_name, alignment)).fetchone()
+    state = {'version': row[0], 'labels_version': row[1], 'metric': row[2]} if row else None
+    cursor.execute("SELECT face_id FROM face_identities WHERE model_name = ? AND alignment = ?", (model_name, alignment))
+    return {face_id for face_id, in cursor.fetchall()}, state
+
+@timed("db_save_face_identities")
+def save_face_identities(face_ids, identity_ids, scores, metric, version, model_name=DEFAULT_MODEL_NAME,
+                         alignment=DEFAULT_ALIGNMENT, replace=False):
+    """
+    Stores the best-matching identity of group faces and its score, in one transaction.
+
+    Args:
+        face_ids (list): group_faces ids.
+        identity_ids (list): Best-matching identity of each face.
+        scores (list): Score of each face against its identity.
+        metric (str): Similarity metric of the scores.
+        version (int): Version of the templates the faces were scored against.
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+        replace (bool): If True, the labels of the model's other faces are removed first.
+
+    Returns:
+        bool: True if the labels were stored.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        if replace:
+            cursor.execute("DELETE FROM face_identities WHERE model_name = ? AND alignment = ?", (model_name, alignment))
+        cursor.executemany('''
+            INSERT INTO face_identities (face_id, model_name, alignment, identity_id, score) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(face_id, model_name, alignment) DO UPDATE SET identity_id = excluded.identity_id,
+                score = excluded.score
+        ''', ((int(face_id), model_name, alignment, int(identity_id), float(score))
+              for face_id, identity_id, score in zip(face_ids, identity_ids, scores)))
+        cursor.execute("UPDATE identity_state SET labels_version = ?, metric = ? WHERE model_name = ? AND alignment = ?",
+                       (int(version), metric, model_name, alignment))
+        conn.commit()
+        return True
+    except Exception as e:
+        conn.rollback()
+        print(f"Error saving face identities: {e}")
+        return False
+
+def get_identity_faces(name, threshold, metric="cosine", model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
+    """
+    Looks up the group faces labelled with an identity, through the index on the labels.
+
+    Args:
+        name (str): Name of the identity.
+        threshold (float): Threshold a face's score must pass (see search_in_group_images).
+        metric (str): Similarity metric of the stored scores ("cosine" or "euclidean").
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        list: (group image filename, face id, face box, score) tuples, best first.
+    """
+    passes, order = (">=", "DESC") if metric == "cosine" else ("<=", "ASC")
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT g.filename, f.id, f.box_x, f.box_y, f.box_w, f.box_h, l.score
+        FROM identities i
+        JOIN face_identities l ON l.identity_id = i.id AND l.model_name = ? AND l.alignment = ?
+        JOIN group_faces f ON f.id = l.face_id
+        JOIN group_images g ON g.id = f.image_id
+        WHERE i.name = ? AND l.score {passes} ?
+        ORDER BY l.score {order}
+    ''', (model_name, alignment, name, float(threshold)))
+    return [(filename, face_id, [x, y, w, h] if x is not None else None, score)
+            for filename, face_id, x, y, w, h, score in cursor.fetchall()]
+
+def count_identity_faces(threshold, metric="cosine", model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
+    """
+    Counts the labelled group faces of every identity that pass a threshold.
+
+    Args:
+        threshold (float): Threshold a face's score must pass.
+        metric (str): Similarity metric of the stored scores ("cosine" or "euclidean").
+        model_name (str): Name of the model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        dict: Identity name -> number of faces.
+    """
+    passes = ">=" if metric == "cosine" else "<="
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT i.name, COUNT(*)
+        FROM face_identities l JOIN identities i ON i.id = l.identity_id
+        WHERE l.model_name = ? AND l.alignment = ? AND l.score {passes} ?
+        GROUP BY l.identity_id
+    ''', (model_name, alignment, float(threshold)))
+    return dict(cursor.fetchall())
+
+def get_manifest_entries():
+    """
+    Retrieves the ingestion manifest.
+
+    Returns:
+        dict: Path (absolute, '/'-separated; relative to the ingested folder for entries recorded by
+              older versions) -> (size, mtime_ns, content_hash).
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT path, size, mtime_ns, content_hash FROM ingest_manifest")
+    manifest = {path: (size, mtime_ns, content_hash) for path, size, mtime_ns, content_hash in cursor.fetchall()}
+    return manifest
+
+def record_manifest_entries(entries):
+    """
+    Records files as ingested in the manifest, replacing earlier entries for the same paths.
+
+    Args:
+        entries (list): Dicts with 'path', 'content_hash', 'size' and 'mtime_ns'.
+    """
+    if not entries:
+        return
+    conn = get_connection()
+    try:
+        _insert_manifest_entries(conn.cursor(), entries)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Error updating the ingestion manifest: {e}")
+
+def get_group_image_hashes(filenames):
+    """
+    Retrieves the content hashes the given group images were stored with.
+
+    Args:
+        filenames (list): The filenames to look up.
+
+    Returns:
+        dict: Filename -> content hash (None for images stored without one), for the stored images.
+    """
+    cursor = get_connection().cursor()
+    return dict(_select_by_filename(cursor, "SELECT filename, content_hash FROM group_images WHERE filename IN ({})",
+                                    list(filenames)))
+
+def rename_group_images(renames):
+    """
+    Moves group images and their manifest entries to new filenames, e.g. from the paths relative
+    to the ingested folder stored by older versions to absolute paths.
+
+    Images whose new filename is already stored keep their old one. Every gallery generation is
+    bumped, since gallery matrices and shards hold the filenames of their rows.
+
+    Args:
+        renames (dict): Old filename -> new filename.
+
+    Returns:
+        bool: True if the images were renamed.
+    """
+    if not renames:
+        return True
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        pairs = [(new, old) for old, new in renames.items()]
+        cursor.executemany("UPDATE OR IGNORE group_images SET filename = ? WHERE filename = ?", pairs)
+        cursor.executemany("UPDATE OR REPLACE ingest_manifest SET path = ? WHERE path = ?", pairs)
+        cursor.execute("UPDATE gallery_state SET value = value + 2 WHERE key LIKE 'generation:%'")
+        conn.commit()
+        return True
+    except Exception as e:
+        conn.rollback()
+        print(f"Error renaming {len(renames)} group images: {e}")
+        return False
+
+def _insert_manifest_entries(cursor, entries):
+    cursor.executemany('''
+        INSERT OR REPLACE INTO ingest_manifest (path, content_hash, size, mtime_ns)
+        VALUES (?, ?, ?, ?)
+    ''', [(e['path'], e['content_hash'], e['size'], e['mtime_ns']) for e in entries])
 
 def is_image_in_db(table, filename):
     """
@@ -126,38 +1388,74 @@ def is_image_in_db(table, filename):
     Returns:
         bool: True if the image exists, False otherwise.
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE filename = ?", (filename,))
     exists = cursor.fetchone()[0] > 0
-    conn.close()
     return exists
 
-def get_reference_embedding(image_path):
+def is_reference_image_in_db(filename, model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
     """
-    Retrieves the embedding of a specific reference image from the database.
+    Checks if a reference image has an embedding for the given model, of the current embedding
+    pipeline: one of an older pipeline is still searched, but re-embedded when the image is added again.
+
+    Args:
+        filename (str): The filename to check.
+        model_name (str): Name of the model.
+        alignment (str): Alignment the face was embedded with.
+
+    Returns:
+        bool: True if the embedding exists, False otherwise.
+    """
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT COUNT(*) FROM reference_images "
+                   "WHERE filename = ? AND model_name = ? AND alignment = ? AND pipeline = ?",
+                   (filename, model_name, alignment, EMBEDDING_PIPELINE))
+    return cursor.fetchone()[0] > 0
+
+def get_existing_filenames(table, filenames):
+    """
+    Checks which of the given filenames exist in the specified table, with one query per chunk
+    of filenames instead of one is_image_in_db() round-trip per file.
+
+    Args:
+        table (str): The table name ('reference_images' or 'group_images').
+        filenames (list): The filenames to check.
+
+    Returns:
+        set: The filenames that exist in the table.
+    """
+    cursor = get_connection().cursor()
+    rows = _select_by_filename(cursor, f"SELECT filename FROM {table} WHERE filename IN ({{}})", list(filenames))
+    return {filename for filename, in rows}
+
+@timed("db_get_reference_embedding")
+def get_reference_embedding(image_path, model_name=DEFAULT_MODEL_NAME, alignment=DEFAULT_ALIGNMENT):
+    """
+    Retrieves the embedding a model produced for a specific reference image from the database.
 
     Args:
         image_path (str): The file path of the image.
+        model_name (str): Name of the model.
+        alignment (str): Alignment the face was embedded with.
 
     Returns:
-        list or None: The embedding vector if found, otherwise None.
+        np.array or None: The embedding vector if found, otherwise None.
     """
     image_filename = os.path.basename(image_path)  # Extract only the filename
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT embedding FROM reference_images WHERE filename = ?', (image_filename,))
+    cursor.execute('SELECT embedding, dtype FROM reference_images WHERE filename = ? AND model_name = ? AND alignment = ?',
+                   (image_filename, model_name, alignment))
     row = cursor.fetchone()
     
-    conn.close()
-    
     if row:
         try:
-            return json.loads(row[0])  # Convert JSON string back to a list
+            return _decode_embedding(row[0], row[1])
         except Exception as e:
             print(f"Error parsing embedding for {image_filename}: {e}")
             return None
     else:
-        print(f"Embedding not found for {image_filename}.")
+        print(f"Embedding not found for {image_filename} (model '{model_name}', alignment '{alignment}').")
         return None
\ No newline at end of file
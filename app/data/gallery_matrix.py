@@ -0,0 +1,557 @@
+import json
+import os
+import re
+import struct
+import time
+import numpy as np
+from app.core.metrics import timed
+from app.core.quantization import ROW_ARRAYS
+from app.core.sharded_search import shard_of
+from app.data import database
+
+# Each model (and alignment) has its own gallery matrix, living next to the SQLite file as three
+# append-only data files plus a small state file. The state file is replaced atomically after
+# every write and is the commit record: rows beyond its `count` are leftovers of an interrupted
+# write and are ignored. `{key}` is replaced by the model name and alignment.
+MATRIX_FILENAME = 'gallery_{key}.npy'
+NORMS_FILENAME = 'gallery_{key}_norms.npy'
+IDS_FILENAME = 'gallery_{key}_ids.tsv'
+STATE_FILENAME = 'gallery_{key}_state.json'
+# Optional IVF index over the gallery rows: centroids plus one inverted-list assignment per row
+IVF_CENTROIDS_FILENAME = 'gallery_{key}_ivf_centroids.npy'
+IVF_ASSIGNMENTS_FILENAME = 'gallery_{key}_ivf_assignments.npy'
+# Optional compressed copies of the gallery rows, one file per array of each quantization mode
+QUANTIZED_FILENAME = 'gallery_{key}_{mode}_{name}.npy'
+# Optional copy of the gallery rows split into shards by image, searched in parallel: per shard, the
+# normalized rows, their norms and their positions in the gallery
+SHARD_FILENAME = 'gallery_{key}_shard{shard}of{shards}_{name}.npy'
+SHARD_ARRAYS = ('matrix', 'norms', 'rows')
+
+# Fixed .npy header size, so the shape can be rewritten in place as rows are appended
+_HEADER_SIZE = 128
+_DTYPE = np.dtype('<f4')
+_ASSIGNMENT_DTYPE = np.dtype('<i4')
+_ROW_DTYPE = np.dtype('<i8')
+# Number of gallery rows copied to the shards at once
+_SHARD_CHUNK = 65536
+
+def gallery_paths(model_name=database.DEFAULT_MODEL_NAME, alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Returns the paths of a model's gallery matrix files, located next to the database file.
+
+    Args:
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        dict: Paths keyed by 'matrix', 'norms', 'ids', 'state', 'ivf_centroids' and 'ivf_assignments'.
+    """
+    data_dir = os.path.dirname(database.DB_PATH)
+    key = _gallery_key(model_name, alignment)
+    return {
+        'matrix': os.path.join(data_dir, MATRIX_FILENAME.format(key=key)),
+        'norms': os.path.join(data_dir, NORMS_FILENAME.format(key=key)),
+        'ids': os.path.join(data_dir, IDS_FILENAME.format(key=key)),
+        'state': os.path.join(data_dir, STATE_FILENAME.format(key=key)),
+        'ivf_centroids': os.path.join(data_dir, IVF_CENTROIDS_FILENAME.format(key=key)),
+        'ivf_assignments': os.path.join(data_dir, IVF_ASSIGNMENTS_FILENAME.format(key=key)),
+    }
+
+@timed("load_gallery")
+def load_gallery(model_name=database.DEFAULT_MODEL_NAME, alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Opens a model's gallery matrix with np.memmap, rebuilding it from SQLite first if it is stale.
+
+    Args:
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        tuple: (ids, filenames, matrix, norms) with one row per group face: ids are group_faces ids,
+               filenames the images the faces belong to, matrix an (N, D) memory-mapped float32 array
+               of L2-normalized embeddings and norms the original row norms.
+    """
+    paths = gallery_paths(model_name, alignment)
+    state = _read_state(paths)
+    generation, count = database.get_gallery_state(model_name, alignment)
+
+    if state is None or state['generation'] != generation or state['count'] != count or not _is_complete(paths, state):
+        print(f"Gallery matrix for model '{model_name}' ({alignment} alignment) is missing or stale. "
+              f"Rebuilding it from the database...")
+        state = rebuild_gallery(model_name, alignment)
+
+    count, dim = state['count'], state['dim']
+    ids, filenames = _read_ids(paths['ids'], state['ids_bytes'])
+    if count == 0:
+        return ids, filenames, np.empty((0, dim), dtype=_DTYPE), np.empty(0, dtype=_DTYPE)
+
+    matrix = np.memmap(paths['matrix'], dtype=_DTYPE, mode='r', offset=_HEADER_SIZE, shape=(count, dim))
+    norms = np.memmap(paths['norms'], dtype=_DTYPE, mode='r', offset=_HEADER_SIZE, shape=(count,))
+    return ids, filenames, matrix, norms
+
+def load_ivf_index(with_assignments=True, model_name=database.DEFAULT_MODEL_NAME, alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Opens the persisted IVF index files, if they belong to the current gallery matrix.
+
+    Args:
+        with_assignments (bool): If False, only the centroids are read and assignments is None.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        tuple or None: (centroids, assignments) where assignments may cover fewer rows than the
+                       gallery if rows were appended while the index was not being maintained.
+    """
+    paths = gallery_paths(model_name, alignment)
+    state = _read_state(paths)
+    if state is None or 'ivf' not in state:
+        return None
+
+    nlist, count, dim = state['ivf']['nlist'], state['ivf']['count'], state['dim']
+    try:
+        centroids = np.fromfile(paths['ivf_centroids'], dtype=_DTYPE, offset=_HEADER_SIZE, count=nlist * dim)
+        assignments = None
+        if with_assignments:
+            assignments = np.fromfile(paths['ivf_assignments'], dtype=_ASSIGNMENT_DTYPE, offset=_HEADER_SIZE, count=count)
+    except (OSError, ValueError):
+        return None
+    if len(centroids) != nlist * dim or (assignments is not None and len(assignments) != count):
+        return None
+    return centroids.reshape(nlist, dim), assignments
+
+def save_ivf_index(centroids, assignments, model_name=database.DEFAULT_MODEL_NAME, alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Persists a freshly trained IVF index for the current gallery matrix.
+
+    Args:
+        centroids (np.array): (nlist, D) float32 centroids.
+        assignments (np.array): Inverted-list id of every gallery row, in row order.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+    """
+    paths = gallery_paths(model_name, alignment)
+    for key, data in (('ivf_centroids', np.asarray(centroids, dtype=_DTYPE)),
+                      ('ivf_assignments', np.asarray(assignments, dtype=_ASSIGNMENT_DTYPE))):
+        tmp_path = paths[key] + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            _write_header(f, data.shape, data.dtype)
+            f.write(data.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, paths[key])
+
+    state = _read_state(paths)
+    state['ivf'] = {'nlist': len(centroids), 'count': len(assignments)}
+    _write_state(paths, state)
+
+def append_ivf_assignments(assignments, model_name=database.DEFAULT_MODEL_NAME, alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Appends inverted-list assignments for the last gallery rows, which the index does not cover yet.
+
+    Args:
+        assignments (np.array): Inverted-list ids of the last len(assignments) gallery rows, in row order.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        bool: True if appended, False if there is no index or it would not end up covering exactly
+              the gallery rows (the assignments are then caught up on the next search).
+    """
+    paths = gallery_paths(model_name, alignment)
+    state = _read_state(paths)
+    assignments = np.asarray(assignments, dtype=_ASSIGNMENT_DTYPE)
+    if state is None or 'ivf' not in state or state['ivf']['count'] + len(assignments) != state['count']:
+        return False
+
+    count = state['ivf']['count']
+    _append_rows(paths['ivf_assignments'], count, assignments)
+    state['ivf']['count'] = count + len(assignments)
+    _write_state(paths, state)
+    return True
+
+def load_quantized_arrays(mode, model_name=database.DEFAULT_MODEL_NAME, alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Reads the persisted compressed gallery of a quantization mode, if it belongs to the current gallery matrix.
+
+    Args:
+        mode (str): Quantization mode (see app.core.quantization).
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        dict or None: Arrays by name (see QuantizedGallery), whose per-row arrays may cover fewer rows
+                      than the gallery if rows were appended while the compressed gallery was not loaded.
+    """
+    state = _read_state(gallery_paths(model_name, alignment))
+    entry = (state or {}).get('quantized', {}).get(mode)
+    if entry is None:
+        return None
+
+    arrays = {}
+    for name, (dtype, shape) in entry['arrays'].items():
+        shape = tuple(shape) if name not in ROW_ARRAYS else (entry['count'],) + tuple(shape)
+        try:
+            values = np.fromfile(_quantized_path(model_name, alignment, mode, name), dtype=dtype,
+                                 offset=_HEADER_SIZE, count=int(np.prod(shape)))
+        except (OSError, ValueError):
+            return None
+        if values.size != int(np.prod(shape)):
+            return None
+        arrays[name] = values.reshape(shape)
+    return arrays
+
+def save_quantized_arrays(mode, arrays, model_name=database.DEFAULT_MODEL_NAME, alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Persists a freshly encoded compressed gallery for the current gallery matrix.
+
+    Args:
+        mode (str): Quantization mode (see app.core.quantization).
+        arrays (dict): Arrays by name, as held by QuantizedGallery.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+    """
+    entry = {'count': len(arrays['codes']), 'arrays': {}}
+    for name, values in arrays.items():
+        path = _quantized_path(model_name, alignment, mode, name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            _write_header(f, values.shape, values.dtype)
+            f.write(np.ascontiguousarray(values).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        shape = values.shape[1:] if name in ROW_ARRAYS else values.shape
+        entry['arrays'][name] = [values.dtype.str, list(shape)]
+
+    paths = gallery_paths(model_name, alignment)
+    state = _read_state(paths)
+    state.setdefault('quantized', {})[mode] = entry
+    _write_state(paths, state)
+
+def append_quantized_arrays(mode, arrays, model_name=database.DEFAULT_MODEL_NAME, alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Appends the compressed rows of the last gallery rows, which the compressed gallery does not cover yet.
+
+    Args:
+        mode (str): Quantization mode (see app.core.quantization).
+        arrays (dict): Per-row arrays of the last rows, as returned by QuantizedGallery.encode_rows.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        bool: True if appended, False if there is no compressed gallery or it would not end up covering
+              exactly the gallery rows (it is then re-encoded on the next load).
+    """
+    paths = gallery_paths(model_name, alignment)
+    state = _read_state(paths)
+    entry = (state or {}).get('quantized', {}).get(mode)
+    added = len(arrays['codes'])
+    if entry is None or entry['count'] + added != state['count']:
+        return False
+
+    if added:
+        for name, values in arrays.items():
+            _append_rows(_quantized_path(model_name, alignment, mode, name), entry['count'], np.ascontiguousarray(values))
+    entry['count'] += added
+    _write_state(paths, state)
+    return True
+
+def load_shards(model_name=database.DEFAULT_MODEL_NAME, alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Describes the persisted gallery shards, if they belong to the current gallery matrix.
+
+    Args:
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        tuple or None: (shards, count) where shards are descriptors of the shard files (see
+                       ShardedSearchEngine) and count is the number of gallery rows they cover, which
+                       may be less than the gallery if rows were appended while they were not maintained.
+    """
+    state = _read_state(gallery_paths(model_name, alignment))
+    entry = (state or {}).get('shards')
+    if entry is None:
+        return None
+
+    shards = []
+    for shard, count in enumerate(entry['counts']):
+        paths = {name: _shard_path(model_name, alignment, shard, entry['shards'], name) for name in SHARD_ARRAYS}
+        paths.update(gallery=_gallery_key(model_name, alignment), shard=shard, split=entry.get('split', 0))
+        row_bytes = {'matrix': state['dim'] * _DTYPE.itemsize, 'norms': _DTYPE.itemsize, 'rows': _ROW_DTYPE.itemsize}
+        try:
+            if any(os.path.getsize(paths[name]) < _HEADER_SIZE + count * row_bytes[name] for name in SHARD_ARRAYS):
+                return None
+        except OSError:
+            return None
+        shards.append(dict(paths, count=count))
+    return shards, entry['count']
+
+@timed("save_shards")
+def save_shards(shards, matrix, norms, filenames, model_name=database.DEFAULT_MODEL_NAME,
+                alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Splits the current gallery matrix into shard files by image, replacing any previous split.
+
+    Rows are copied in chunks, so the gallery is never held in memory. The files of a previous split
+    into another number of shards are removed once the new split is committed.
+
+    Args:
+        shards (int): Number of shards.
+        matrix (np.array): The gallery matrix returned by load_gallery().
+        norms (np.array): The gallery norms returned by load_gallery().
+        filenames (list): The gallery's group image filenames, in row order.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+    """
+    assignments = shard_of(filenames, shards)
+    files = [{name: open(_shard_path(model_name, alignment, shard, shards, name) + '.tmp', 'wb') for name in SHARD_ARRAYS}
+             for shard in range(shards)]
+    counts = np.bincount(assignments, minlength=shards)
+    try:
+        for shard, shard_files in enumerate(files):
+            _write_header(shard_files['matrix'], (int(counts[shard]), matrix.shape[1]))
+            _write_header(shard_files['norms'], (int(counts[shard]),))
+            _write_header(shard_files['rows'], (int(counts[shard]),), _ROW_DTYPE)
+        for start in range(0, len(filenames), _SHARD_CHUNK):
+            chunk = assignments[start:start + _SHARD_CHUNK]
+            for shard, shard_files in enumerate(files):
+                rows = np.flatnonzero(chunk == shard)
+                shard_files['matrix'].write(np.ascontiguousarray(matrix[start + rows], dtype=_DTYPE).tobytes())
+                shard_files['norms'].write(np.asarray(norms[start + rows], dtype=_DTYPE).tobytes())
+                shard_files['rows'].write((start + rows).astype(_ROW_DTYPE).tobytes())
+        for shard_files in files:
+            for f in shard_files.values():
+                f.flush()
+                os.fsync(f.fileno())
+    finally:
+        for shard_files in files:
+            for f in shard_files.values():
+                f.close()
+    for shard in range(shards):
+        for name in SHARD_ARRAYS:
+            path = _shard_path(model_name, alignment, shard, shards, name)
+            os.replace(path + '.tmp', path)
+
+    paths = gallery_paths(model_name, alignment)
+    state = _read_state(paths)
+    previous = state.get('shards')
+    # Identifies this split: the files were replaced, so memory maps of a previous split must not be reused
+    state['shards'] = {'shards': shards, 'count': len(filenames), 'counts': counts.tolist(), 'split': time.time_ns()}
+    _write_state(paths, state)
+    if previous and previous['shards'] != shards:
+        for shard in range(previous['shards']):
+            for name in SHARD_ARRAYS:
+                path = _shard_path(model_name, alignment, shard, previous['shards'], name)
+                if os.path.exists(path):
+                    os.remove(path)
+
+def append_shard_rows(filenames, embeddings, norms=None, model_name=database.DEFAULT_MODEL_NAME,
+                      alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Routes the last gallery rows, which the shards do not cover yet, to the shards of their images.
+
+    Args:
+        filenames (list): Group image filename of each of the last len(filenames) gallery rows.
+        embeddings (np.array): (M, D) embeddings of these rows.
+        norms (np.array): Row norms of the original embeddings. When given, `embeddings` is assumed to
+                          be normalized already.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        bool: True if appended, False if the gallery is not sharded or the shards would not end up
+              covering exactly the gallery rows (they are then caught up on the next search).
+    """
+    paths = gallery_paths(model_name, alignment)
+    state = _read_state(paths)
+    entry = (state or {}).get('shards')
+    if entry is None or entry['count'] + len(filenames) != state['count']:
+        return False
+
+    if norms is None:
+        embeddings, norms = _normalize(embeddings)
+    embeddings = np.asarray(embeddings, dtype=_DTYPE).reshape(len(filenames), -1)
+    norms = np.asarray(norms, dtype=_DTYPE)
+    assignments = shard_of(filenames, entry['shards'])
+    for shard in np.unique(assignments):
+        rows = np.flatnonzero(assignments == shard)
+        count = entry['counts'][shard]
+        for name, data in (('matrix', np.ascontiguousarray(embeddings[rows])), ('norms', norms[rows]),
+                           ('rows', (entry['count'] + rows).astype(_ROW_DTYPE))):
+            _append_rows(_shard_path(model_name, alignment, shard, entry['shards'], name), count, data)
+        entry['counts'][shard] = count + len(rows)
+    entry['count'] += len(filenames)
+    _write_state(paths, state)
+    return True
+
+@timed("rebuild_gallery")
+def rebuild_gallery(model_name=database.DEFAULT_MODEL_NAME, alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Rewrites a model's gallery matrix files from the group face embeddings stored in SQLite.
+
+    Args:
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        dict: The new gallery state.
+    """
+    paths = gallery_paths(model_name, alignment)
+    ids, filenames, embeddings, generation = database.get_group_embedding_rows(model_name, alignment)
+    stale_faces, _ = database.count_stale_embeddings(model_name, alignment)
+    if stale_faces:
+        print(f"Note: {stale_faces} group faces were embedded by an older embedding pipeline. They are still "
+              f"searched; run MODE=add on their folders to re-embed them.")
+
+    # Drop the commit record first so a crash mid-rebuild is never mistaken for a valid matrix
+    if os.path.exists(paths['state']):
+        os.remove(paths['state'])
+
+    dim = embeddings.shape[1] if len(embeddings) else 0
+    normalized, norms = _normalize(embeddings.reshape(len(ids), dim))
+    for key, data in (('matrix', normalized), ('norms', norms)):
+        tmp_path = paths[key] + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            _write_header(f, data.shape)
+            f.write(data.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, paths[key])
+
+    tmp_path = paths['ids'] + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        ids_bytes = f.write(_encode_ids(zip(ids, filenames)))
+    os.replace(tmp_path, paths['ids'])
+
+    state = {'generation': generation, 'count': len(ids), 'dim': dim, 'ids_bytes': ids_bytes}
+    _write_state(paths, state)
+    return state
+
+@timed("append_to_gallery")
+def append_to_gallery(face_ids, filenames, embeddings, generation, model_name=database.DEFAULT_MODEL_NAME, alignment=database.DEFAULT_ALIGNMENT):
+    """
+    Appends the faces of a newly inserted group image to the model's gallery matrix.
+
+    The append is only applied when the matrix is exactly one generation behind the database,
+    i.e. this insert is the only change since the last write. Otherwise the matrix is left stale
+    and the next load_gallery() rebuilds it from SQLite.
+
+    Args:
+        face_ids (list): The ids of the inserted group_faces rows.
+        filenames (list): The filename of the group image each face belongs to.
+        embeddings (np.array): (M, D) face embedding vectors, in the order of face_ids.
+        generation (int): The gallery generation returned by insert_group_image.
+        model_name (str): Name of the model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        bool: True if the rows were appended, False if the matrix was left for a rebuild.
+    """
+    paths = gallery_paths(model_name, alignment)
+    state = _read_state(paths)
+    if state is None or state['generation'] != generation - 1 or not _is_complete(paths, state):
+        return False
+
+    count, dim = state['count'], state['dim']
+    if len(face_ids):
+        embeddings = np.asarray(embeddings, dtype=_DTYPE).reshape(len(face_ids), -1)
+        if count and dim != embeddings.shape[1]:
+            return False
+        dim = embeddings.shape[1]
+        normalized, norms = _normalize(embeddings)
+        _append_rows(paths['matrix'], count, normalized)
+        _append_rows(paths['norms'], count, norms)
+        state['ids_bytes'] = _append_ids(paths['ids'], state['ids_bytes'], zip(face_ids, filenames))
+
+    state.update({'generation': generation, 'count': count + len(face_ids), 'dim': dim})
+    _write_state(paths, state)
+    return True
+
+def _gallery_key(model_name, alignment):
+    return re.sub(r'[^A-Za-z0-9]+', '-', f"{model_name}_{alignment}")
+
+def _quantized_path(model_name, alignment, mode, name):
+    data_dir = os.path.dirname(database.DB_PATH)
+    return os.path.join(data_dir, QUANTIZED_FILENAME.format(key=_gallery_key(model_name, alignment), mode=mode, name=name))
+
+def _shard_path(model_name, alignment, shard, shards, name):
+    data_dir = os.path.dirname(database.DB_PATH)
+    key = _gallery_key(model_name, alignment)
+    return os.path.join(data_dir, SHARD_FILENAME.format(key=key, shard=shard, shards=shards, name=name))
+
+def _normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=_DTYPE)
+    norms = np.linalg.norm(embeddings, axis=1).astype(_DTYPE)
+    safe_norms = np.where(norms > 0, norms, 1).astype(_DTYPE)
+    return np.ascontiguousarray(embeddings / safe_norms[:, None], dtype=_DTYPE), norms
+
+def _write_header(f, shape, dtype=_DTYPE):
+    """Writes an .npy v1.0 header padded to a fixed size."""
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': %r, }" % (np.dtype(dtype).str, tuple(shape))
+    header = header.ljust(_HEADER_SIZE - 10 - 1) + "\n"
+    f.seek(0)
+    f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+def _append_rows(path, count, rows):
+    """Appends rows after the first `count` committed rows, discarding any uncommitted tail."""
+    row_bytes = rows[0].nbytes if rows.ndim > 1 else rows.itemsize
+    with open(path, 'r+b') as f:
+        f.truncate(_HEADER_SIZE + count * row_bytes)
+        f.seek(0, os.SEEK_END)
+        f.write(rows.tobytes())
+        _write_header(f, (count + len(rows),) + rows.shape[1:], rows.dtype)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _encode_ids(entries):
+    return "".join(f"{row_id}\t{filename}\n" for row_id, filename in entries).encode('utf-8')
+
+def _append_ids(path, ids_bytes, entries):
+    """Appends id/filename lines after the committed bytes and returns the new committed size."""
+    data = _encode_ids(entries)
+    with open(path, 'r+b') as f:
+        f.truncate(ids_bytes)
+        f.seek(ids_bytes)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return ids_bytes + len(data)
+
+def _read_ids(path, ids_bytes):
+    ids, filenames = [], []
+    with open(path, 'rb') as f:
+        data = f.read(ids_bytes).decode('utf-8')
+    # Only '\n' ends a line: splitlines() would also split file names containing '\r', '\x1c' or '\u2028'
+    for line in data.split('\n')[:-1]:
+        row_id, filename = line.split("\t", 1)
+        ids.append(int(row_id))
+        filenames.append(filename)
+    return ids, filenames
+
+def _read_state(paths):
+    try:
+        with open(paths['state'], encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_state(paths, state):
+    tmp_path = paths['state'] + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, paths['state'])
+
+def _is_complete(paths, state):
+    """Checks that every data file holds at least the committed number of rows."""
+    count, dim = state['count'], state['dim']
+    try:
+        if os.path.getsize(paths['matrix']) < _HEADER_SIZE + count * dim * _DTYPE.itemsize:
+            return False
+        if os.path.getsize(paths['norms']) < _HEADER_SIZE + count * _DTYPE.itemsize:
+            return False
+        return os.path.getsize(paths['ids']) >= state['ids_bytes']
+    except (OSError, KeyError):
+        return False
@@ -0,0 +1,176 @@
+import hashlib
+import os
+from app.data.database import (get_existing_filenames, get_group_image_hashes, get_manifest_entries,
+                               record_manifest_entries, rename_group_images)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+HASH_CHUNK_SIZE = 1 << 20
+
+def hash_file(path):
+    """
+    Computes the content hash of a file, reading it in chunks.
+
+    Args:
+        path (str): Path to the file.
+
+    Returns:
+        str: Hex digest of the BLAKE2b hash of the file contents.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def image_key(path):
+    """
+    Returns the identifier a group image or video is stored under, and recorded in the manifest by.
+
+    It is the absolute, '/'-separated path of the file, so that files with the same name in
+    different folders never collide.
+
+    Args:
+        path (str): Path to the file.
+
+    Returns:
+        str: The absolute path of the file.
+    """
+    return os.path.abspath(path).replace(os.sep, '/')
+
+def adopt_legacy_key(path):
+    """
+    Moves a group image stored by older versions under the basename of a file to the file's
+    key (see image_key), if it has the same contents.
+
+    Args:
+        path (str): Path to the file.
+
+    Returns:
+        str: The key of the file.
+    """
+    file = _file_entry(path, os.path.dirname(path), os.stat(path))
+    _adopt_relative_keys([file], get_manifest_entries())
+    return file['path']
+
+def list_image_files(folder_path, recursive=False, extensions=IMAGE_EXTENSIONS):
+    """
+    Lists the image files of a folder with their size and modification time.
+
+    Args:
+        folder_path (str): Path to the folder.
+        recursive (bool): If True, also list the images of all sub-folders.
+        extensions (tuple): Lower-case file extensions to include.
+
+    Returns:
+        list: Dicts with 'path' (the key of the file, see image_key), 'rel_path' (relative to
+              folder_path, '/'-separated), 'abs_path', 'size' and 'mtime_ns', sorted by path.
+    """
+    files = []
+    pending_dirs = [folder_path]
+    while pending_dirs:
+        with os.scandir(pending_dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        pending_dirs.append(entry.path)
+                elif entry.name.lower().endswith(extensions):
+                    files.append(_file_entry(entry.path, folder_path, entry.stat()))
+    files.sort(key=lambda f: f['path'])
+    return files
+
+def _file_entry(path, folder_path, stat):
+    return {
+        'path': image_key(path),
+        'rel_path': os.path.relpath(path, folder_path).replace(os.sep, '/'),
+        'abs_path': path,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+def scan_folder(folder_path, recursive=False, extensions=IMAGE_EXTENSIONS):
+    """
+    Finds the images of a folder that still need to be ingested, using the ingestion manifest.
+
+    Files whose size and modification time match the manifest are skipped without being read.
+    Other files are hashed: if the same content was already ingested (e.g. a renamed copy), the
+    manifest is updated and the file is skipped; otherwise it is returned for ingestion. Only one
+    of several copies found by the same scan is returned; the others are recorded by the next scan,
+    once that copy is committed. Files missing from the manifest but already stored as group images
+    (ingested before the manifest existed) are recorded and skipped as well, and images stored by
+    older versions under paths relative to this folder are moved to their keys first.
+
+    Args:
+        folder_path (str): Path to the folder.
+        recursive (bool): If True, also scan all sub-folders.
+        extensions (tuple): Lower-case file extensions to include.
+
+    Returns:
+        tuple: (new_files, total) where new_files are the list_image_files() dicts to ingest, each
+               with an added 'content_hash', and total is the number of image files found.
+    """
+    files = list_image_files(folder_path, recursive=recursive, extensions=extensions)
+    manifest = get_manifest_entries()
+    _adopt_relative_keys(files, manifest)
+    known_hashes = {content_hash for _, _, content_hash in manifest.values()}
+    stored = get_existing_filenames("group_images", [f['path'] for f in files if f['path'] not in manifest])
+
+    # Hashes of the files returned for ingestion; they only become known once the files are committed
+    pending_hashes = set()
+    new_files, duplicates = [], []
+    for file in files:
+        entry = manifest.get(file['path'])
+        if entry is not None and entry[0] == file['size'] and entry[1] == file['mtime_ns']:
+            continue
+
+        if not _hash(file):
+            continue
+
+        if file['content_hash'] in known_hashes or file['path'] in stored:
+            duplicates.append(file)
+        elif file['content_hash'] not in pending_hashes:
+            new_files.append(file)
+            pending_hashes.add(file['content_hash'])
+
+    # Same content under a new path or a touched file: remember it without re-processing
+    record_manifest_entries(duplicates)
+    return new_files, len(files)
+
+def _hash(file):
+    """Sets the 'content_hash' of a file dict if it is not set yet; returns False if it cannot be read."""
+    if 'content_hash' not in file:
+        try:
+            file['content_hash'] = hash_file(file['abs_path'])
+        except OSError as e:
+            print(f"Unable to read image: {file['abs_path']} ({e})")
+            return False
+    return True
+
+def _adopt_relative_keys(files, manifest):
+    """
+    Moves the group images and manifest entries that older versions stored under paths relative to
+    the ingested folder to the keys of the given files.
+
+    A relative path is ambiguous, since another folder may hold a file with the same relative path,
+    so it is only adopted by a file with the same contents. Images stored without a content hash
+    (before the manifest existed) are adopted by name.
+
+    Args:
+        files (list): list_image_files() dicts; 'content_hash' is set on the files that were hashed.
+        manifest (dict): The manifest, as returned by get_manifest_entries; updated in place.
+    """
+    candidates = [file for file in files if file['path'] not in manifest]
+    stored = get_group_image_hashes([file['rel_path'] for file in candidates])
+    renames = {}
+    for file in candidates:
+        entry = manifest.get(file['rel_path'])
+        if entry is None and file['rel_path'] not in stored:
+            continue
+        content_hash = entry[2] if entry is not None else stored[file['rel_path']]
+        if content_hash is None or (_hash(file) and file['content_hash'] == content_hash):
+            renames[file['rel_path']] = file['path']
+
+    if renames and rename_group_images(renames):
+        print(f"Moved {len(renames)} images stored under paths relative to their folder to absolute paths.")
+        for old, new in renames.items():
+            if old in manifest:
+                manifest[new] = manifest.pop(old)
@@ -1,77 +1,426 @@
 import os
-import cv2
-from app.core.face_detector import detect_faces
-from app.core.face_alignment import align_face
-from app.core.feature_extraction import extract_face_embedding
-from app.data.database import insert_reference_image, insert_group_image, is_image_in_db
+import numpy as np
+from app.converter.convert import load_image, supported_extensions
+from app.core.face_detector import detect_faces, detector_version
+from app.core.face_alignment import align_face, align_faces
+from app.core.feature_extraction import extract_face_embedding, extract_face_embeddings
+from app.core.model_registry import get_input_size
+from app.data.database import (BulkWriter, add_face_embeddings, get_faces_missing_embeddings, get_group_image_hashes,
+                               insert_reference_image, insert_reference_images, insert_group_image, is_image_in_db,
+                               is_reference_image_in_db)
+from app.data.manifest import adopt_legacy_key, hash_file, image_key, scan_folder
+from app.data.gallery_matrix import append_to_gallery
+from app.runner.index_runner import add_to_ann_index, add_to_shards
 
-def add_reference_image(image_path, model_name="Facenet"):
+def add_reference_image(image_path, model_name="Facenet", detection_max_side=None, alignment="legacy"):
     filename = os.path.basename(image_path)
-    if is_image_in_db("reference_images", filename):
+    if is_reference_image_in_db(filename, model_name, alignment):
         print(f"Reference image '{filename}' is already in the database.")
         return
 
-    img = cv2.imread(image_path)
+    img = load_image(image_path)
     if img is None:
         print(f"Unable to read image: {image_path}")
         return
 
-    results = detect_faces(image_path, save_output=False)
+    results = detect_faces(img, save_output=False, max_side=detection_max_side)
     if not results:
         print(f"No face detected in {image_path}.")
         return
 
     try:
-        aligned_face = align_face(img, results[0])
+        aligned_face = _align_reference_face(img, results, alignment_size(model_name, alignment))
         embedding = extract_face_embedding(aligned_face, model_name=model_name)
-        insert_reference_image(filename, embedding)
+        insert_reference_image(filename, embedding, model_name=model_name, alignment=alignment)
         print(f"Reference image '{filename}' added successfully.")
     except Exception as e:
         print(f"Error processing '{filename}': {e}")
 
-def add_group_image(image_path, model_name="Facenet"):
+def add_reference_images(image_paths, model_name="Facenet", batch_size=32, detection_max_side=None, alignment="legacy",
+                         filenames=None):
     """
-    Adds a group image to the database by detecting faces, extracting embeddings, and saving them.
-    
+    Adds several reference images, embedding their faces in batches and storing them in one transaction.
+
+    Args:
+        image_paths (list): Paths to the reference images.
+        model_name (str): Name of the face recognition model.
+        batch_size (int): Number of faces embedded per forward pass.
+        detection_max_side (int): Longest image side used for detection; larger images are downscaled.
+        alignment (str): "legacy" or "roi" (see add_group_image).
+        filenames (list): Identifiers to store the images under. Defaults to their basenames.
+
+    Returns:
+        dict: Filename -> embedding of every reference image added.
+    """
+    align_size = alignment_size(model_name, alignment)
+    names = filenames or [os.path.basename(image_path) for image_path in image_paths]
+    filenames, aligned_faces = [], []
+    for image_path, filename in zip(image_paths, names):
+        img = load_image(image_path)
+        if img is None:
+            print(f"Unable to read image: {image_path}")
+            continue
+        try:
+            results = detect_faces(img, save_output=False, max_side=detection_max_side)
+            if not results:
+                print(f"No face detected in {image_path}.")
+                continue
+            aligned_faces.append(_align_reference_face(img, results, align_size))
+            filenames.append(filename)
+        except Exception as e:
+            print(f"Error processing '{filename}': {e}")
+
+    if not filenames:
+        return {}
+    try:
+        embeddings = extract_face_embeddings(aligned_faces, model_name=model_name, batch_size=batch_size)
+    except Exception as e:
+        print(f"Error extracting embeddings: {e}")
+        return {}
+    insert_reference_images(list(zip(filenames, embeddings)), model_name=model_name, alignment=alignment)
+    print(f"Added {len(filenames)} reference images.")
+    return dict(zip(filenames, embeddings))
+
+def _align_reference_face(img, faces, align_size):
+    """Aligns the first detected face, which is the one a reference image is stored with."""
+    return align_faces(img, faces[:1], align_size)[0] if align_size else align_face(img, faces[0])
+
+def add_group_image(image_path, model_name="Facenet", batch_size=32, detection_max_side=None, alignment="legacy",
+                    detection_tiling=None):
+    """
+    Adds a group image to the database by detecting all faces, extracting their embeddings, and saving them.
+
+    If the image is already stored but its faces have no embedding for this model yet, only the
+    embedding stage runs, on the stored detections. Detections of another detector version (e.g.
+    other DETECTION_MAX_SIDE or tiling settings) are not reused: the faces are detected again and
+    replace the stored ones.
+
     Args:
         image_path (str): Path to the group image.
         model_name (str): Name of the face recognition model.
+        batch_size (int): Number of faces embedded per forward pass.
+        detection_max_side (int): Longest image side used for detection; larger images are downscaled.
+        alignment (str): "legacy" (full-image rotation, then box crop) or "roi" (landmark similarity
+                         transform straight to the model input size).
+        detection_tiling (dict): tile_size, tile_overlap and tile_workers of tiled detection (see detect_faces).
     """
-    filename = os.path.basename(image_path)
+    filename = adopt_legacy_key(image_path)
+    detector = detector_version(detection_max_side, detection_tiling)
+    cached_faces = None
+    replace = False
     if is_image_in_db("group_images", filename):
-        print(f"Group image '{filename}' is already in the database.")
+        cached_faces = get_faces_missing_embeddings(model_name, alignment, filename=filename).get(filename)
+        if not cached_faces:
+            print(f"Group image '{filename}' is already in the database.")
+            return
+        if not detected_with(cached_faces, detector):
+            cached_faces, replace = None, True
+
+    prepared = prepare_group_image(image_path, filename=filename, skip_existing=False,
+                                   detection_max_side=detection_max_side,
+                                   align_size=alignment_size(model_name, alignment), faces=cached_faces,
+                                   detection_tiling=detection_tiling)
+    # A re-detected image replaces its stored faces even when none are found any more
+    if prepared is None or not (prepared[1] or replace):
         return
 
-    img = cv2.imread(image_path)
+    filename, faces, aligned_faces = prepared
+    try:
+        embeddings = extract_face_embeddings(aligned_faces, model_name=model_name, batch_size=batch_size)
+        if cached_faces:
+            store_face_embeddings(filename, faces, embeddings, model_name=model_name, alignment=alignment)
+        else:
+            content_hash = get_group_image_hashes([filename]).get(filename) if replace else None
+            store_group_image(filename, faces, embeddings, content_hash=content_hash, model_name=model_name,
+                              alignment=alignment, detector=detector)
+    except Exception as e:
+        print(f"Error processing '{filename}': {e}")
+
+def detected_with(faces, detector):
+    """Returns True if every cached face was found by the given detector version (see detector_version)."""
+    return all(face.get('detector') == detector for face in faces)
+
+def prepare_group_image(image_path, filename=None, skip_existing=True, detection_max_side=None, align_size=None,
+                        faces=None, detection_tiling=None):
+    """
+    Reads a group image, detects all of its faces and aligns them, ready for embedding.
+
+    Args:
+        image_path (str): Path to the group image.
+        filename (str): Identifier to store the image under. Defaults to the key of image_path (see image_key).
+        skip_existing (bool): If True, skip images whose filename is already in the database.
+        detection_max_side (int): Longest image side used for detection; larger images are downscaled.
+        align_size (tuple): (width, height) for ROI alignment; None uses the legacy align_face.
+        faces (list): Cached detections to align instead of detecting the faces again.
+        detection_tiling (dict): tile_size, tile_overlap and tile_workers of tiled detection (see detect_faces).
+
+    Returns:
+        tuple or None: (filename, faces, aligned_faces) where faces are the detection results and
+                       aligned_faces the matching aligned crops (both empty if no face was found),
+                       or None if the image is skipped or cannot be processed.
+    """
+    filename = filename or image_key(image_path)
+    if skip_existing and is_image_in_db("group_images", filename):
+        print(f"Group image '{filename}' is already in the database.")
+        return None
+
+    img = load_image(image_path)
     if img is None:
         print(f"Unable to read image: {image_path}")
-        return
-
-    results = detect_faces(image_path, save_output=False)
-    if not results:
-        print(f"No face detected in {image_path}.")
-        return
+        return None
 
     try:
-        aligned_face = align_face(img, results[0])
-        embedding = extract_face_embedding(aligned_face, model_name=model_name)
-        insert_group_image(filename, embedding)  # Now storing the embedding for group images
-        print(f"Group image '{filename}' added successfully.")
+        results, aligned_faces = detect_and_align_faces(img, detection_max_side=detection_max_side,
+                                                        align_size=align_size, faces=faces,
+                                                        detection_tiling=detection_tiling)
     except Exception as e:
         print(f"Error processing '{filename}': {e}")
+        return None
+
+    if not results:
+        print(f"No face detected in {image_path}.")
+    return filename, results, aligned_faces
+
+def detect_and_align_faces(img, detection_max_side=None, align_size=None, faces=None, detection_tiling=None):
+    """
+    Detects every face of a decoded image and aligns each of them.
+
+    The image is decoded once by the caller; detection may run on a downscaled copy, while the
+    alignment crops are taken from the full-resolution image.
+
+    Args:
+        img (numpy.ndarray): The decoded BGR image.
+        detection_max_side (int): Longest image side used for detection; larger images are downscaled.
+        align_size (tuple): (width, height) for ROI alignment of all faces in one call; None uses the
+                            legacy align_face, which warps the full image once per face.
+        faces (list): Cached detections (with 'box' and 'keypoints'); when given, detection is skipped.
+        detection_tiling (dict): tile_size, tile_overlap and tile_workers of tiled detection (see detect_faces).
+
+    Returns:
+        tuple: (faces, aligned_faces) with the detection results and the matching aligned crops.
+    """
+    results = faces if faces is not None else detect_faces(img, save_output=False, max_side=detection_max_side,
+                                                           **(detection_tiling or {}))
+    # Keep every detected face, not just the first one
+    if align_size:
+        return results, list(align_faces(img, results, align_size))
+    return results, [align_face(img, face) for face in results]
+
+def alignment_size(model_name, alignment):
+    """
+    Returns the output size for the given alignment mode, or None for the legacy alignment.
 
-def add_group_images_from_folder(folder_path):
-    image_extensions = (".jpg", ".jpeg", ".png")
-    images = [f for f in os.listdir(folder_path) if f.lower().endswith(image_extensions)]
+    Args:
+        model_name (str): Name of the face recognition model the faces are aligned for.
+        alignment (str): "legacy" or "roi".
+    """
+    if alignment == "roi":
+        return get_input_size(model_name)
+    if alignment != "legacy":
+        raise ValueError(f"Unsupported alignment '{alignment}'. Choose either 'legacy' or 'roi'.")
+    return None
+
+def store_group_image(filename, faces, embeddings, content_hash=None, model_name="Facenet", alignment="legacy",
+                      detector=None):
+    """
+    Saves a group image with its faces and their embeddings, and appends them to the gallery matrix.
+
+    Args:
+        filename (str): The filename (or identifier) of the group image.
+        faces (list): The detection results of the faces.
+        embeddings (np.array): (N, D) embeddings of the faces, in the same order.
+        content_hash (str): Hash of the file contents, if known.
+        model_name (str): Name of the face recognition model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+        detector (str): Version of the detector that found the faces.
+
+    Returns:
+        bool: True if the image was stored.
+    """
+    faces = [dict(face, embedding=embedding) for face, embedding in zip(faces, embeddings)]
+    inserted = insert_group_image(filename, faces, content_hash=content_hash, model_name=model_name,
+                                  alignment=alignment, detector=detector)
+    if inserted is None:
+        return False
+    face_ids, generation = inserted
+    append_stored_images([(filename, face_ids, embeddings)], generation, model_name, alignment)
+    return True
+
+def store_face_embeddings(filename, faces, embeddings, model_name="Facenet", alignment="legacy"):
+    """
+    Saves the embeddings of stored group faces for another model, and appends them to its gallery matrix.
+
+    Args:
+        filename (str): The filename of the group image the faces belong to.
+        faces (list): The cached faces, as returned by get_faces_missing_embeddings.
+        embeddings (np.array): (N, D) embeddings of the faces, in the same order.
+        model_name (str): Name of the face recognition model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        bool: True if the embeddings were stored.
+    """
+    face_ids = [face['id'] for face in faces]
+    generation = add_face_embeddings(face_ids, embeddings, model_name=model_name, alignment=alignment)
+    if generation is None:
+        return False
+    append_stored_images([(filename, face_ids, embeddings)], generation, model_name, alignment)
+    return True
+
+def group_image_writer(model_name="Facenet", alignment="legacy", batch_size=256, flush_interval=2.0):
+    """
+    Returns a BulkWriter whose flushed group images are appended to the model's gallery matrix.
+
+    Args:
+        model_name (str): Name of the face recognition model that produces the embeddings.
+        alignment (str): Alignment the faces are embedded with.
+        batch_size (int): Number of buffered group images that triggers a database write.
+        flush_interval (float): Seconds after which buffered rows are written.
+    """
+    return BulkWriter(model_name=model_name, alignment=alignment, batch_size=batch_size, flush_interval=flush_interval,
+                      on_flush=lambda images, generation: append_stored_images(images, generation, model_name, alignment))
+
+def append_stored_images(images, generation, model_name="Facenet", alignment="legacy"):
+    """
+    Appends the faces of group images just committed to the database to the model's gallery matrix
+    and ANN index.
+
+    Args:
+        images (list): (filename, face_ids, embeddings) tuples, in insertion order.
+        generation (int): The model's gallery generation after the insert.
+        model_name (str): Name of the face recognition model that produced the embeddings.
+        alignment (str): Alignment the faces were embedded with.
+    """
+    face_ids = [face_id for _, ids, _ in images for face_id in ids]
+    filenames = [filename for filename, ids, _ in images for _ in ids]
+    embeddings = [np.asarray(e, dtype=np.float32).reshape(len(ids), -1) for _, ids, e in images if len(ids)]
+    embeddings = np.concatenate(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+    if append_to_gallery(face_ids, filenames, embeddings, generation, model_name, alignment) and face_ids:
+        add_to_ann_index(embeddings, model_name, alignment)
+        add_to_shards(filenames, embeddings, model_name, alignment)
+    for filename, ids, _ in images:
+        print(f"Group image '{filename}' added successfully with {len(ids)} face(s).")
 
-    if not images:
+def files_missing_embeddings(folder_path, new_files, model_name="Facenet", alignment="legacy", detector=None):
+    """
+    Finds the already-ingested images of a folder whose faces have no embedding for a model yet.
+
+    Images whose faces were found by another detector version are returned without their cached
+    detections, as manifest entries with 'replace' set, to be detected again and replace the stored faces.
+    Videos share the group image tables but cannot be decoded as images, so only files with an
+    image extension load_image supports are returned.
+
+    Args:
+        folder_path (str): Path to the ingested folder.
+        new_files (list): Files about to be ingested from scratch, which are left out.
+        model_name (str): Name of the face recognition model.
+        alignment (str): Alignment the faces are embedded with.
+        detector (str): Current detector version (see detector_version).
+
+    Returns:
+        list: Dicts with 'path', 'abs_path' and either 'faces', the cached detections still to embed,
+              or 'replace' with the 'content_hash', 'size' and 'mtime_ns' of the file.
+    """
+    new_paths = {file['path'] for file in new_files}
+    # Images are stored under their absolute path (see image_key), so only those under the folder are its own
+    root = image_key(folder_path).rstrip('/') + '/'
+    extensions = supported_extensions()
+    files, stale = [], []
+    for path, faces in get_faces_missing_embeddings(model_name, alignment).items():
+        if (path.startswith(root) and path.lower().endswith(extensions) and path not in new_paths
+                and os.path.isfile(path)):
+            if detected_with(faces, detector):
+                files.append({'path': path, 'abs_path': path, 'faces': faces})
+            else:
+                stale.append(path)
+
+    hashes = get_group_image_hashes(stale)
+    for path in stale:
+        try:
+            stat = os.stat(path)
+            content_hash = hashes.get(path) or hash_file(path)
+        except OSError as e:
+            print(f"Unable to read '{path}': {e}")
+            continue
+        files.append({'path': path, 'abs_path': path, 'content_hash': content_hash, 'size': stat.st_size,
+                      'mtime_ns': stat.st_mtime_ns, 'replace': True})
+    return files
+
+def add_group_images_from_folder(folder_path, model_name="Facenet", batch_size=32, recursive=False,
+                                 detection_max_side=None, alignment="legacy", detection_tiling=None):
+    """
+    Adds the new or changed group images of a folder to the database, and embeds the faces of the
+    images already stored that have no embedding for this model yet.
+
+    Args:
+        folder_path (str): Path to the folder of group images.
+        model_name (str): Name of the face recognition model.
+        batch_size (int): Number of faces embedded per forward pass.
+        recursive (bool): If True, also add the images of all sub-folders.
+        detection_max_side (int): Longest image side used for detection; larger images are downscaled.
+        alignment (str): "legacy" or "roi" (see add_group_image).
+        detection_tiling (dict): tile_size, tile_overlap and tile_workers of tiled detection (see detect_faces).
+    """
+    align_size = alignment_size(model_name, alignment)
+    new_files, total = scan_folder(folder_path, recursive=recursive, extensions=supported_extensions())
+
+    if not total:
         print(f"No images found in folder '{folder_path}'.")
         return
 
-    print(f"Adding {len(images)} images from folder '{folder_path}'...")
+    print(f"Adding {len(new_files)} new or changed images from folder '{folder_path}' "
+          f"({total - len(new_files)} unchanged)...")
+    detector = detector_version(detection_max_side, detection_tiling)
+    cached_files = files_missing_embeddings(folder_path, new_files, model_name, alignment, detector)
+    if cached_files:
+        print(f"Embedding the stored faces of {len(cached_files)} images with model '{model_name}' "
+              f"({sum(1 for file in cached_files if file.get('replace'))} detected again)...")
 
-    for image_file in images:
-        image_path = os.path.join(folder_path, image_file)
-        add_group_image(image_path)
+    # Faces are accumulated across images and embedded together once a full batch is pending
+    pending = []
+    pending_faces = 0
+    with group_image_writer(model_name, alignment) as writer:
+        for file in new_files + cached_files:
+            prepared = prepare_group_image(file['abs_path'], filename=file['path'], skip_existing=False,
+                                           detection_max_side=detection_max_side, align_size=align_size,
+                                           faces=file.get('faces'), detection_tiling=detection_tiling)
+            if prepared is None:
+                continue
+            pending.append((prepared, file))
+            pending_faces += len(prepared[1])
+            if pending_faces >= batch_size:
+                _embed_and_store(pending, model_name, batch_size, writer, detector)
+                pending, pending_faces = [], 0
+        _embed_and_store(pending, model_name, batch_size, writer, detector)
 
     print(f"Finished adding images from '{folder_path}'.")
+
+def _embed_and_store(pending, model_name, batch_size, writer, detector):
+    """
+    Embeds the faces of several prepared group images in one call and hands each image, with its
+    ingestion manifest entry, to the bulk writer.
+    """
+    if not pending:
+        return
+    aligned_faces = [aligned for (_, _, aligned_list), _ in pending for aligned in aligned_list]
+    try:
+        embeddings = extract_face_embeddings(aligned_faces, model_name=model_name, batch_size=batch_size)
+    except Exception as e:
+        print(f"Error extracting embeddings: {e}")
+        return
+
+    offset = 0
+    for (filename, faces, _), file in pending:
+        face_embeddings = embeddings[offset:offset + len(faces)]
+        offset += len(faces)
+        if 'faces' in file:
+            # Stored image: only the embeddings of this model are new
+            writer.add_face_embeddings(filename, [face['id'] for face in faces], face_embeddings)
+            continue
+        # Images without faces are only recorded in the manifest, so re-scans skip them; re-detected
+        # images are stored anyway, to replace the faces found by the previous detector
+        if faces or file.get('replace'):
+            writer.add_group_image(filename, [dict(face, embedding=embedding) for face, embedding
+                                              in zip(faces, face_embeddings)],
+                                   content_hash=file['content_hash'], detector=detector)
+        writer.add_manifest_entries([file])
@@ -0,0 +1,155 @@
+import csv
+import json
+import os
+import time
+import numpy as np
+from app.data.database import get_all_reference_embeddings, get_group_faces
+from app.data.gallery_matrix import load_gallery
+from app.data.manifest import list_image_files
+from app.runner.index_runner import build_search_engine
+
+RESULT_FIELDS = ("reference", "group_image", "face_id", "box_x", "box_y", "box_w", "box_h", "score")
+RESULT_FORMATS = (".csv", ".json", ".jsonl", ".parquet")
+
+# Upper bound on the number of scores held in memory at once (256 MB of float32)
+MAX_BLOCK_SCORES = 1 << 26
+
+def batch_search_in_group_images(reference_source, output_path, metric="cosine", similarity_threshold=0.8, top_k=None,
+                                 model_name="Facenet", alignment="legacy", batch_size=32, detection_max_side=None,
+                                 block_size=None, quantization="none", rerank=4, pq_subspaces=None,
+                                 shards=0, search_workers=0):
+    """
+    Searches every stored group face for the faces of many reference images in one run.
+
+    References missing from the database are embedded together first. The gallery matrix is
+    loaded once, and the reference x gallery scores are computed blockwise with one matrix product
+    per block of references.
+
+    Args:
+        reference_source (str): A folder of reference images, or a text file listing one image path
+                                per line (relative paths are relative to the text file).
+        output_path (str): Where to write the matches; the format follows the extension
+                           (.csv, .json, .jsonl or .parquet).
+        metric (str): The similarity metric to use ("cosine" or "euclidean").
+        similarity_threshold (float): Threshold a score must pass to count as a match.
+        top_k (int): Keep only the k best matches per reference. None keeps every match.
+        model_name (str): Name of the face recognition model.
+        alignment (str): Alignment the faces are embedded with ("legacy" or "roi").
+        batch_size (int): Number of missing references embedded per forward pass.
+        detection_max_side (int): Longest image side used for detection; larger images are downscaled.
+        block_size (int): Number of references scored per matrix product. Defaults to as many as fit
+                          in MAX_BLOCK_SCORES scores.
+        quantization (str): Search a compressed copy of the gallery: "none", "float16", "int8" or "pq".
+        rerank (int): Number of gallery rows re-ranked exactly per requested result with quantization.
+        pq_subspaces (int): Number of product quantization sub-vectors (bytes) per face.
+        shards (int): Number of gallery shards searched in parallel; 0 or 1 searches the gallery in one piece.
+        search_workers (int): Number of search processes for the shards; 0 uses one per CPU.
+
+    Returns:
+        list: One dict per match, with the RESULT_FIELDS keys.
+
+    Raises:
+        ValueError: If the extension of output_path is not one of RESULT_FORMATS.
+    """
+    if os.path.splitext(output_path)[1].lower() not in RESULT_FORMATS:
+        raise ValueError(f"Unsupported output format for '{output_path}'. Use one of {', '.join(RESULT_FORMATS)}.")
+
+    reference_paths = list_reference_images(reference_source)
+    if not reference_paths:
+        print(f"No reference images found in '{reference_source}'.")
+        return []
+
+    filenames = list(dict.fromkeys(os.path.basename(path) for path in reference_paths))
+    references = get_all_reference_embeddings(model_name, alignment, filenames=filenames)
+    missing = [path for path in reference_paths if os.path.basename(path) not in references]
+    if missing:
+        # Only embedding new references needs the detector and the embedding model
+        from app.runner.add_image_runner import add_reference_images
+
+        print(f"Embedding {len(missing)} reference images not yet in the database...")
+        references.update(add_reference_images(missing, model_name=model_name, batch_size=batch_size,
+                                               detection_max_side=detection_max_side, alignment=alignment))
+    filenames = [filename for filename in filenames if filename in references]
+    if not filenames:
+        print("None of the reference images could be embedded.")
+        return []
+
+    face_ids, group_filenames, matrix, norms = load_gallery(model_name, alignment)
+    if not group_filenames:
+        print(f"No group images embedded with model '{model_name}' ({alignment} alignment) found in the database.")
+        return []
+
+    engine = build_search_engine(group_filenames, matrix, norms, quantization=quantization, rerank=rerank,
+                                 pq_subspaces=pq_subspaces, model_name=model_name, alignment=alignment,
+                                 shards=shards, search_workers=search_workers)
+    queries = np.stack([np.asarray(references[filename], dtype=np.float32) for filename in filenames])
+    block_size = block_size or max(1, MAX_BLOCK_SCORES // len(engine))
+    start = time.perf_counter()
+    matches = engine.search(queries, k=top_k, threshold=similarity_threshold, metric=metric, block_size=block_size)
+    elapsed = time.perf_counter() - start
+
+    faces = get_group_faces({face_ids[index] for reference_matches in matches for index, _ in reference_matches})
+    rows = []
+    for filename, reference_matches in zip(filenames, matches):
+        for index, score in reference_matches:
+            box = faces[face_ids[index]]['box'] or [None] * 4
+            rows.append(dict(zip(RESULT_FIELDS, (filename, group_filenames[index], face_ids[index], *box, score))))
+
+    write_search_results(rows, output_path)
+    print(f"Scored {len(filenames)} references against {len(group_filenames)} group faces in {elapsed:.2f}s. "
+          f"{len(rows)} matches written to '{output_path}'.")
+    return rows
+
+def list_reference_images(reference_source):
+    """
+    Lists the reference image paths of a folder or of a text file with one path per line.
+
+    Args:
+        reference_source (str): The folder or text file.
+
+    Returns:
+        list: Image paths, in folder or file order.
+    """
+    if os.path.isdir(reference_source):
+        from app.converter.convert import supported_extensions
+
+        return [file['abs_path'] for file in list_image_files(reference_source, extensions=supported_extensions())]
+    if not os.path.isfile(reference_source):
+        return []
+
+    base_dir = os.path.dirname(os.path.abspath(reference_source))
+    with open(reference_source, encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base_dir, line) for line in lines if line and not line.startswith('#')]
+
+def write_search_results(rows, output_path):
+    """
+    Writes batch search matches, in the format given by the extension of output_path.
+
+    Args:
+        rows (list): Match dicts with the RESULT_FIELDS keys.
+        output_path (str): A .csv, .json, .jsonl or .parquet file path.
+
+    Raises:
+        ValueError: If the extension is not supported.
+    """
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension == ".csv":
+        with open(output_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    elif extension == ".json":
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, indent=2)
+    elif extension == ".jsonl":
+        with open(output_path, 'w', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+    elif extension == ".parquet":
+        # Parquet needs pandas with a Parquet engine (pyarrow or fastparquet)
+        import pandas as pd
+
+        pd.DataFrame(rows, columns=RESULT_FIELDS).to_parquet(output_path, index=False)
+    else:
+        raise ValueError(f"Unsupported output format '{extension}'. Use .csv, .json, .jsonl or .parquet.")
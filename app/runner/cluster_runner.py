@@ -0,0 +1,91 @@
+import time
+from collections import Counter
+import numpy as np
+from app.core.clustering import cluster_embeddings
+from app.data.database import get_face_clusters, save_face_clusters
+from app.data.gallery_matrix import load_gallery
+
+def cluster_group_faces(similarity_threshold=0.8, metric="cosine", memory_mb=512, rebuild=False, min_cluster_size=2,
+                        model_name="Facenet", alignment="legacy"):
+    """
+    Clusters every stored group face of a model into identities and stores the clusters in the database.
+
+    Faces are linked when their score passes the similarity threshold, and a cluster is a set of
+    faces connected by links. After a first run only the faces added since are scored (against the
+    whole gallery), and merged into the existing clusters; everything is re-clustered when the
+    metric or threshold changed, when clustered faces were removed, or when rebuild is set.
+
+    Args:
+        similarity_threshold (float): Threshold a pair of faces must pass to be linked.
+        metric (str): The similarity metric to use ("cosine" or "euclidean").
+        memory_mb (int): Memory budget for the blocks of scores, in MB.
+        rebuild (bool): If True, re-cluster every face instead of only the new ones.
+        min_cluster_size (int): Clusters with fewer faces are reported as unclustered.
+        model_name (str): Name of the face recognition model.
+        alignment (str): Alignment the faces were embedded with ("legacy" or "roi").
+
+    Returns:
+        dict: Cluster id -> list of (group image filename, face id), for clusters of at least
+              min_cluster_size faces, largest first.
+    """
+    face_ids, filenames, matrix, norms = load_gallery(model_name, alignment)
+    if not filenames:
+        print(f"No group images embedded with model '{model_name}' ({alignment} alignment) found in the database.")
+        return {}
+
+    stored, state = get_face_clusters(model_name, alignment)
+    labels = _existing_labels(face_ids, stored, state, similarity_threshold, metric)
+    if rebuild or labels is None:
+        labels = None
+        print(f"Clustering {len(face_ids)} group faces...")
+    else:
+        print(f"Assigning {len(face_ids) - len(labels)} new group faces to the clusters of {len(labels)} faces...")
+
+    start = time.perf_counter()
+    cluster_ids = cluster_embeddings(matrix, norms, similarity_threshold, metric=metric,
+                                     memory_bytes=int(memory_mb) << 20, labels=labels)
+    elapsed = time.perf_counter() - start
+
+    if labels is None:
+        saved = save_face_clusters(face_ids, cluster_ids, metric, similarity_threshold, model_name, alignment,
+                                   replace=True)
+    else:
+        # Only new faces and faces whose cluster was merged into another one need to be written
+        changed = np.flatnonzero(cluster_ids[:len(labels)] != labels)
+        rows = np.concatenate([changed, np.arange(len(labels), len(face_ids))])
+        saved = save_face_clusters([face_ids[i] for i in rows], cluster_ids[rows], metric, similarity_threshold,
+                                   model_name, alignment)
+    if not saved:
+        return {}
+
+    clusters = {}
+    for row, cluster_id in enumerate(cluster_ids.tolist()):
+        clusters.setdefault(cluster_id, []).append((filenames[row], face_ids[row]))
+    clusters = {cluster_id: faces for cluster_id, faces in sorted(clusters.items(), key=lambda item: -len(item[1]))
+                if len(faces) >= min_cluster_size}
+
+    clustered = sum(len(faces) for faces in clusters.values())
+    print(f"Found {len(clusters)} clusters of at least {min_cluster_size} faces ({clustered} faces, "
+          f"{len(face_ids) - clustered} unclustered) in {elapsed:.2f}s.")
+    for cluster_id, faces in list(clusters.items())[:10]:
+        images = Counter(filename for filename, _ in faces)
+        sample = ", ".join(filename for filename, _ in images.most_common(3))
+        print(f"Cluster {cluster_id}: {len(faces)} faces in {len(images)} images (e.g. {sample})")
+    return clusters
+
+def _existing_labels(face_ids, stored, state, similarity_threshold, metric):
+    """
+    Returns the stored cluster ids of the gallery rows that can be kept, or None if the faces must be
+    re-clustered. Labels can be kept if they were computed with the same parameters, no clustered
+    face was removed since, and the clustered faces come before the new ones in the gallery.
+    """
+    if state is None or state['stale'] or state['metric'] != metric or \
+            not np.isclose(state['threshold'], similarity_threshold):
+        return None
+
+    labelled = 0
+    while labelled < len(face_ids) and face_ids[labelled] in stored:
+        labelled += 1
+    if labelled != len(stored):
+        return None
+    return np.array([stored[face_id] for face_id in face_ids[:labelled]], dtype=np.int64)
@@ -0,0 +1,170 @@
+import time
+from collections import Counter
+import numpy as np
+from app.core.identities import AGGREGATIONS, aggregate_templates, label_faces
+from app.data.database import (add_identity_references, count_identity_faces, get_face_identities, get_identity_faces,
+                               get_identity_references, get_identity_templates, is_reference_image_in_db,
+                               save_face_identities, save_identity_templates)
+from app.data.gallery_matrix import load_gallery
+from app.data.manifest import list_image_files
+
+def add_identities_from_folder(folder_path, model_name="Facenet", batch_size=32, detection_max_side=None,
+                               alignment="legacy"):
+    """
+    Adds the reference images of a folder with one sub-folder per identity, named after the identity.
+
+    The images are stored as reference images under '<identity>/<file>', so that references of
+    different identities never collide, and only those not embedded with the model yet are processed.
+
+    Args:
+        folder_path (str): Path to the folder of identities.
+        model_name (str): Name of the face recognition model.
+        batch_size (int): Number of faces embedded per forward pass.
+        detection_max_side (int): Longest image side used for detection; larger images are downscaled.
+        alignment (str): "legacy" or "roi" (see add_group_image).
+
+    Returns:
+        dict: Identity name -> number of its reference images.
+    """
+    from app.converter.convert import supported_extensions
+    from app.runner.add_image_runner import add_reference_images
+
+    identities = {}
+    for file in list_image_files(folder_path, recursive=True, extensions=supported_extensions()):
+        if '/' in file['rel_path']:
+            identities.setdefault(file['rel_path'].split('/', 1)[0], []).append(file)
+    if not identities:
+        print(f"No identity sub-folders with images found in '{folder_path}'.")
+        return {}
+
+    missing = [file for files in identities.values() for file in files
+               if not is_reference_image_in_db(file['rel_path'], model_name, alignment)]
+    if missing:
+        add_reference_images([file['abs_path'] for file in missing], model_name=model_name, batch_size=batch_size,
+                             detection_max_side=detection_max_side, alignment=alignment,
+                             filenames=[file['rel_path'] for file in missing])
+    for name, files in identities.items():
+        add_identity_references(name, [file['rel_path'] for file in files])
+    print(f"Found {len(identities)} identities with {sum(len(files) for files in identities.values())} "
+          f"reference images ({len(missing)} new).")
+    return {name: len(files) for name, files in identities.items()}
+
+def refresh_identity_templates(aggregation="mean", count=1, model_name="Facenet", alignment="legacy"):
+    """
+    Aggregates the reference embeddings of every identity into templates, and stores them if they changed.
+
+    Storing new templates invalidates the face labels computed from the previous ones, so they are
+    only replaced when an identity gained or lost references, or the aggregation settings changed.
+
+    Args:
+        aggregation (str): "mean" or "medoid" (see aggregate_templates).
+        count (int): Number of templates per identity.
+        model_name (str): Name of the face recognition model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        tuple: (template_identities, templates, names) as returned by get_identity_templates.
+    """
+    references = get_identity_references(model_name, alignment)
+    templates = {identity_id: aggregate_templates(embeddings, aggregation, count)
+                 for identity_id, (_, embeddings) in references.items()}
+    stored_identities, stored, names = get_identity_templates(model_name, alignment)
+    if templates:
+        identities = np.concatenate([np.full(len(rows), identity_id) for identity_id, rows in templates.items()])
+        matrix = np.concatenate(list(templates.values()))
+        if matrix.shape != stored.shape or not np.array_equal(identities, stored_identities) or \
+                not np.allclose(matrix, stored, atol=1e-6):
+            print(f"Aggregating the references of {len(templates)} identities into {len(matrix)} templates...")
+            if save_identity_templates(templates, model_name, alignment):
+                return get_identity_templates(model_name, alignment)
+    return stored_identities, stored, names
+
+def label_group_faces(aggregation="mean", templates_per_identity=1, similarity_threshold=0.8, metric="cosine",
+                      memory_mb=256, rebuild=False, model_name="Facenet", alignment="legacy"):
+    """
+    Labels every stored group face of a model with its best-matching identity and stores the labels.
+
+    Every face is scored against every identity template in blocks of faces, one matrix product per
+    block. After a first run only the faces added since are scored; every face is relabelled when the
+    templates or the metric changed, or when rebuild is set. The labels keep the best identity and its
+    score even when it does not pass the threshold, so lookups can use another threshold later.
+
+    Args:
+        aggregation (str): "mean" or "medoid" (see aggregate_templates).
+        templates_per_identity (int): Number of templates per identity.
+        similarity_threshold (float): Threshold reported faces must pass (see search_in_group_images).
+        metric (str): The similarity metric to use ("cosine" or "euclidean").
+        memory_mb (int): Memory budget for a block of faces and its scores, in MB.
+        rebuild (bool): If True, relabel every face instead of only the new ones.
+        model_name (str): Name of the face recognition model.
+        alignment (str): Alignment the faces were embedded with ("legacy" or "roi").
+
+    Returns:
+        dict: Identity name -> number of labelled faces passing the threshold.
+    """
+    if aggregation not in AGGREGATIONS:
+        print(f"Error: Invalid TEMPLATE_AGGREGATION '{aggregation}'. Use one of {', '.join(AGGREGATIONS)}.")
+        return {}
+    template_identities, templates, names = refresh_identity_templates(aggregation, templates_per_identity,
+                                                                       model_name, alignment)
+    if not len(templates):
+        print(f"No identities embedded with model '{model_name}' ({alignment} alignment) found in the database.")
+        return {}
+    face_ids, filenames, matrix, norms = load_gallery(model_name, alignment)
+    if not filenames:
+        print(f"No group images embedded with model '{model_name}' ({alignment} alignment) found in the database.")
+        return {}
+
+    labelled, state = get_face_identities(model_name, alignment)
+    replace = rebuild or state['labels_version'] != state['version'] or state['metric'] != metric
+    rows = np.arange(len(face_ids)) if replace else \
+        np.array([row for row, face_id in enumerate(face_ids) if face_id not in labelled], dtype=np.int64)
+    print(f"Labelling {len(rows)} group faces with {len(names)} identities ({len(templates)} templates)...")
+
+    start = time.perf_counter()
+    if len(rows) == len(face_ids):
+        identities, scores = label_faces(matrix, norms, templates, template_identities, metric=metric,
+                                         memory_bytes=int(memory_mb) << 20)
+    else:
+        identities, scores = label_faces(matrix[rows], norms[rows], templates, template_identities, metric=metric,
+                                         memory_bytes=int(memory_mb) << 20)
+    elapsed = time.perf_counter() - start
+    if not save_face_identities([face_ids[row] for row in rows], identities, scores, metric, state['version'],
+                                model_name, alignment, replace=replace):
+        return {}
+
+    counts = Counter(count_identity_faces(similarity_threshold, metric, model_name, alignment))
+    print(f"Labelled {len(rows)} group faces in {elapsed:.2f}s; {sum(counts.values())} of {len(face_ids)} "
+          f"match an identity.")
+    for name, count in counts.most_common(10):
+        print(f"{name}: {count} faces")
+    return dict(counts)
+
+def find_identity_photos(name, similarity_threshold=0.8, metric="cosine", model_name="Facenet", alignment="legacy"):
+    """
+    Prints the group images containing an identity, from the stored face labels.
+
+    Args:
+        name (str): Name of the identity.
+        similarity_threshold (float): Threshold a face's score must pass.
+        metric (str): Similarity metric the faces were labelled with.
+        model_name (str): Name of the face recognition model.
+        alignment (str): Alignment the faces were embedded with.
+
+    Returns:
+        list: (group image filename, face id, face box, score) tuples, best first.
+    """
+    _, state = get_face_identities(model_name, alignment)
+    if state is None or state['labels_version'] is None:
+        print("No face labels found. Run MODE=identify without IDENTITY_NAME first.")
+        return []
+    if state['metric'] != metric:
+        print(f"Note: the faces were labelled with the {state['metric']} metric, not {metric}.")
+        metric = state['metric']
+
+    faces = get_identity_faces(name, similarity_threshold, metric, model_name, alignment)
+    images = dict.fromkeys(filename for filename, _, _, _ in faces)
+    print(f"'{name}' appears in {len(images)} group images ({len(faces)} faces).")
+    for filename, _, box, score in faces:
+        print(f"{filename}: face {box} ({metric} {score:.4f})")
+    return faces
@@ -0,0 +1,227 @@
+import time
+import numpy as np
+from app.core.ann_index import IVFIndex
+from app.core.quantization import QUANTIZATION_MODES, QuantizedGallery, QuantizedSearchEngine
+from app.core.sharded_search import ShardedSearchEngine
+from app.core.similarity_matching import GallerySearchEngine
+from app.data.gallery_matrix import (load_gallery, load_ivf_index, save_ivf_index, append_ivf_assignments,
+                                     load_quantized_arrays, save_quantized_arrays, append_quantized_arrays,
+                                     load_shards, save_shards, append_shard_rows)
+
+def build_ann_index(nlist=None, iterations=10, model_name="Facenet", alignment="legacy"):
+    """
+    Trains the IVF index over a model's stored group face embeddings and persists it next to the database.
+
+    Args:
+        nlist (int): Number of cells. Defaults to 4 * sqrt(number of group faces).
+        iterations (int): Number of k-means iterations.
+        model_name (str): Name of the face recognition model whose gallery is indexed.
+        alignment (str): Alignment the gallery faces were embedded with.
+
+    Returns:
+        IVFIndex or None: The built index, or None if the gallery is empty.
+    """
+    _, filenames, matrix, _ = load_gallery(model_name, alignment)
+    if not filenames:
+        print("No group images found in the database.")
+        return None
+
+    print(f"Building IVF index over {len(filenames)} group faces...")
+    index = IVFIndex.train(matrix, nlist=nlist, iterations=iterations)
+    save_ivf_index(index.centroids, index.assignments, model_name, alignment)
+    print(f"IVF index built with {index.nlist} cells.")
+    return index
+
+def load_ann_index(matrix, nlist=None, model_name="Facenet", alignment="legacy"):
+    """
+    Loads the IVF index for the given gallery matrix, building it if needed.
+
+    Rows appended to the gallery while the index was not maintained are assigned to their cells here.
+
+    Args:
+        matrix (np.array): The gallery matrix returned by load_gallery().
+        nlist (int): Number of cells to use if the index has to be built.
+        model_name (str): Name of the face recognition model the gallery belongs to.
+        alignment (str): Alignment the gallery faces were embedded with.
+
+    Returns:
+        IVFIndex: An index covering every gallery row.
+    """
+    stored = load_ivf_index(model_name=model_name, alignment=alignment)
+    if stored is None:
+        print("No IVF index found for the current gallery. Building it now...")
+        index = IVFIndex.train(matrix, nlist=nlist)
+        save_ivf_index(index.centroids, index.assignments, model_name, alignment)
+        return index
+
+    index = IVFIndex(*stored)
+    if len(index) < len(matrix):
+        new_assignments = index.assign(matrix[len(index):])
+        append_ivf_assignments(new_assignments, model_name, alignment)
+        index.add(new_assignments)
+    return index
+
+def add_to_ann_index(embeddings, model_name="Facenet", alignment="legacy"):
+    """
+    Assigns the group faces just appended to the gallery matrix to their IVF cells, if an index exists.
+
+    Args:
+        embeddings (np.array): (M, D) face embedding vectors of the last M gallery rows.
+        model_name (str): Name of the face recognition model the gallery belongs to.
+        alignment (str): Alignment the gallery faces were embedded with.
+    """
+    stored = load_ivf_index(with_assignments=False, model_name=model_name, alignment=alignment)
+    if stored is None:
+        return
+
+    centroids = stored[0]
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, centroids.shape[1])
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    index = IVFIndex(centroids, [])
+    append_ivf_assignments(index.assign(embeddings / np.where(norms > 0, norms, 1)), model_name, alignment)
+
+def load_quantized_gallery(matrix, mode, pq_subspaces=None, model_name="Facenet", alignment="legacy"):
+    """
+    Loads the compressed copy of the given gallery matrix, encoding it if needed.
+
+    Rows appended to the gallery since it was encoded are compressed here. The gallery is re-encoded
+    if it is missing or was encoded with another number of PQ subspaces.
+
+    Args:
+        matrix (np.array): The gallery matrix returned by load_gallery().
+        mode (str): "float16", "int8" or "pq".
+        pq_subspaces (int): Number of PQ sub-vectors per row. Defaults to D / 8, or the stored value.
+        model_name (str): Name of the face recognition model the gallery belongs to.
+        alignment (str): Alignment the gallery faces were embedded with.
+
+    Returns:
+        QuantizedGallery: A compressed gallery covering every gallery row.
+    """
+    arrays = load_quantized_arrays(mode, model_name, alignment)
+    if arrays is not None and mode == "pq" and pq_subspaces and len(arrays['codebooks']) != pq_subspaces:
+        arrays = None
+    if arrays is None:
+        print(f"Encoding the gallery as {mode}...")
+        quantized = QuantizedGallery.encode(matrix, mode, subspaces=pq_subspaces)
+        save_quantized_arrays(mode, quantized.arrays, model_name, alignment)
+        return quantized
+
+    quantized = QuantizedGallery(mode, arrays)
+    if len(quantized) < len(matrix):
+        new_rows = quantized.encode_rows(matrix[len(quantized):])
+        append_quantized_arrays(mode, new_rows, model_name, alignment)
+        quantized.add(new_rows)
+    return quantized
+
+def load_gallery_shards(matrix, norms, filenames, shards, model_name="Facenet", alignment="legacy"):
+    """
+    Loads the shards of the given gallery matrix, splitting it if needed.
+
+    Rows appended to the gallery while the shards were not maintained are routed to their shards here.
+    An existing split into another number of shards is kept: changing it rewrites every shard, which
+    is left to rebalance_shards.
+
+    Args:
+        matrix (np.array): The gallery matrix returned by load_gallery().
+        norms (np.array): The gallery norms returned by load_gallery().
+        filenames (list): The gallery's group image filenames, in row order.
+        shards (int): Number of shards to split the gallery into if it is not split yet.
+        model_name (str): Name of the face recognition model the gallery belongs to.
+        alignment (str): Alignment the gallery faces were embedded with.
+
+    Returns:
+        list: Descriptors of shards covering every gallery row (see ShardedSearchEngine).
+    """
+    stored = load_shards(model_name, alignment)
+    if stored is None:
+        print(f"Splitting the gallery into {shards} shards...")
+        save_shards(shards, matrix, norms, filenames, model_name, alignment)
+        return load_shards(model_name, alignment)[0]
+
+    descriptors, count = stored
+    if len(descriptors) != shards:
+        print(f"Note: the gallery is split into {len(descriptors)} shards, not {shards}. "
+              f"Run MODE=shard to rebalance it.")
+    if count < len(matrix):
+        append_shard_rows(filenames[count:], matrix[count:], norms[count:], model_name, alignment)
+        descriptors = load_shards(model_name, alignment)[0]
+    return descriptors
+
+def add_to_shards(filenames, embeddings, model_name="Facenet", alignment="legacy"):
+    """
+    Routes the group faces just appended to the gallery matrix to the shards of their images, if it is sharded.
+
+    Args:
+        filenames (list): Group image filename of each of the last M gallery rows.
+        embeddings (np.array): (M, D) face embedding vectors of these rows.
+        model_name (str): Name of the face recognition model the gallery belongs to.
+        alignment (str): Alignment the gallery faces were embedded with.
+    """
+    append_shard_rows(filenames, embeddings, model_name=model_name, alignment=alignment)
+
+def rebalance_shards(shards, model_name="Facenet", alignment="legacy"):
+    """
+    Splits a model's gallery into a new number of shards, offline.
+
+    Every row is reassigned by the hash of its image, and the previous shard files are removed once
+    the new split is committed. Searches keep using the previous split until then.
+
+    Args:
+        shards (int): Number of shards, at least 2.
+        model_name (str): Name of the face recognition model whose gallery is split.
+        alignment (str): Alignment the gallery faces were embedded with.
+
+    Returns:
+        list or None: Descriptors of the new shards, or None if nothing was split.
+    """
+    if shards < 2:
+        print(f"Error: GALLERY_SHARDS must be at least 2 to shard the gallery (got {shards}).")
+        return None
+    _, filenames, matrix, norms = load_gallery(model_name, alignment)
+    if not filenames:
+        print("No group images found in the database.")
+        return None
+
+    start = time.perf_counter()
+    save_shards(shards, matrix, norms, filenames, model_name, alignment)
+    descriptors = load_shards(model_name, alignment)[0]
+    counts = [shard['count'] for shard in descriptors]
+    print(f"Gallery of {len(filenames)} faces split into {shards} shards of {min(counts)} to {max(counts)} faces "
+          f"in {time.perf_counter() - start:.1f}s.")
+    return descriptors
+
+def build_search_engine(ids, matrix, norms, quantization="none", rerank=4, pq_subspaces=None, model_name="Facenet",
+                        alignment="legacy", shards=0, search_workers=0):
+    """
+    Builds the engine searching a gallery, on its compressed copy when quantization is enabled, or on
+    its shards in parallel when sharding is enabled.
+
+    Args:
+        ids (list): Identifiers for the gallery rows (the group image filenames), in row order.
+        matrix (np.array): The gallery matrix returned by load_gallery().
+        norms (np.array): The gallery norms returned by load_gallery().
+        quantization (str): "none", "float16", "int8" or "pq".
+        rerank (int): Number of rows re-ranked exactly per requested result (top-k searches).
+        pq_subspaces (int): Number of PQ sub-vectors per row (see load_quantized_gallery).
+        model_name (str): Name of the face recognition model the gallery belongs to.
+        alignment (str): Alignment the gallery faces were embedded with.
+        shards (int): Number of shards searched in parallel; 0 or 1 searches the gallery in one piece.
+                      Shards hold full-precision rows, so quantization does not apply to them.
+        search_workers (int): Number of search processes for the shards; 0 uses one per CPU.
+
+    Returns:
+        GallerySearchEngine: The engine; a ShardedSearchEngine with shards, otherwise a
+                             QuantizedSearchEngine unless quantization is "none".
+    """
+    if quantization not in QUANTIZATION_MODES:
+        print(f"Error: Invalid GALLERY_QUANTIZATION '{quantization}'. Use one of {', '.join(QUANTIZATION_MODES)}.")
+        quantization = "none"
+    if shards > 1 and len(matrix):
+        if quantization != "none":
+            print("Note: GALLERY_QUANTIZATION is not applied to a sharded gallery.")
+        descriptors = load_gallery_shards(matrix, norms, ids, shards, model_name, alignment)
+        return ShardedSearchEngine(ids, matrix, norms, descriptors, workers=search_workers)
+    if quantization == "none" or len(matrix) == 0:
+        return GallerySearchEngine(ids, matrix, norms=norms)
+    quantized = load_quantized_gallery(matrix, quantization, pq_subspaces, model_name, alignment)
+    return QuantizedSearchEngine(ids, matrix, norms, quantized, rerank=rerank)
@@ -0,0 +1,170 @@
+import multiprocessing as mp
+import queue
+import threading
+import time
+from app.converter.convert import load_image, supported_extensions
+from app.core import metrics
+from app.core.feature_extraction import extract_face_embeddings
+from app.core.face_detector import detector_version
+from app.core.model_registry import warm_up
+from app.data.manifest import scan_folder
+from app.runner.add_image_runner import alignment_size, detect_and_align_faces, files_missing_embeddings, group_image_writer
+
+def add_group_images_pipelined(folder_path, model_name="Facenet", decode_workers=2, inference_workers=2,
+                               queue_size=16, batch_size=32, report_interval=5.0, recursive=False,
+                               detection_max_side=None, alignment="legacy", detection_tiling=None):
+    """
+    Adds the group images of a folder with a multi-process pipeline.
+
+    Decode processes read the files, inference processes (each holding its own warm detector and
+    embedding model) detect, align and embed the faces, and the calling process is the single
+    database writer. Stages are connected by bounded queues so memory stays flat on large folders.
+    Images already stored whose faces have no embedding for this model yet go through the same
+    pipeline, but their stored detections are aligned instead of detecting the faces again.
+
+    Args:
+        folder_path (str): Path to the folder of group images.
+        model_name (str): Name of the face recognition model.
+        decode_workers (int): Number of decode processes (at least 1).
+        inference_workers (int): Number of detection/alignment/embedding processes.
+        queue_size (int): Maximum number of images waiting between two stages.
+        batch_size (int): Number of faces per embedding forward pass.
+        report_interval (float): Seconds between two throughput reports.
+        recursive (bool): If True, also add the images of all sub-folders.
+        detection_max_side (int): Longest image side used for detection; larger images are downscaled.
+        alignment (str): "legacy" or "roi" (see add_group_image).
+        detection_tiling (dict): tile_size, tile_overlap and tile_workers of tiled detection (see detect_faces).
+    """
+    if decode_workers < 1 or inference_workers < 1:
+        print(f"Error: Pipelined ingestion needs at least one decode and one inference worker "
+              f"(got DECODE_WORKERS={decode_workers}, INFERENCE_WORKERS={inference_workers}).")
+        return
+
+    new_files, total = scan_folder(folder_path, recursive=recursive, extensions=supported_extensions())
+    if not total:
+        print(f"No images found in folder '{folder_path}'.")
+        return
+
+    print(f"Adding {len(new_files)} new or changed images from folder '{folder_path}' "
+          f"({total - len(new_files)} unchanged)...")
+    detector = detector_version(detection_max_side, detection_tiling)
+    cached_files = files_missing_embeddings(folder_path, new_files, model_name, alignment, detector)
+    if cached_files:
+        print(f"Embedding the stored faces of {len(cached_files)} images with model '{model_name}' "
+              f"({sum(1 for file in cached_files if file.get('replace'))} detected again)...")
+    pending = new_files + cached_files
+    if not pending:
+        return
+
+    # TensorFlow is not fork-safe, so workers are always spawned
+    ctx = mp.get_context("spawn")
+    path_queue = ctx.Queue()
+    decoded_queue = ctx.Queue(maxsize=queue_size)
+    result_queue = ctx.Queue(maxsize=queue_size)
+    for file in pending:
+        path_queue.put(file)
+    for _ in range(decode_workers):
+        path_queue.put(None)
+
+    # Spawned workers start with metrics disabled, so they are handed this process's settings
+    metrics_settings = metrics.settings()
+    decoders = [ctx.Process(target=_decode_worker, args=(path_queue, decoded_queue, result_queue, metrics_settings),
+                            daemon=True)
+                for _ in range(decode_workers)]
+    inference_args = (decoded_queue, result_queue, model_name, batch_size, detection_max_side, alignment,
+                      detection_tiling, metrics_settings)
+    inferers = [ctx.Process(target=_inference_worker, args=inference_args, daemon=True)
+                for _ in range(inference_workers)]
+    for process in decoders + inferers:
+        process.start()
+
+    # Once every decoder is done, tell each inference worker to stop
+    def _close_decoded_queue():
+        for process in decoders:
+            process.join()
+        for _ in range(inference_workers):
+            decoded_queue.put(None)
+    threading.Thread(target=_close_decoded_queue, daemon=True).start()
+
+    start = last_report = time.perf_counter()
+    done = faces = finished_workers = 0
+    with group_image_writer(model_name, alignment) as writer:
+        while finished_workers < inference_workers:
+            try:
+                item = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not any(process.is_alive() for process in inferers):
+                    print("Inference workers exited unexpectedly. Stopping ingestion.")
+                    break
+                continue
+            if item is None:
+                finished_workers += 1
+                continue
+
+            file, results, embeddings, error = item
+            done += 1
+            if error:
+                print(error)
+            elif 'faces' in file:
+                # Stored image: only the embeddings of this model are new
+                writer.add_face_embeddings(file['path'], [face['id'] for face in results], embeddings)
+                faces += len(results)
+            else:
+                if not results:
+                    # Images without faces are only recorded in the manifest, so re-scans skip them
+                    print(f"No face detected in {file['abs_path']}.")
+                if results or file.get('replace'):
+                    # Re-detected images are stored anyway, to replace the faces of the previous detector
+                    writer.add_group_image(file['path'], [dict(face, embedding=embedding) for face, embedding
+                                                          in zip(results, embeddings)],
+                                           content_hash=file['content_hash'], detector=detector)
+                    faces += len(results)
+                writer.add_manifest_entries([file])
+
+            now = time.perf_counter()
+            if now - last_report >= report_interval:
+                last_report = now
+                print(f"Processed {done}/{len(pending)} images ({done / (now - start):.1f} images/sec).")
+
+    for process in inferers:
+        process.join()
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"Finished adding images from '{folder_path}': {done} images, {faces} faces in {elapsed:.1f}s "
+          f"({done / elapsed:.1f} images/sec).")
+
+def _decode_worker(path_queue, decoded_queue, result_queue, metrics_settings):
+    metrics.configure(**metrics_settings)
+    while True:
+        file = path_queue.get()
+        if file is None:
+            break
+        img = load_image(file['abs_path'])
+        if img is None:
+            result_queue.put((file, None, None, f"Unable to read image: {file['abs_path']}"))
+        else:
+            decoded_queue.put((file, img))
+
+def _inference_worker(decoded_queue, result_queue, model_name, batch_size, detection_max_side, alignment,
+                      detection_tiling, metrics_settings):
+    metrics.configure(**metrics_settings)
+    warm_up(model_names=[model_name])
+    align_size = alignment_size(model_name, alignment)
+    while True:
+        item = decoded_queue.get()
+        if item is None:
+            result_queue.put(None)
+            break
+
+        file, img = item
+        try:
+            results, aligned_faces = detect_and_align_faces(img, detection_max_side=detection_max_side,
+                                                            align_size=align_size, faces=file.get('faces'),
+                                                            detection_tiling=detection_tiling)
+            if not results:
+                result_queue.put((file, [], [], None))
+                continue
+            embeddings = extract_face_embeddings(aligned_faces, model_name=model_name, batch_size=batch_size)
+            result_queue.put((file, results, embeddings, None))
+        except Exception as e:
+            result_queue.put((file, None, None, f"Error processing '{file['path']}': {e}"))
@@ -1,27 +1,92 @@
-from app.data.database import get_reference_embedding, get_all_group_embeddings 
-from app.core.similarity_matching import match_embeddings
+from app.data.database import get_reference_embedding, get_group_faces, get_video_tracks
+from app.data.gallery_matrix import load_gallery
+from app.runner.index_runner import build_search_engine, load_ann_index
 
-def search_in_group_images(image_path, metric="cosine", similarity_threshold=0.8):
+def search_in_group_images(image_path, metric="cosine", similarity_threshold=0.8, use_ann=False, nprobe=8, nlist=None,
+                           model_name="Facenet", alignment="legacy", quantization="none", rerank=4, pq_subspaces=None,
+                           shards=0, search_workers=0):
+    """
+    Searches every stored group face for the face of a stored reference image.
+
+    Only embeddings produced by the same model and alignment are compared: the reference embedding
+    and the gallery matrix are both looked up by (model_name, alignment).
+
+    Args:
+        image_path (str): Path to the reference image.
+        metric (str): The similarity metric to use ("cosine" or "euclidean").
+        similarity_threshold (float): Threshold a score must pass to count as a match.
+        use_ann (bool): If True, only score the shortlist returned by the IVF index.
+        nprobe (int): Number of IVF cells scanned per query; higher values trade latency for recall.
+        nlist (int): Number of IVF cells if the index has to be built.
+        model_name (str): Name of the face recognition model.
+        alignment (str): Alignment the faces were embedded with ("legacy" or "roi").
+        quantization (str): Search a compressed copy of the gallery: "none", "float16", "int8" or "pq".
+        rerank (int): Number of gallery rows re-ranked exactly per requested result with quantization.
+        pq_subspaces (int): Number of product quantization sub-vectors (bytes) per face.
+        shards (int): Number of gallery shards searched in parallel; 0 or 1 searches the gallery in one piece.
+        search_workers (int): Number of search processes for the shards; 0 uses one per CPU.
+
+    Returns:
+        list: (group image filename, face box, score) hits, in gallery order.
+    """
     print("Processing group images from the database...")
 
-    # Fetch group images and their embeddings from the database
-    group_embeddings = get_all_group_embeddings()
-    if not group_embeddings:
-        print("No group images found in the database.")
-        return
+    # Open the memory-mapped gallery matrix (rebuilt from the database if it is stale)
+    face_ids, filenames, matrix, norms = load_gallery(model_name, alignment)
+    if not filenames:
+        print(f"No group images embedded with model '{model_name}' ({alignment} alignment) found in the database.")
+        return []
 
     # Fetch reference embedding from the database
-    reference_embedding = get_reference_embedding(image_path)
+    reference_embedding = get_reference_embedding(image_path, model_name, alignment)
     if reference_embedding is None:
         print(f"No reference embedding found for {image_path}.")
-        return
+        return []
+
+    # Score all group images against the reference embedding in one matrix product,
+    # or only the rows of the closest IVF cells when the ANN index is enabled
+    # The IVF shortlist is scored on the full-precision rows, so quantization and shards only apply without it
+    engine = build_search_engine(filenames, matrix, norms, quantization="none" if use_ann else quantization,
+                                 rerank=rerank, pq_subspaces=pq_subspaces, model_name=model_name, alignment=alignment,
+                                 shards=0 if use_ann else shards, search_workers=search_workers)
+    if use_ann:
+        index = load_ann_index(matrix, nlist=nlist, model_name=model_name, alignment=alignment)
+        matches = index.search(engine, reference_embedding, nprobe=nprobe, threshold=similarity_threshold, metric=metric)
+    else:
+        matches = engine.search(reference_embedding, threshold=similarity_threshold, metric=metric)[0]
 
-    # Compare all group images with the reference embedding
-    matches = match_embeddings(group_embeddings, reference_embedding, metric=metric, threshold=similarity_threshold)
+    hits = describe_matches(face_ids, filenames, matches)
 
-    if matches:
-        for group_filename, score in matches.items():
-            print(f"Match found: {group_filename} ↔ {image_path} (Score: {score:.2f})")
+    if hits:
+        # Faces of videos are face tracks, reported with the time range they appear in
+        tracks = get_video_tracks([face_ids[index] for index, _ in matches])
+        for (index, _), (group_filename, box, score) in zip(matches, hits):
+            if face_ids[index] in tracks:
+                start_ms, end_ms = tracks[face_ids[index]]
+                print(f"Match found: {group_filename} [{_timestamp(start_ms)}-{_timestamp(end_ms)}] ↔ {image_path} "
+                      f"(Score: {score:.2f})")
+            else:
+                print(f"Match found: {group_filename} [face box: {box}] ↔ {image_path} (Score: {score:.2f})")
     else:
         print(f"No matches found for {image_path}.")
-        
\ No newline at end of file
+    return hits
+
+def describe_matches(face_ids, filenames, matches):
+    """
+    Looks up the group image and face box of gallery matches.
+
+    Args:
+        face_ids (list): The gallery's group_faces ids, in row order (as returned by load_gallery()).
+        filenames (list): The gallery's group image filenames, in row order.
+        matches (list): (row index, score) tuples, as returned by GallerySearchEngine.search.
+
+    Returns:
+        list: (group image filename, face box, score) hits, in the order of matches.
+    """
+    faces = get_group_faces([face_ids[index] for index, _ in matches])
+    return [(filenames[index], faces[face_ids[index]]['box'], score) for index, score in matches]
+
+def _timestamp(ms):
+    """Formats a video position in milliseconds as m:ss.s."""
+    minutes, seconds = divmod(ms / 1000, 60)
+    return f"{int(minutes)}:{seconds:04.1f}"
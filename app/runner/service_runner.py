@@ -0,0 +1,349 @@
+import asyncio
+import math
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+import numpy as np
+from app.converter.convert import load_image
+from app.core.face_detector import detector_version
+from app.core.feature_extraction import extract_face_embeddings
+from app.core.model_registry import warm_up
+from app.data.database import get_gallery_state, get_reference_embedding, insert_reference_image
+from app.data.gallery_matrix import load_gallery
+from app.data.manifest import image_key
+from app.runner.add_image_runner import alignment_size, detect_and_align_faces, store_group_image
+from app.runner.index_runner import build_search_engine
+from app.runner.search_runner import describe_matches
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into batches that are processed by a single function call.
+
+    A batch is closed once `max_batch_size` requests are queued or `max_wait` seconds have passed
+    since its first request, and is processed in the executor while the next batch fills up.
+
+    Args:
+        process_batch (callable): Called with a list of requests; returns one result per request.
+                                  A result that is an Exception is raised to its caller.
+        executor (concurrent.futures.Executor): Executor the batches are processed in.
+        max_batch_size (int): Maximum number of requests per batch.
+        max_wait (float): Maximum time in seconds the first request of a batch waits for others.
+    """
+
+    def __init__(self, process_batch, executor, max_batch_size=16, max_wait=0.005):
+        self.process_batch = process_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = asyncio.Queue()
+
+    async def submit(self, request):
+        """Queues a request and waits for its result."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((request, future))
+        return await future
+
+    async def run(self):
+        """Processes batches until cancelled."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch, [r for r, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+class RecognitionService:
+    """
+    Keeps the detector, the embedding model and the gallery matrix resident and serves add and
+    search requests, embedding the faces of all requests in a micro-batch with one forward pass.
+
+    Args:
+        model_name (str): Name of the face recognition model.
+        alignment (str): "legacy" or "roi" (see add_group_image).
+        detection_max_side (int): Longest image side used for detection; larger images are downscaled.
+        metric (str): The similarity metric to use ("cosine" or "euclidean").
+        similarity_threshold (float): Default threshold a score must pass to count as a match.
+        max_batch_size (int): Maximum number of requests per micro-batch.
+        max_wait_ms (float): Maximum time a request waits for others to join its micro-batch.
+        quantization (str): Search a compressed copy of the gallery: "none", "float16", "int8" or "pq".
+        rerank (int): Number of gallery rows re-ranked exactly per requested result with quantization.
+        pq_subspaces (int): Number of product quantization sub-vectors (bytes) per face.
+        shards (int): Number of gallery shards searched in parallel; 0 or 1 searches the gallery in one piece.
+        search_workers (int): Number of search processes for the shards; 0 uses one per CPU.
+        detection_tiling (dict): tile_size, tile_overlap and tile_workers of tiled detection (see detect_faces).
+    """
+
+    def __init__(self, model_name="Facenet", alignment="legacy", detection_max_side=None, metric="cosine",
+                 similarity_threshold=0.8, max_batch_size=16, max_wait_ms=5.0, quantization="none", rerank=4,
+                 pq_subspaces=None, shards=0, search_workers=0, detection_tiling=None):
+        self.model_name = model_name
+        self.alignment = alignment
+        self.detection_max_side = detection_max_side
+        self.metric = metric
+        self.similarity_threshold = similarity_threshold
+        self.quantization = quantization
+        self.rerank = rerank
+        self.pq_subspaces = pq_subspaces
+        self.shards = shards
+        self.search_workers = search_workers
+        self.detection_tiling = detection_tiling
+        # A single worker thread owns the models and the database connection
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batcher = MicroBatcher(self._process_batch, self.executor, max_batch_size, max_wait_ms / 1000.0)
+        self._gallery = None
+        self._align_size = None
+
+    def warm_up(self):
+        """Builds the models and opens the gallery matrix before the first request."""
+        warm_up(model_names=[self.model_name])
+        self._align_size = alignment_size(self.model_name, self.alignment)
+        self._current_gallery()
+
+    async def handle(self, method, path, body):
+        """
+        Handles one HTTP request.
+
+        Returns:
+            tuple: (HTTP status, JSON-serializable payload).
+        """
+        if method == "GET" and path == "/health":
+            return HTTPStatus.OK, {'status': 'ok', 'model_name': self.model_name, 'alignment': self.alignment}
+        if method != "POST" or path not in ("/search", "/add"):
+            return HTTPStatus.NOT_FOUND, {'error': f"Unknown endpoint {method} {path}."}
+
+        try:
+            request = json.loads(body or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("The request body must be a JSON object.")
+            request['op'] = path.lstrip("/")
+            _validate(request, self.metric)
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, {'error': str(e)}
+
+        try:
+            return HTTPStatus.OK, await self.batcher.submit(request)
+        except ValueError as e:
+            return HTTPStatus.UNPROCESSABLE_ENTITY, {'error': str(e)}
+        except Exception as e:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)}
+
+    def _process_batch(self, requests):
+        """Detects, aligns and embeds the faces of a micro-batch, then answers each request."""
+        results = [None] * len(requests)
+        queries = {}
+        pending = []
+        for i, request in enumerate(requests):
+            try:
+                if request['op'] == "search" and request.get('reference'):
+                    embedding = get_reference_embedding(request['reference'], self.model_name, self.alignment)
+                    if embedding is None:
+                        raise ValueError(f"Reference image '{request['reference']}' is not in the database.")
+                    queries[i] = embedding
+                    continue
+
+                img = load_image(request['image_path'])
+                if img is None:
+                    raise ValueError(f"Unable to read image: {request['image_path']}")
+                faces, aligned_faces = detect_and_align_faces(img, detection_max_side=self.detection_max_side,
+                                                              align_size=self._align_size,
+                                                              detection_tiling=self.detection_tiling)
+                if not faces:
+                    raise ValueError(f"No face detected in {request['image_path']}.")
+                # References and search queries only use their first face
+                if request['op'] == "search" or request.get('type') == "ref":
+                    faces, aligned_faces = faces[:1], aligned_faces[:1]
+                pending.append((i, faces, aligned_faces))
+            except Exception as e:
+                results[i] = e
+
+        if pending:
+            aligned_faces = [face for _, _, aligned in pending for face in aligned]
+            try:
+                embeddings = extract_face_embeddings(aligned_faces, model_name=self.model_name,
+                                                     batch_size=len(aligned_faces))
+            except Exception as e:
+                for i, _, _ in pending:
+                    results[i] = e
+                return results
+
+            offset = 0
+            for i, faces, _ in pending:
+                face_embeddings = embeddings[offset:offset + len(faces)]
+                offset += len(faces)
+                if requests[i]['op'] == "search":
+                    queries[i] = face_embeddings[0]
+                else:
+                    results[i] = self._store(requests[i], faces, face_embeddings)
+
+        if queries:
+            for i, result in zip(queries, self._search(requests, queries)):
+                results[i] = result
+        return results
+
+    def _store(self, request, faces, embeddings):
+        # Reference images are stored under their basename, group images under their key (see image_key)
+        filename = request.get('filename') or (os.path.basename(request['image_path']) if request.get('type') == "ref"
+                                               else image_key(request['image_path']))
+        try:
+            if request.get('type') == "ref":
+                insert_reference_image(filename, embeddings[0], model_name=self.model_name, alignment=self.alignment)
+            elif not store_group_image(filename, faces, embeddings, model_name=self.model_name, alignment=self.alignment,
+                                       detector=detector_version(self.detection_max_side, self.detection_tiling)):
+                raise RuntimeError(f"Unable to store group image '{filename}'.")
+        except Exception as e:
+            return e
+        return {'filename': filename, 'type': request.get('type', 'group'), 'faces': len(faces)}
+
+    def _search(self, requests, queries):
+        """Scores every search query of the batch against the gallery in one matrix product."""
+        face_ids, filenames, engine = self._current_gallery()
+        indices = list(queries)
+        if engine is None:
+            return [{'matches': []} for _ in indices]
+
+        results = []
+        # Queries are grouped by their (threshold, top_k) settings, which apply per search call
+        groups = {}
+        for i in indices:
+            key = (requests[i].get('threshold', self.similarity_threshold), requests[i].get('top_k'))
+            groups.setdefault(key, []).append(i)
+        by_index = {}
+        for (threshold, top_k), group in groups.items():
+            matches = engine.search(np.stack([queries[i] for i in group]), k=top_k, threshold=threshold,
+                                    metric=self.metric)
+            for i, query_matches in zip(group, matches):
+                by_index[i] = {'matches': [{'group_image': filename, 'box': box, 'score': score}
+                                           for filename, box, score in describe_matches(face_ids, filenames, query_matches)]}
+        for i in indices:
+            results.append(by_index[i])
+        return results
+
+    def _current_gallery(self):
+        """Returns the resident gallery, reopening the matrix if images were added since it was loaded."""
+        generation, _ = get_gallery_state(self.model_name, self.alignment)
+        if self._gallery is None or self._gallery[0] != generation:
+            face_ids, filenames, matrix, norms = load_gallery(self.model_name, self.alignment)
+            engine = build_search_engine(filenames, matrix, norms, quantization=self.quantization, rerank=self.rerank,
+                                         pq_subspaces=self.pq_subspaces, model_name=self.model_name,
+                                         alignment=self.alignment, shards=self.shards,
+                                         search_workers=self.search_workers) if filenames else None
+            self._gallery = (generation, face_ids, filenames, engine)
+        return self._gallery[1:]
+
+def _validate(request, metric="cosine"):
+    if request['op'] == "search" and not (request.get('image_path') or request.get('reference')):
+        raise ValueError("A search request needs an 'image_path' or a stored 'reference' filename.")
+    if request['op'] == "add" and not request.get('image_path'):
+        raise ValueError("An add request needs an 'image_path'.")
+    if request.get('type', 'group') not in ("group", "ref"):
+        raise ValueError("The image 'type' must be 'group' or 'ref'.")
+    # bool is an int subclass, but true/false are not meant as numbers here
+    top_k = request.get('top_k')
+    if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1):
+        raise ValueError("'top_k' must be a positive integer.")
+    threshold = request.get('threshold')
+    if threshold is not None:
+        if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) or not math.isfinite(threshold):
+            raise ValueError("'threshold' must be a number.")
+        if metric == "euclidean" and threshold < 0:
+            raise ValueError("'threshold' must not be negative for the euclidean metric.")
+
+async def _handle_connection(service, reader, writer):
+    """Serves the HTTP/1.1 requests of one connection, keeping it open between requests."""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode('latin1').split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode('latin1').partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            status, payload = await service.handle(method, path.split("?", 1)[0], body)
+            data = json.dumps(payload).encode('utf-8')
+            writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(data)}\r\n\r\n".encode('latin1') + data)
+            await writer.drain()
+            if headers.get('connection', '').lower() == "close":
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def _serve(service, host, port):
+    server = await asyncio.start_server(lambda r, w: _handle_connection(service, r, w), host, port)
+    batcher = asyncio.create_task(service.batcher.run())
+    print(f"Recognition service listening on http://{host}:{port} "
+          f"(model '{service.model_name}', {service.alignment} alignment).")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.cancel()
+
+def run_service(host="127.0.0.1", port=8765, model_name="Facenet", alignment="legacy", detection_max_side=None,
+                similarity_threshold=0.8, max_batch_size=16, max_wait_ms=5.0, quantization="none", rerank=4,
+                pq_subspaces=None, shards=0, search_workers=0, detection_tiling=None):
+    """
+    Runs the local recognition service until interrupted.
+
+    Endpoints (JSON bodies and responses):
+        GET  /health
+        POST /search  {"image_path": ...} or {"reference": stored filename},
+                      optional "threshold" and "top_k"
+        POST /add     {"image_path": ..., "type": "group" or "ref", optional "filename"}
+
+    Args:
+        host (str): Interface to bind; keep the default to only accept local connections.
+        port (int): TCP port.
+        model_name (str): Name of the face recognition model.
+        alignment (str): "legacy" or "roi" (see add_group_image).
+        detection_max_side (int): Longest image side used for detection; larger images are downscaled.
+        similarity_threshold (float): Default threshold a score must pass to count as a match.
+        max_batch_size (int): Maximum number of requests per micro-batch.
+        max_wait_ms (float): Maximum time a request waits for others to join its micro-batch.
+        quantization (str): Search a compressed copy of the gallery: "none", "float16", "int8" or "pq".
+        rerank (int): Number of gallery rows re-ranked exactly per requested result with quantization.
+        pq_subspaces (int): Number of product quantization sub-vectors (bytes) per face.
+        shards (int): Number of gallery shards searched in parallel; 0 or 1 searches the gallery in one piece.
+        search_workers (int): Number of search processes for the shards; 0 uses one per CPU.
+        detection_tiling (dict): tile_size, tile_overlap and tile_workers of tiled detection (see detect_faces).
+    """
+    service = RecognitionService(model_name=model_name, alignment=alignment, detection_max_side=detection_max_side,
+                                 similarity_threshold=similarity_threshold, max_batch_size=max_batch_size,
+                                 max_wait_ms=max_wait_ms, quantization=quantization, rerank=rerank,
+                                 pq_subspaces=pq_subspaces, shards=shards, search_workers=search_workers,
+                                 detection_tiling=detection_tiling)
+    print("Loading models and gallery...")
+    # Models are built in the worker thread that later runs every batch
+    service.executor.submit(service.warm_up).result()
+    try:
+        asyncio.run(_serve(service, host, port))
+    except KeyboardInterrupt:
+        print("Recognition service stopped.")
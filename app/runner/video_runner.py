@@ -0,0 +1,227 @@
+import math
+import os
+import time
+import cv2
+import numpy as np
+from app.core.face_alignment import align_face, align_faces
+from app.core.face_detector import detect_faces, detector_version
+from app.core.face_tracker import FaceTracker
+from app.core.feature_extraction import extract_face_embeddings
+from app.data.database import insert_video, is_image_in_db, record_manifest_entries
+from app.data.manifest import adopt_legacy_key, scan_folder
+from app.runner.add_image_runner import alignment_size, append_stored_images
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.m4v', '.avi', '.mkv', '.webm', '.mts', '.m2ts', '.wmv', '.3gp')
+
+# Longest side of the grayscale frames used for optical flow and scene cut detection
+FLOW_MAX_SIDE = 320
+
+def add_video(video_path, filename=None, model_name="Facenet", alignment="legacy", detection_max_side=None,
+              detect_interval=0.5, track_fps=10.0, samples_per_track=3, scene_cut=40.0, batch_size=32,
+              content_hash=None, skip_existing=True):
+    """
+    Adds a video to the database as a group image whose faces are the face tracks of the video.
+
+    Faces are only detected on frames sampled every `detect_interval` seconds (and after scene cuts).
+    Detections are linked into tracks by IoU, with the track boxes carried between detections by
+    optical flow, and each track is embedded from its `samples_per_track` best detections only. The
+    track embedding (the mean of its sample embeddings) is stored with the track's time range, and
+    is searched like any other group face.
+
+    Args:
+        video_path (str): Path to the video file, read with OpenCV.
+        filename (str): Identifier to store the video under. Defaults to the key of video_path (see image_key).
+        model_name (str): Name of the face recognition model.
+        alignment (str): "legacy" or "roi" (see add_group_image).
+        detection_max_side (int): Longest frame side used for detection; larger frames are downscaled.
+        detect_interval (float): Seconds of video between two detection frames.
+        track_fps (float): Frames per second on which track boxes are moved by optical flow; 0 only
+                           matches detections by IoU, and skips every frame between detections.
+        samples_per_track (int): Detections embedded per track.
+        scene_cut (float): Mean absolute difference (0-255) between two analyzed frames above which a
+                           scene cut ends every track and triggers a detection; 0 disables it.
+        batch_size (int): Number of faces embedded per forward pass.
+        content_hash (str): Hash of the file contents, if known.
+        skip_existing (bool): If True, skip videos whose filename is already in the database.
+
+    Returns:
+        dict or None: Statistics of the video ('frames', 'duration_s', 'detection_frames', 'tracks',
+                      'embeddings', 'seconds', 'frames_per_sec', 'embeddings_per_min'), or None if
+                      the video was skipped or could not be stored.
+    """
+    filename = filename or adopt_legacy_key(video_path)
+    if skip_existing and is_image_in_db("group_images", filename):
+        print(f"Video '{filename}' is already in the database.")
+        return None
+
+    start = time.perf_counter()
+    tracked = track_video(video_path, model_name=model_name, alignment=alignment, detection_max_side=detection_max_side,
+                          detect_interval=detect_interval, track_fps=track_fps, samples_per_track=samples_per_track,
+                          scene_cut=scene_cut, batch_size=batch_size)
+    if tracked is None:
+        return None
+    tracks, stats = tracked
+
+    inserted = insert_video(filename, tracks, content_hash=content_hash, model_name=model_name, alignment=alignment,
+                            detector=detector_version(detection_max_side))
+    if inserted is None:
+        return None
+    face_ids, generation = inserted
+    append_stored_images([(filename, face_ids, np.array([track['embedding'] for track in tracks]))], generation,
+                         model_name, alignment)
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    stats.update(seconds=round(elapsed, 2), frames_per_sec=round(stats['frames'] / elapsed, 1),
+                 embeddings_per_min=round(60 * stats['embeddings'] / max(stats['duration_s'], 1e-9), 1))
+    print(f"Video '{filename}': {stats['tracks']} face tracks in {stats['duration_s']:.0f}s of video, "
+          f"{stats['detection_frames']} detection frames out of {stats['frames']}, {stats['embeddings']} embeddings "
+          f"({stats['embeddings_per_min']:.1f} per minute of video), processed in {elapsed:.1f}s "
+          f"({stats['frames_per_sec']:.0f} frames/sec).")
+    return stats
+
+def add_videos_from_folder(folder_path, recursive=False, **kwargs):
+    """
+    Adds the new or changed videos of a folder, recording them in the ingestion manifest.
+
+    Args:
+        folder_path (str): Path to the folder of videos.
+        recursive (bool): If True, also add the videos of all sub-folders.
+        **kwargs: Options of add_video.
+    """
+    new_files, total = scan_folder(folder_path, recursive=recursive, extensions=VIDEO_EXTENSIONS)
+    if not total:
+        print(f"No videos found in folder '{folder_path}'.")
+        return
+
+    print(f"Adding {len(new_files)} new or changed videos from folder '{folder_path}' "
+          f"({total - len(new_files)} unchanged)...")
+    for file in new_files:
+        stats = add_video(file['abs_path'], filename=file['path'], content_hash=file['content_hash'],
+                          skip_existing=False, **kwargs)
+        if stats is not None:
+            record_manifest_entries([file])
+    print(f"Finished adding videos from '{folder_path}'.")
+
+def track_video(video_path, model_name="Facenet", alignment="legacy", detection_max_side=None, detect_interval=0.5,
+                track_fps=10.0, samples_per_track=3, scene_cut=40.0, batch_size=32):
+    """
+    Decodes a video, tracks its faces and embeds every track (see add_video for the options).
+
+    Returns:
+        tuple or None: (tracks, stats) where tracks are face dicts ready for insert_video, or None if
+                       the video cannot be read.
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        print(f"Unable to read video: {video_path}")
+        return None
+
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    fps = fps if fps and math.isfinite(fps) and fps > 0 else 25.0
+    detect_every = max(1, round(detect_interval * fps))
+    follow_every = max(1, round(fps / track_fps)) if track_fps else 0
+    align_size = alignment_size(model_name, alignment)
+
+    tracker = FaceTracker()
+    embedder = _TrackEmbedder(model_name, batch_size, fps)
+    frame_index = detection_frames = 0
+    previous = None
+    try:
+        while True:
+            detect = frame_index % detect_every == 0
+            follow = follow_every and frame_index % follow_every == 0
+            if not (detect or follow):
+                # Frames that are not analyzed are demuxed but never converted to BGR
+                if not capture.grab():
+                    break
+                frame_index += 1
+                continue
+            ok, frame = capture.read()
+            if not ok:
+                break
+
+            gray, scale = _small_gray(frame)
+            if scene_cut and previous is not None and previous.shape == gray.shape and \
+                    cv2.absdiff(previous, gray).mean() > scene_cut:
+                embedder.add(tracker.reset())
+                detect = True
+            previous = gray
+            if follow_every:
+                tracker.follow(gray, frame_index, scale)
+
+            if detect:
+                detection_frames += 1
+                faces = detect_faces(frame, save_output=False, max_side=detection_max_side)
+                assignments, finished = tracker.update(faces, frame_index)
+                for track, face in assignments:
+                    if track.wants_sample(face, samples_per_track):
+                        crop = align_faces(frame, [face], align_size)[0] if align_size else align_face(frame, face)
+                        track.add_sample(face, crop, samples_per_track)
+                embedder.add(finished)
+            frame_index += 1
+    finally:
+        capture.release()
+
+    embedder.add(tracker.reset())
+    tracks = embedder.finish()
+    stats = {
+        'frames': frame_index,
+        'duration_s': round(frame_index / fps, 2),
+        'detection_frames': detection_frames,
+        'tracks': len(tracks),
+        'embeddings': sum(track['samples'] for track in tracks),
+    }
+    return tracks, stats
+
+class _TrackEmbedder:
+    """Embeds the samples of ended tracks in batches, freeing their crops, and averages them per track."""
+
+    def __init__(self, model_name, batch_size, fps):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.fps = fps
+        self.pending = []
+        self.tracks = []
+
+    def add(self, tracks):
+        for track in tracks:
+            if not track.samples:
+                continue
+            self.tracks.append({'track': track, 'embeddings': []})
+            self.pending.extend((self.tracks[-1], crop) for _, crop in track.samples)
+            track.samples = []
+        if len(self.pending) >= self.batch_size:
+            self._embed()
+
+    def finish(self):
+        self._embed()
+        results = []
+        for entry in sorted(self.tracks, key=lambda entry: entry['track'].start_frame):
+            if not entry['embeddings']:
+                continue
+            track = entry['track']
+            results.append(dict(track.best_face, embedding=np.mean(entry['embeddings'], axis=0),
+                                start_ms=round(1000 * track.start_frame / self.fps),
+                                end_ms=round(1000 * track.end_frame / self.fps),
+                                detections=track.detections, samples=len(entry['embeddings'])))
+        return results
+
+    def _embed(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        try:
+            embeddings = extract_face_embeddings([crop for _, crop in pending], model_name=self.model_name,
+                                                 batch_size=self.batch_size)
+        except Exception as e:
+            print(f"Error extracting embeddings: {e}")
+            return
+        for (entry, _), embedding in zip(pending, embeddings):
+            entry['embeddings'].append(embedding)
+
+def _small_gray(frame):
+    """Returns a grayscale copy of a frame downscaled to FLOW_MAX_SIDE, and its scale."""
+    scale = min(1.0, FLOW_MAX_SIDE / max(frame.shape[:2]))
+    if scale < 1.0:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), scale
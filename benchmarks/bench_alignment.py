@@ -0,0 +1,99 @@
+"""
+Compares the legacy full-image alignment (align_face) with the batched ROI alignment (align_faces).
+
+For every face the benchmark reports the time spent aligning and how consistently each method
+places the face in its own output. The methods aim at different geometries (the legacy method
+levels the eyes and crops the detection box, the ROI method fits a template), so neither is scored
+against the other's target: the 5 landmarks of every aligned face, relative to the output size, are
+compared with their mean position over all faces aligned by the same method. The spread is the mean
+landmark distance to that mean, normalized by its inter-ocular distance, and the roll spread the
+mean deviation of the eye line from its mean angle. Lower is better for all columns; a model
+resizing the aligned faces to its input sees the same face geometry only when the spread is low.
+
+Usage:
+    python -m benchmarks.bench_alignment --images path/to/folder
+    python -m benchmarks.bench_alignment --synthetic-faces 30
+"""
+import argparse
+import time
+import cv2
+import numpy as np
+from app.core.face_alignment import LANDMARK_NAMES, align_face, align_faces, face_transform
+from benchmarks.common import list_images, synthetic_faces
+
+def _legacy_transform(face):
+    """Returns the transform applied by align_face, including the crop offset, and its output size."""
+    keypoints = face['keypoints']
+    left_eye, right_eye = keypoints['left_eye'], keypoints['right_eye']
+    eye_center = (int((left_eye[0] + right_eye[0]) / 2), int((left_eye[1] + right_eye[1]) / 2))
+    dy, dx = float(right_eye[1] - left_eye[1]), float(right_eye[0] - left_eye[0])
+    M = cv2.getRotationMatrix2D(eye_center, np.degrees(np.arctan2(dy, dx)), 60.0 / np.sqrt(dx ** 2 + dy ** 2))
+    x, y, width, height = (int(v) for v in face['box'])
+    M[:, 2] -= (x, y)
+    return M, (width, height)
+
+def _aligned_landmarks(M, output_size, face):
+    """The 5 landmarks of one aligned face, relative to the output size."""
+    src = np.array([face['keypoints'][name] for name in LANDMARK_NAMES], dtype=np.float64)
+    mapped = np.c_[src, np.ones(len(src))] @ np.asarray(M, dtype=np.float64).T
+    return mapped / np.array(output_size, dtype=np.float64)
+
+def _spread(landmarks):
+    """Normalized landmark spread and mean eye-line roll deviation (degrees) around the mean face."""
+    mean = landmarks.mean(axis=0)
+    interocular = np.linalg.norm(mean[1] - mean[0])
+    error = np.mean(np.linalg.norm(landmarks - mean, axis=2)) / interocular
+    roll = np.degrees(np.arctan2(landmarks[:, 1, 1] - landmarks[:, 0, 1], landmarks[:, 1, 0] - landmarks[:, 0, 0]))
+    return error, np.mean(np.abs(roll - roll.mean()))
+
+def _detected_faces(folder, max_side):
+    from app.core.face_detector import detect_faces
+
+    samples = []
+    for path in list_images(folder):
+        img = cv2.imread(path)
+        faces = [f for f in detect_faces(img, max_side=max_side) if all(n in f['keypoints'] for n in LANDMARK_NAMES)]
+        if faces:
+            samples.append((img, faces))
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="Folder of sample images (faces are detected with MTCNN).")
+    parser.add_argument("--synthetic-faces", type=int, default=30, help="Number of synthetic faces if --images is not given.")
+    parser.add_argument("--size", type=int, default=160, help="Output size of the ROI alignment (model input size).")
+    parser.add_argument("--max-side", type=int, default=1600, help="Longest side used for detection.")
+    args = parser.parse_args()
+
+    samples = _detected_faces(args.images, args.max_side) if args.images else synthetic_faces(args.synthetic_faces)
+    face_count = sum(len(faces) for _, faces in samples)
+    if not face_count:
+        print("No faces with complete landmarks found.")
+        return
+
+    output_size = (args.size, args.size)
+    results = {}
+    for method in ("legacy", "roi"):
+        start = time.perf_counter()
+        for img, faces in samples:
+            if method == "legacy":
+                for face in faces:
+                    align_face(img, face)
+            else:
+                align_faces(img, faces, output_size)
+        elapsed = time.perf_counter() - start
+
+        landmarks = []
+        for _, faces in samples:
+            for face in faces:
+                M, size = _legacy_transform(face) if method == "legacy" else (face_transform(face, output_size), output_size)
+                landmarks.append(_aligned_landmarks(M, size, face))
+        results[method] = (1000 * elapsed / face_count,) + _spread(np.array(landmarks))
+
+    print(f"{face_count} faces in {len(samples)} images")
+    print(f"{'method':<10}{'ms/face':>10}{'landmark spread':>17}{'roll spread (deg)':>19}")
+    for method, (ms, spread, roll) in results.items():
+        print(f"{method:<10}{ms:>10.2f}{spread:>17.3f}{roll:>19.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Measures the time, peak memory and quality of unknown-face clustering on synthetic galleries.
+
+Each gallery holds noisy embeddings around random identity centres, written to a memory-mapped file
+like the real gallery matrix. For every size the faces are clustered from scratch, then the last
+--new-fraction of them is assigned incrementally to the clusters of the others. Quality is reported
+as pairwise precision and recall against the true identities. Each size runs in its own process, so
+that peak memory is measured per size.
+
+Usage:
+    python -m benchmarks.bench_cluster --sizes 10000 100000 --memory-mb 256
+    python -m benchmarks.bench_cluster --sizes 1000000 --faces-per-identity 50
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from benchmarks.common import peak_rss_mb, run_isolated, synthetic_gallery
+
+def _pair_scores(clusters, identities):
+    """Pairwise precision and recall of the clusters against the true identities."""
+    def pairs(counts):
+        return float((counts * (counts - 1) // 2).sum())
+
+    _, joint = np.unique(np.stack([clusters, identities]), axis=1, return_counts=True)
+    _, cluster_sizes = np.unique(clusters, return_counts=True)
+    _, identity_sizes = np.unique(identities, return_counts=True)
+    together = pairs(joint)
+    return together / max(pairs(cluster_sizes), 1), together / max(pairs(identity_sizes), 1)
+
+def _measure(count, args):
+    from app.core.clustering import cluster_embeddings
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "gallery.f32")
+        identities, norms = synthetic_gallery(path, count, args.dim, args.faces_per_identity, args.noise)
+        matrix = np.memmap(path, dtype=np.float32, mode='r', shape=(count, args.dim))
+        memory_bytes = args.memory_mb << 20
+
+        start = time.perf_counter()
+        clusters = cluster_embeddings(matrix, norms, args.threshold, memory_bytes=memory_bytes)
+        full_s = time.perf_counter() - start
+        precision, recall = _pair_scores(clusters, identities)
+
+        known = count - max(1, int(count * args.new_fraction))
+        labels = cluster_embeddings(matrix[:known], norms[:known], args.threshold, memory_bytes=memory_bytes)
+        start = time.perf_counter()
+        incremental = cluster_embeddings(matrix, norms, args.threshold, memory_bytes=memory_bytes, labels=labels)
+        incremental_s = time.perf_counter() - start
+
+    return {
+        'faces': count,
+        'clusters': int(len(np.unique(clusters))),
+        'full_s': round(full_s, 3),
+        'faces_per_sec': round(count / full_s, 1),
+        'incremental_faces': count - known,
+        'incremental_s': round(incremental_s, 3),
+        'incremental_matches_full': bool(np.array_equal(_pair_scores(incremental, clusters), (1.0, 1.0))),
+        'precision': round(precision, 4),
+        'recall': round(recall, 4),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="Gallery sizes (faces).")
+    parser.add_argument("--dim", type=int, default=128, help="Embedding dimension.")
+    parser.add_argument("--faces-per-identity", type=int, default=20, help="Average faces per synthetic identity.")
+    parser.add_argument("--noise", type=float, default=0.04, help="Per-dimension noise around identity centres.")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Cosine similarity threshold.")
+    parser.add_argument("--memory-mb", type=int, default=512, help="Memory budget for each block of scores.")
+    parser.add_argument("--new-fraction", type=float, default=0.01, help="Share of faces assigned incrementally.")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size:
+        print(json.dumps(_measure(args.size, args)))
+        return
+
+    options = ["--dim", str(args.dim), "--faces-per-identity", str(args.faces_per_identity), "--noise", str(args.noise),
+               "--threshold", str(args.threshold), "--memory-mb", str(args.memory_mb),
+               "--new-fraction", str(args.new_fraction)]
+    print(f"{'faces':>10}{'clusters':>10}{'full s':>10}{'faces/s':>12}{'incr. s':>10}"
+          f"{'precision':>11}{'recall':>8}{'peak RSS MB':>13}")
+    results = []
+    for size in args.sizes:
+        result = run_isolated("benchmarks.bench_cluster", ["--size", str(size)] + options)
+        results.append(result)
+        print(f"{result['faces']:>10}{result['clusters']:>10}{result['full_s']:>10.2f}{result['faces_per_sec']:>12.0f}"
+              f"{result['incremental_s']:>10.2f}{result['precision']:>11.3f}{result['recall']:>8.3f}"
+              f"{result['peak_rss_mb']:>13.1f}")
+
+    print(json.dumps(results))
+
+if __name__ == "__main__":
+    main()
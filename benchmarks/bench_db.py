@@ -0,0 +1,74 @@
+"""
+Compares group image ingestion throughput of per-image commits with the BulkWriter.
+
+Both modes store the same synthetic faces in a fresh database: "per_image" checks each filename
+with is_image_in_db() and commits every image and manifest entry on its own (the way ingestion
+wrote before the BulkWriter), "bulk" buffers them in a BulkWriter. Unless --no-gallery is given,
+the faces are also appended to the gallery matrix, per image or per flush respectively.
+
+Usage:
+    python -m benchmarks.bench_db --images 2000 --faces 3
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from app.data import database
+from app.data.gallery_matrix import append_to_gallery, load_gallery
+from benchmarks.common import synthetic_rows
+
+def _append_images(images, generation):
+    face_ids = [face_id for _, ids, _ in images for face_id in ids]
+    filenames = [filename for filename, ids, _ in images for _ in ids]
+    append_to_gallery(face_ids, filenames, np.concatenate([e for _, _, e in images]), generation)
+
+def _run(mode, rows, gallery, batch_size):
+    on_flush = _append_images if gallery else None
+    start = time.perf_counter()
+    if mode == "per_image":
+        for file, faces in rows:
+            if database.is_image_in_db("group_images", file['path']):
+                continue
+            face_ids, generation = database.insert_group_image(file['path'], faces, content_hash=file['content_hash'])
+            database.record_manifest_entries([file])
+            if on_flush:
+                on_flush([(file['path'], face_ids, np.array([f['embedding'] for f in faces]))], generation)
+    else:
+        existing = database.get_existing_filenames("group_images", [file['path'] for file, _ in rows])
+        with database.BulkWriter(batch_size=batch_size, on_flush=on_flush) as writer:
+            for file, faces in rows:
+                if file['path'] in existing:
+                    continue
+                writer.add_group_image(file['path'], faces, content_hash=file['content_hash'])
+                writer.add_manifest_entries([file])
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=2000, help="Number of synthetic group images.")
+    parser.add_argument("--faces", type=int, default=3, help="Faces per image.")
+    parser.add_argument("--dim", type=int, default=128, help="Embedding dimension.")
+    parser.add_argument("--batch-size", type=int, default=256, help="BulkWriter batch size.")
+    parser.add_argument("--no-gallery", action="store_true", help="Only write to SQLite.")
+    parser.add_argument("--modes", nargs="+", default=["per_image", "bulk"], choices=["per_image", "bulk"])
+    args = parser.parse_args()
+
+    rows = synthetic_rows(args.images, args.faces, args.dim)
+    results = {}
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database.DB_PATH = os.path.join(tmp_dir, "database.db")
+            database.init_db()
+            if not args.no_gallery:
+                load_gallery()
+            elapsed = _run(mode, rows, not args.no_gallery, args.batch_size)
+            database.close_connections()
+        results[mode] = {'seconds': round(elapsed, 3), 'images_per_sec': round(args.images / elapsed, 1)}
+        print(f"{mode:>10}: {elapsed:8.2f}s  {args.images / elapsed:10.1f} images/sec")
+
+    print(json.dumps(results))
+
+if __name__ == "__main__":
+    main()
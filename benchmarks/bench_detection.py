@@ -0,0 +1,75 @@
+"""
+Compares the per-image time and peak memory of face detection at full resolution (the file decoded
+twice, as the runners used to do) with the decode-once, reduced-resolution path and with tiled
+detection (full-resolution tiles plus one reduced-resolution pass, see detect_faces_tiled).
+
+Usage:
+    python -m benchmarks.bench_detection --images path/to/folder --max-side 1600
+    python -m benchmarks.bench_detection --synthetic 5
+    python -m benchmarks.bench_detection --images path/to/raw_jpgs --tile-size 1024 --tile-workers 4
+"""
+import argparse
+import json
+import tempfile
+import time
+import cv2
+from benchmarks.common import list_images, peak_rss_mb, run_isolated, synthetic_images
+
+def _measure(paths, mode, max_side, tiling):
+    from app.core.face_detector import detect_faces
+    from app.core.model_registry import warm_up
+
+    warm_up(model_names=[])
+    timings, faces = [], 0
+    for path in paths:
+        start = time.perf_counter()
+        # Both paths decode the image once for alignment
+        img = cv2.imread(path)
+        if mode == "full":
+            # Previous path: detect_faces decodes the file again and detects at full resolution
+            results = detect_faces(path)
+        elif mode == "tiled":
+            results = detect_faces(img, max_side=max_side, **tiling)
+        else:
+            results = detect_faces(img, max_side=max_side)
+        timings.append(time.perf_counter() - start)
+        faces += len(results)
+    return {
+        "mode": mode,
+        "images": len(paths),
+        "faces": faces,
+        "ms_per_image": 1000 * sum(timings) / len(timings),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="Folder of sample images.")
+    parser.add_argument("--synthetic", type=int, default=5, help="Number of synthetic 24 MP images if --images is not given.")
+    parser.add_argument("--max-side", type=int, default=1600, help="Longest side used for reduced-resolution detection.")
+    parser.add_argument("--tile-size", type=int, default=1024, help="Tile side of tiled detection.")
+    parser.add_argument("--tile-overlap", type=int, default=256, help="Overlap between tiles, in pixels.")
+    parser.add_argument("--tile-workers", type=int, default=2, help="Tiles detected in parallel.")
+    parser.add_argument("--mode", choices=["full", "downscaled", "tiled"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    tiling = dict(tile_size=args.tile_size, tile_overlap=args.tile_overlap, tile_workers=args.tile_workers)
+    if args.mode:
+        print(json.dumps(_measure(list_images(args.images), args.mode, args.max_side, tiling)))
+        return
+
+    folder = args.images or tempfile.mkdtemp(prefix="photoscan_bench_")
+    if not args.images:
+        synthetic_images(folder, count=args.synthetic)
+
+    print(f"{'mode':<12}{'images':>8}{'faces':>8}{'ms/image':>12}{'peak RSS MB':>14}")
+    for mode in ("full", "downscaled", "tiled"):
+        result = run_isolated("benchmarks.bench_detection",
+                              ["--images", folder, "--mode", mode, "--max-side", str(args.max_side),
+                               "--tile-size", str(args.tile_size), "--tile-overlap", str(args.tile_overlap),
+                               "--tile-workers", str(args.tile_workers)])
+        print(f"{result['mode']:<12}{result['images']:>8}{result['faces']:>8}"
+              f"{result['ms_per_image']:>12.1f}{result['peak_rss_mb']:>14.1f}")
+
+if __name__ == "__main__":
+    main()
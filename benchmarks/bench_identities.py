@@ -0,0 +1,95 @@
+"""
+Measures identification accuracy of the identity templates and the throughput of labelling a gallery.
+
+Accuracy: every synthetic identity has two looks (e.g. with and without glasses), its reference images
+are noisy photos of either look, and probe faces are labelled with the best-matching identity. The
+report compares one reference per identity (a single reference image, as before identities) with
+mean and medoid templates, one or more per identity, as rank-1 accuracy over the probes.
+
+Throughput: a memory-mapped synthetic gallery of --faces faces is labelled against --identities
+identities with label_faces, as MODE=identify does, reporting faces per second and peak memory.
+
+Usage:
+    python -m benchmarks.bench_identities --faces 1000000 --identities 1000 --references 5
+    python -m benchmarks.bench_identities --faces 100000 --identities 200 --noise 0.12 --templates 1 2 3
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from app.core.identities import aggregate_templates, label_faces
+from benchmarks.common import peak_rss_mb, synthetic_gallery
+
+def _photos(rng, looks, count, noise):
+    """Noisy photos of an identity, each of a random look."""
+    photos = looks[rng.integers(0, len(looks), size=count)]
+    return photos + rng.normal(0, noise, size=photos.shape).astype(np.float32)
+
+def _accuracy(args):
+    rng = np.random.default_rng(args.seed)
+    centres = rng.normal(size=(args.identities, args.dim)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    # The second look of every identity is its centre moved part of the way towards another direction
+    shifts = rng.normal(size=centres.shape).astype(np.float32)
+    shifts /= np.linalg.norm(shifts, axis=1, keepdims=True)
+    looks = np.stack([centres, centres + args.look_shift * shifts], axis=1)
+
+    references = [_photos(rng, looks[i], args.references, args.noise) for i in range(args.identities)]
+    truth = np.repeat(np.arange(args.identities), args.probes)
+    probes = np.concatenate([_photos(rng, looks[i], args.probes, args.noise) for i in range(args.identities)])
+    probe_norms = np.linalg.norm(probes, axis=1)
+    probes /= probe_norms[:, None]
+
+    variants = [("single", [reference[:1] for reference in references])]
+    for method in ("mean", "medoid"):
+        for count in args.templates:
+            variants.append((f"{method} x{count}", [aggregate_templates(reference, method, count)
+                                                   for reference in references]))
+    results = []
+    for name, templates in variants:
+        identities = np.concatenate([np.full(len(rows), i) for i, rows in enumerate(templates)])
+        labels, _ = label_faces(probes, probe_norms, np.concatenate(templates), identities)
+        results.append({'templates': name, 'accuracy': round(float(np.mean(labels == truth)), 4)})
+    return results
+
+def _throughput(args):
+    rng = np.random.default_rng(args.seed + 1)
+    templates = rng.normal(size=(args.identities, args.dim)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "gallery.f32")
+        _, norms = synthetic_gallery(path, args.faces, args.dim, 20, 0.04)
+        matrix = np.memmap(path, dtype=np.float32, mode='r', shape=(args.faces, args.dim))
+        start = time.perf_counter()
+        label_faces(matrix, norms, templates, np.arange(args.identities), memory_bytes=args.memory_mb << 20)
+        elapsed = time.perf_counter() - start
+    return {'faces': args.faces, 'identities': args.identities, 'label_s': round(elapsed, 3),
+            'faces_per_sec': round(args.faces / elapsed, 1), 'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--faces", type=int, default=1000000, help="Gallery faces labelled in the throughput run.")
+    parser.add_argument("--identities", type=int, default=1000, help="Number of identities.")
+    parser.add_argument("--dim", type=int, default=128, help="Embedding dimension.")
+    parser.add_argument("--references", type=int, default=5, help="Reference images per identity.")
+    parser.add_argument("--probes", type=int, default=10, help="Probe faces per identity in the accuracy run.")
+    parser.add_argument("--noise", type=float, default=0.1, help="Per-dimension noise of a photo around its look.")
+    parser.add_argument("--look-shift", type=float, default=0.8, help="Distance between an identity's two looks.")
+    parser.add_argument("--templates", type=int, nargs="+", default=[1, 2], help="Templates per identity to compare.")
+    parser.add_argument("--memory-mb", type=int, default=256, help="Memory budget for each block of scores.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    accuracy = _accuracy(args)
+    print(f"{'templates':>12}{'accuracy':>10}")
+    for result in accuracy:
+        print(f"{result['templates']:>12}{result['accuracy']:>10.4f}")
+    throughput = _throughput(args)
+    print(f"Labelled {throughput['faces']} faces with {throughput['identities']} identities in "
+          f"{throughput['label_s']:.2f}s ({throughput['faces_per_sec']:.0f} faces/s, "
+          f"peak RSS {throughput['peak_rss_mb']:.0f} MB).")
+    print(json.dumps({'accuracy': accuracy, 'labelling': throughput}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Measures the import time of each CLI mode with `python -X importtime` and checks that modes working
+on stored embeddings never load the heavy inference dependencies.
+
+Each mode runs in a fresh interpreter that imports main.py (against a throwaway database) and then
+the runner the mode dispatches to. The report lists the total import time, the slowest top-level
+imports and any forbidden module that was loaded. The exit code is 1 if a light mode imports a
+forbidden module or a mode exceeds --max-ms, so the benchmark can guard against regressions.
+
+Usage:
+    python -m benchmarks.bench_import
+    python -m benchmarks.bench_import --modes search --max-ms 500
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from benchmarks.common import REPO_ROOT
+
+# Modules imported by each MODE of main.py, after main itself
+MODE_IMPORTS = {
+    'search': ["app.runner.search_runner"],
+    'batch_search': ["app.runner.batch_search_runner"],
+    'build_index': ["app.runner.index_runner"],
+    'shard': ["app.runner.index_runner"],
+    'cluster': ["app.runner.cluster_runner"],
+    'identify': ["app.runner.identity_runner"],
+    'add': ["app.core.model_registry", "app.runner.add_image_runner", "app.runner.video_runner"],
+    'serve': ["app.runner.service_runner"],
+}
+
+# Modes that only read stored embeddings must not import these
+LIGHT_MODES = ("search", "batch_search", "build_index", "shard", "cluster", "identify")
+HEAVY_MODULES = ("tensorflow", "keras", "tf_keras", "deepface", "mtcnn", "matplotlib", "cv2")
+
+def _import_times(mode, db_path):
+    """Runs the imports of a mode with -X importtime and returns {top-level module: cumulative us}."""
+    code = "; ".join([f"import app.data.database as database", f"database.DB_PATH = {db_path!r}", "import main"]
+                     + [f"import {module}" for module in MODE_IMPORTS[mode]])
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=REPO_ROOT, check=True,
+                            capture_output=True, text=True).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue  # header line
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        # Depth 0 entries are imported directly by the script, deeper ones are included in them
+        if depth == 0:
+            times[name] = int(cumulative)
+        times.setdefault(f"loaded:{name.split('.')[0]}", 0)
+    return times
+
+def _measure(mode, repeat, db_path):
+    runs = [_import_times(mode, db_path) for _ in range(repeat)]
+    best = min(runs, key=lambda times: sum(v for k, v in times.items() if not k.startswith("loaded:")))
+    top_level = {k: v for k, v in best.items() if not k.startswith("loaded:")}
+    loaded = {k.split(":", 1)[1] for k in best if k.startswith("loaded:")}
+    return {
+        'total_ms': round(sum(top_level.values()) / 1000, 1),
+        'slowest': sorted(((name, round(us / 1000, 1)) for name, us in top_level.items()), key=lambda x: -x[1]),
+        'heavy_modules': sorted(loaded & set(HEAVY_MODULES)),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=list(MODE_IMPORTS), choices=list(MODE_IMPORTS))
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per mode; the fastest is reported.")
+    parser.add_argument("--top", type=int, default=5, help="Number of slowest top-level imports listed.")
+    parser.add_argument("--max-ms", type=float, default=None, help="Fail if a mode imports for longer.")
+    args = parser.parse_args()
+
+    results, failures = {}, []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "database.db")
+        for mode in args.modes:
+            result = _measure(mode, args.repeat, db_path)
+            result['slowest'] = result['slowest'][:args.top]
+            results[mode] = result
+            print(f"{mode:>12}: {result['total_ms']:8.1f} ms  "
+                  + ", ".join(f"{name} {ms} ms" for name, ms in result['slowest']))
+            if mode in LIGHT_MODES and result['heavy_modules']:
+                failures.append(f"{mode} imports {', '.join(result['heavy_modules'])}")
+            if args.max_ms is not None and result['total_ms'] > args.max_ms:
+                failures.append(f"{mode} takes {result['total_ms']} ms to import (limit {args.max_ms} ms)")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print(json.dumps(results))
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
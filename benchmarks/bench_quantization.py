@@ -0,0 +1,102 @@
+"""
+Compares the memory, latency and recall of gallery search on compressed embeddings (float16, int8,
+product quantization) with the exact float32 search.
+
+A synthetic gallery of noisy faces around random identities is searched with held-out faces of the
+same identities. The exact results are those of GallerySearchEngine (the engine behind
+match_embeddings); for every mode the benchmark reports the memory of the scanned gallery, the
+encoding time, the latency of top-k and threshold searches, recall@k of the top-k results and the
+recall of the threshold matches (which the error bounds keep at 1.0). float64 is the memory a
+gallery of NumPy float64 arrays (decoded from JSON, as galleries used to be held) would take.
+
+Usage:
+    python -m benchmarks.bench_quantization --faces 100000 --queries 200 --k 10
+    python -m benchmarks.bench_quantization --faces 1000000 --modes int8 pq --pq-subspaces 32
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from app.core.quantization import QUANTIZATION_MODES, QuantizedGallery, QuantizedSearchEngine
+from app.core.similarity_matching import GallerySearchEngine
+from benchmarks.common import synthetic_gallery
+
+def _queries(count, dim, identities, noise, seed=1):
+    """Noisy faces of existing identities, generated like the gallery rows."""
+    rng = np.random.default_rng(0)
+    centres = rng.normal(size=(identities, dim)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    rng = np.random.default_rng(seed)
+    return centres[rng.integers(0, identities, count)] + rng.normal(0, noise, size=(count, dim)).astype(np.float32)
+
+def _timed_search(engine, queries, **kwargs):
+    start = time.perf_counter()
+    results = [engine.search(query, **kwargs)[0] for query in queries]
+    return results, 1000 * (time.perf_counter() - start) / len(queries)
+
+def _recall(results, exact):
+    found = sum(len({row for row, _ in result} & {row for row, _ in reference}) for result, reference in zip(results, exact))
+    return found / max(sum(len(reference) for reference in exact), 1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--faces", type=int, default=100000, help="Number of gallery faces.")
+    parser.add_argument("--dim", type=int, default=128, help="Embedding dimension.")
+    parser.add_argument("--faces-per-identity", type=int, default=20, help="Average faces per synthetic identity.")
+    parser.add_argument("--noise", type=float, default=0.04, help="Per-dimension noise around identity centres.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of search queries.")
+    parser.add_argument("--k", type=int, default=10, help="Results per top-k search.")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Cosine threshold of the threshold searches.")
+    parser.add_argument("--rerank", type=int, default=4, help="Rows re-ranked exactly per requested result.")
+    parser.add_argument("--pq-subspaces", type=int, default=None, help="PQ sub-vectors per face (default dim / 8).")
+    parser.add_argument("--modes", nargs="+", default=list(QUANTIZATION_MODES), choices=list(QUANTIZATION_MODES))
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "gallery.f32")
+        _, norms = synthetic_gallery(path, args.faces, args.dim, args.faces_per_identity, args.noise)
+        matrix = np.memmap(path, dtype=np.float32, mode='r', shape=(args.faces, args.dim))
+        ids = list(range(args.faces))
+        queries = _queries(args.queries, args.dim, max(1, args.faces // args.faces_per_identity), args.noise)
+
+        exact_engine = GallerySearchEngine(ids, matrix, norms=norms)
+        exact_top, _ = _timed_search(exact_engine, queries, k=args.k)
+        exact_matches, _ = _timed_search(exact_engine, queries, threshold=args.threshold)
+
+        print(f"{'mode':<9}{'MB':>10}{'bytes/face':>12}{'encode s':>10}{'top-k ms':>10}{'recall@k':>10}"
+              f"{'thresh. ms':>12}{'recall':>8}")
+        float64_mb = args.faces * args.dim * 8 / 2 ** 20
+        print(f"{'float64':<9}{float64_mb:>10.1f}{args.dim * 8:>12}")
+        for mode in args.modes:
+            start = time.perf_counter()
+            if mode == "none":
+                engine, nbytes = exact_engine, matrix.nbytes + norms.nbytes
+            else:
+                quantized = QuantizedGallery.encode(matrix, mode, subspaces=args.pq_subspaces)
+                engine = QuantizedSearchEngine(ids, matrix, norms, quantized, rerank=args.rerank)
+                nbytes = quantized.nbytes + norms.nbytes
+            encode_s = time.perf_counter() - start
+
+            top, top_ms = _timed_search(engine, queries, k=args.k)
+            matches, threshold_ms = _timed_search(engine, queries, threshold=args.threshold)
+            results[mode] = {
+                'mb': round(nbytes / 2 ** 20, 2),
+                'bytes_per_face': round(nbytes / args.faces, 1),
+                'encode_s': round(encode_s, 3),
+                'topk_ms': round(top_ms, 3),
+                'recall_at_k': round(_recall(top, exact_top), 4),
+                'threshold_ms': round(threshold_ms, 3),
+                'threshold_recall': round(_recall(matches, exact_matches), 4),
+            }
+            r = results[mode]
+            print(f"{mode:<9}{r['mb']:>10.1f}{r['bytes_per_face']:>12.1f}{r['encode_s']:>10.2f}{r['topk_ms']:>10.2f}"
+                  f"{r['recall_at_k']:>10.4f}{r['threshold_ms']:>12.2f}{r['threshold_recall']:>8.4f}")
+
+    results['float64'] = {'mb': round(float64_mb, 2), 'bytes_per_face': args.dim * 8}
+    print(json.dumps(results))
+
+if __name__ == "__main__":
+    main()
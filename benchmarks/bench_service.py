@@ -0,0 +1,74 @@
+"""
+Load tests a running recognition service (MODE=serve) with concurrent clients.
+
+Each client keeps one HTTP connection open and sends its requests back to back, so the service
+sees up to --clients requests at once and can coalesce them into micro-batches. Reports the p50
+and p99 latency and the throughput; compare runs with different MICRO_BATCH_SIZE and
+MICRO_BATCH_WAIT_MS settings (MICRO_BATCH_SIZE=1 disables batching).
+
+Usage:
+    python -m benchmarks.bench_service --image path/to/query.jpg --clients 16 --requests 400
+    python -m benchmarks.bench_service --reference stored_ref.jpg --clients 32
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+import numpy as np
+
+def _client(host, port, path, body, count, latencies, errors):
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    for _ in range(count):
+        start = time.perf_counter()
+        conn.request("POST", path, body=body, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors.append(response.status)
+    conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    query = parser.add_mutually_exclusive_group(required=True)
+    query.add_argument("--image", help="Query image path, detected and embedded on every request.")
+    query.add_argument("--reference", help="Filename of a stored reference image (search only, no inference).")
+    parser.add_argument("--clients", type=int, default=16, help="Number of concurrent clients.")
+    parser.add_argument("--requests", type=int, default=400, help="Total number of search requests.")
+    parser.add_argument("--top-k", type=int, default=10, help="Matches returned per search.")
+    args = parser.parse_args()
+
+    request = {'top_k': args.top_k}
+    request.update({'image_path': args.image} if args.image else {'reference': args.reference})
+    body = json.dumps(request)
+
+    per_client = max(1, args.requests // args.clients)
+    latencies, errors = [], []
+    threads = [threading.Thread(target=_client, args=(args.host, args.port, "/search", body, per_client,
+                                                      latencies, errors)) for _ in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    result = {
+        'clients': args.clients,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 2),
+        'p99_ms': round(float(np.percentile(latencies_ms, 99)), 2),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+    }
+    print(f"{result['requests']} requests from {args.clients} clients in {elapsed:.2f}s: "
+          f"p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, {result['requests_per_sec']} requests/sec "
+          f"({result['errors']} errors)")
+    print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Measures how gallery search scales with the number of shards and search worker processes.
+
+A synthetic gallery is split into as many shards as workers (faces assigned by the hash of their
+image, as in the sharded gallery) and searched by ShardedSearchEngine. For every worker count the
+benchmark reports the latency of single-query top-k searches, the throughput of batched queries and
+the speedup over the unsharded GallerySearchEngine, and checks that the results match it exactly.
+
+Usage:
+    python -m benchmarks.bench_shards --faces 1000000 --workers 1 2 4 8
+    python -m benchmarks.bench_shards --faces 200000 --workers 2 4 --queries 100 --batch 64
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from app.core.sharded_search import ShardedSearchEngine, shard_of
+from app.core.similarity_matching import GallerySearchEngine
+from benchmarks.common import synthetic_gallery
+
+def _write_shards(folder, matrix, norms, filenames, shards):
+    """Writes the shard files of a gallery split into `shards` shards and returns their descriptors."""
+    assignments = shard_of(filenames, shards)
+    descriptors = []
+    for shard in range(shards):
+        rows = np.flatnonzero(assignments == shard)
+        descriptor = {'count': len(rows)}
+        for name, data in (('matrix', matrix[rows]), ('norms', norms[rows]), ('rows', rows)):
+            descriptor[name] = os.path.join(folder, f"shard{shard}of{shards}_{name}.npy")
+            np.save(descriptor[name], data)
+        descriptors.append(descriptor)
+    return descriptors
+
+def _measure(engine, queries, k, batch):
+    # The first search starts the workers and pages the shards in
+    engine.search(queries[:1], k=k)
+    latencies, top = [], []
+    for query in queries:
+        start = time.perf_counter()
+        top.append(engine.search(query, k=k)[0])
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    for offset in range(0, len(queries), batch):
+        engine.search(queries[offset:offset + batch], k=k)
+    throughput = len(queries) / (time.perf_counter() - start)
+    return top, 1000 * float(np.median(latencies)), throughput
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--faces", type=int, default=1000000, help="Number of gallery faces.")
+    parser.add_argument("--dim", type=int, default=128, help="Embedding dimension.")
+    parser.add_argument("--faces-per-image", type=int, default=4, help="Faces per synthetic group image.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="Worker (and shard) counts.")
+    parser.add_argument("--queries", type=int, default=50, help="Number of search queries.")
+    parser.add_argument("--batch", type=int, default=32, help="Queries per search call in the throughput runs.")
+    parser.add_argument("--k", type=int, default=10, help="Results per query.")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "gallery.f32")
+        _, norms = synthetic_gallery(path, args.faces, args.dim, 20, 0.04)
+        matrix = np.memmap(path, dtype=np.float32, mode='r', shape=(args.faces, args.dim))
+        filenames = [f"image_{row // args.faces_per_image}.jpg" for row in range(args.faces)]
+        queries = np.random.default_rng(1).normal(size=(args.queries, args.dim)).astype(np.float32)
+
+        exact, latency_ms, throughput = _measure(GallerySearchEngine(filenames, matrix, norms=norms), queries,
+                                                 args.k, args.batch)
+        print(f"{'workers':>8}{'shards':>8}{'p50 ms':>10}{'queries/s':>12}{'speedup':>9}{'exact':>7}")
+        print(f"{'-':>8}{'-':>8}{latency_ms:>10.2f}{throughput:>12.1f}{1.0:>9.2f}{'yes':>7}")
+        baseline = latency_ms
+        results.append({'workers': 0, 'shards': 0, 'p50_ms': round(latency_ms, 3),
+                        'queries_per_sec': round(throughput, 1), 'speedup': 1.0, 'exact': True})
+
+        for workers in args.workers:
+            folder = os.path.join(tmp_dir, f"shards_{workers}")
+            os.makedirs(folder)
+            descriptors = _write_shards(folder, matrix, norms, filenames, workers)
+            engine = ShardedSearchEngine(filenames, matrix, norms, descriptors, workers=workers)
+            top, latency_ms, throughput = _measure(engine, queries, args.k, args.batch)
+            matches = [[row for row, _ in result] for result in top] == [[row for row, _ in result] for result in exact]
+            results.append({'workers': workers, 'shards': workers, 'p50_ms': round(latency_ms, 3),
+                            'queries_per_sec': round(throughput, 1), 'speedup': round(baseline / latency_ms, 2),
+                            'exact': matches})
+            r = results[-1]
+            print(f"{workers:>8}{workers:>8}{r['p50_ms']:>10.2f}{r['queries_per_sec']:>12.1f}{r['speedup']:>9.2f}"
+                  f"{'yes' if matches else 'no':>7}")
+
+    print(json.dumps(results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Times each stage of the recognition pipeline separately and compares the results with a baseline.
+
+Stages (all run offline on synthetic data unless --images is given):
+    decode        cv2.imread of each sample image                       (seconds per image)
+    detection     detect_faces at --max-side                            (seconds per image)
+    alignment     batched ROI alignment to the model input size         (seconds per face)
+    embedding     extract_face_embeddings in batches of --batch-size    (seconds per face)
+    db_insert     BulkWriter ingestion into a fresh database            (seconds per image)
+    gallery_load  load_gallery of a --load-size gallery, pages touched  (seconds per load)
+    search_<N>    single-query search of a synthetic N-face gallery     (seconds per query)
+    search_batch_<N>  the same with --query-batch queries per call      (seconds per query)
+
+Stages whose dependencies are missing (e.g. TensorFlow for embedding) are recorded as skipped.
+`run` writes the median and p90 of each stage to a JSON file; `compare` flags every stage whose
+median is more than --tolerance slower than in the baseline and exits with status 1 if any is.
+
+Usage:
+    python -m benchmarks.bench_suite run --output baseline.json
+    python -m benchmarks.bench_suite run --output current.json --baseline baseline.json
+    python -m benchmarks.bench_suite compare baseline.json current.json --tolerance 0.1
+    python -m benchmarks.bench_suite run --stages search --sizes 1000 100000 1000000
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+from benchmarks.common import list_images, synthetic_faces, synthetic_images, synthetic_rows
+
+STAGES = ("decode", "detection", "alignment", "embedding", "db_insert", "gallery_load", "search")
+
+def _timed(fn, repeat, items=1, warmup=1):
+    """Runs fn warmup + repeat times and summarizes the per-item time of the timed runs."""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) / items)
+    median = float(np.median(timings))
+    return {'median_s': median, 'p90_s': float(np.percentile(timings, 90)), 'per_sec': 1.0 / median if median else None,
+            'items': items, 'repeat': repeat}
+
+def _decode(args, paths):
+    return _timed(lambda: [cv2.imread(path) for path in paths], args.repeat, items=len(paths))
+
+def _detection(args, paths):
+    from app.core.face_detector import detect_faces
+    from app.core.model_registry import get_detector
+
+    # Built outside the timed runs; raises ImportError if MTCNN is missing
+    get_detector()
+    images = [cv2.imread(path) for path in paths]
+    return _timed(lambda: [detect_faces(img, max_side=args.max_side) for img in images], args.repeat,
+                  items=len(images))
+
+def _alignment(args, paths):
+    from app.core.face_alignment import align_faces
+
+    samples = synthetic_faces(args.faces)
+    size = (args.align_size, args.align_size)
+    return _timed(lambda: [align_faces(img, faces, size) for img, faces in samples], args.repeat, items=args.faces)
+
+def _embedding(args, paths):
+    from app.core.feature_extraction import extract_face_embeddings
+    from app.core.model_registry import get_embedding_model
+
+    # Built outside the timed runs; raises ImportError if DeepFace is missing
+    get_embedding_model(args.model_name)
+    rng = np.random.default_rng(0)
+    faces = list(rng.integers(0, 256, size=(args.faces, args.align_size, args.align_size, 3), dtype=np.uint8))
+    return _timed(lambda: extract_face_embeddings(faces, model_name=args.model_name, batch_size=args.batch_size),
+                  args.repeat, items=len(faces))
+
+def _db_insert(args, paths):
+    from app.data import database
+
+    rows = synthetic_rows(args.db_images, 3, args.dim)
+
+    def insert():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database.DB_PATH = os.path.join(tmp_dir, "database.db")
+            database.init_db()
+            with database.BulkWriter() as writer:
+                for file, faces in rows:
+                    writer.add_group_image(file['path'], faces, content_hash=file['content_hash'])
+                    writer.add_manifest_entries([file])
+            database.close_connections()
+
+    return _timed(insert, args.repeat, items=len(rows), warmup=0)
+
+def _gallery_load(args, paths):
+    from app.data import database
+    from app.data.gallery_matrix import append_to_gallery, load_gallery
+
+    def append(images, generation):
+        face_ids = [face_id for _, ids, _ in images for face_id in ids]
+        filenames = [filename for filename, ids, _ in images for _ in ids]
+        append_to_gallery(face_ids, filenames, np.concatenate([e for _, _, e in images]), generation)
+
+    def load():
+        _, _, matrix, norms = load_gallery()
+        # Touch every page, as the first search does
+        float(np.asarray(matrix).sum()) + float(np.asarray(norms).sum())
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database.DB_PATH = os.path.join(tmp_dir, "database.db")
+        database.init_db()
+        load_gallery()
+        with database.BulkWriter(on_flush=append, batch_size=1024) as writer:
+            for file, faces in synthetic_rows(args.load_size // 3, 3, args.dim):
+                writer.add_group_image(file['path'], faces, content_hash=file['content_hash'])
+        result = _timed(load, args.repeat)
+        database.close_connections()
+    return result
+
+def _search(args, paths):
+    from app.core.similarity_matching import GallerySearchEngine
+
+    rng = np.random.default_rng(0)
+    results = {}
+    queries = rng.normal(size=(args.query_batch, args.dim)).astype(np.float32)
+    for size in args.sizes:
+        # Built in chunks and normalized in place, so 1M x 128 needs no temporary copy
+        matrix = np.empty((size, args.dim), dtype=np.float32)
+        for start in range(0, size, 65536):
+            matrix[start:start + 65536] = rng.normal(size=(min(65536, size - start), args.dim))
+        norms = np.linalg.norm(matrix, axis=1)
+        matrix /= norms[:, None]
+        engine = GallerySearchEngine(range(size), matrix, norms=norms)
+
+        # Single queries are timed over the whole query set, as one call is too short to time alone
+        results[f"search_{size}"] = _timed(lambda: [engine.search(query, k=args.top_k) for query in queries],
+                                           args.repeat, items=len(queries))
+        results[f"search_batch_{size}"] = _timed(lambda: engine.search(queries, k=args.top_k), args.repeat,
+                                                 items=len(queries))
+        del engine, matrix
+    return results
+
+_STAGE_FUNCTIONS = {
+    'decode': _decode,
+    'detection': _detection,
+    'alignment': _alignment,
+    'embedding': _embedding,
+    'db_insert': _db_insert,
+    'gallery_load': _gallery_load,
+    'search': _search,
+}
+
+def run_suite(args):
+    """
+    Runs the selected stages.
+
+    Returns:
+        dict: {'meta': {...}, 'stages': {stage name: summary or {'skipped': reason}}}.
+    """
+    tmp_dir = None
+    if args.images:
+        paths = list_images(args.images)
+    else:
+        tmp_dir = tempfile.TemporaryDirectory()
+        paths = synthetic_images(tmp_dir.name, count=args.synthetic, width=args.width, height=args.height)
+
+    stages = {}
+    try:
+        for stage in args.stages:
+            start = time.perf_counter()
+            try:
+                result = _STAGE_FUNCTIONS[stage](args, paths)
+            except ImportError as e:
+                result = {'skipped': f"missing dependency: {e.name or e}"}
+            # search reports one entry per gallery size
+            entries = result if stage == "search" else {stage: result}
+            stages.update(entries)
+            for name, entry in entries.items():
+                print(_format_entry(name, entry))
+            print(f"  ({stage} took {time.perf_counter() - start:.1f}s)")
+    finally:
+        if tmp_dir:
+            tmp_dir.cleanup()
+
+    meta = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': {k: v for k, v in vars(args).items() if k not in ("command", "output", "baseline")},
+    }
+    return {'meta': meta, 'stages': stages}
+
+def compare(baseline, current, tolerance=0.1):
+    """
+    Compares the median time of every stage with a baseline.
+
+    Args:
+        baseline (dict): A result of run_suite (e.g. loaded from the baseline JSON).
+        current (dict): The result to check.
+        tolerance (float): Allowed relative slowdown, e.g. 0.1 for 10%.
+
+    Returns:
+        list: Names of the stages slower than the baseline by more than the tolerance.
+    """
+    regressions = []
+    print(f"{'stage':<24}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name in sorted(set(baseline['stages']) | set(current['stages'])):
+        old, new = baseline['stages'].get(name), current['stages'].get(name)
+        if not old or not new or 'median_s' not in old or 'median_s' not in new:
+            status = "missing" if not old or not new else "skipped"
+            print(f"{name:<24}{'':>14}{'':>14}{'':>10}  {status}")
+            continue
+        change = new['median_s'] / old['median_s'] - 1 if old['median_s'] else 0.0
+        status = ""
+        if change > tolerance:
+            status = "REGRESSION"
+            regressions.append(name)
+        elif change < -tolerance:
+            status = "improved"
+        print(f"{name:<24}{_format_seconds(old['median_s']):>14}{_format_seconds(new['median_s']):>14}"
+              f"{change:>+10.1%}  {status}")
+    return regressions
+
+def _format_seconds(seconds):
+    return f"{seconds * 1000:.3f} ms" if seconds < 1 else f"{seconds:.2f} s"
+
+def _format_entry(name, entry):
+    if 'skipped' in entry:
+        return f"{name:<24} skipped ({entry['skipped']})"
+    return (f"{name:<24} median {_format_seconds(entry['median_s']):>12}  p90 {_format_seconds(entry['p90_s']):>12}"
+            f"  {entry['per_sec']:12.1f}/s")
+
+def _load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Run the benchmark suite.")
+    run.add_argument("--output", default="bench_results.json", help="JSON file the results are written to.")
+    run.add_argument("--baseline", help="Compare the results with this baseline JSON file.")
+    run.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative slowdown.")
+    run.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    run.add_argument("--images", help="Folder of sample images instead of synthetic ones.")
+    run.add_argument("--synthetic", type=int, default=5, help="Number of synthetic images.")
+    run.add_argument("--width", type=int, default=4000, help="Synthetic image width.")
+    run.add_argument("--height", type=int, default=3000, help="Synthetic image height.")
+    run.add_argument("--max-side", type=int, default=1600, help="Longest side used for detection.")
+    run.add_argument("--faces", type=int, default=64, help="Faces aligned and embedded per run.")
+    run.add_argument("--align-size", type=int, default=160, help="Aligned face size (model input size).")
+    run.add_argument("--model-name", default="Facenet", help="Embedding model.")
+    run.add_argument("--batch-size", type=int, default=32, help="Faces per embedding forward pass.")
+    run.add_argument("--db-images", type=int, default=2000, help="Images inserted by the db_insert stage.")
+    run.add_argument("--load-size", type=int, default=100000, help="Faces in the gallery_load gallery.")
+    run.add_argument("--sizes", nargs="+", type=int, default=[1000, 100000, 1000000], help="Search gallery sizes.")
+    run.add_argument("--dim", type=int, default=128, help="Embedding dimension of synthetic galleries.")
+    run.add_argument("--query-batch", type=int, default=32, help="Queries per call in search_batch.")
+    run.add_argument("--top-k", type=int, default=10, help="Matches kept per query.")
+    run.add_argument("--repeat", type=int, default=5, help="Timed runs per stage.")
+
+    cmp = commands.add_parser("compare", help="Compare two result files.")
+    cmp.add_argument("baseline")
+    cmp.add_argument("current")
+    cmp.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative slowdown.")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_suite(args)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to '{args.output}'.")
+        if not args.baseline:
+            return
+        baseline, current = _load(args.baseline), results
+    else:
+        baseline, current = _load(args.baseline), _load(args.current)
+
+    regressions = compare(baseline, current, args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} stages regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
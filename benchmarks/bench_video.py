@@ -0,0 +1,131 @@
+"""
+Compares video ingestion by frame dumping (every frame decoded, run through the detector and every
+detected face embedded, as when a video is exported to images and added as a folder) with tracked
+ingestion (detection on sampled frames, optical-flow tracking in between, a few embeddings per track).
+
+Reports the frames processed per second, the number of detector calls and the embeddings computed per
+minute of video. Each mode runs in its own process. Only the first --seconds of the video are used.
+
+Usage:
+    python -m benchmarks.bench_video --video path/to/clip.mp4 --seconds 60
+    python -m benchmarks.bench_video --video clip.mp4 --detect-interval 1.0 --track-fps 5 --max-side 1280
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import cv2
+from benchmarks.common import peak_rss_mb, run_isolated
+
+def _clip(video, seconds, folder):
+    """Writes the first `seconds` of a video to an MJPEG file, so both modes decode the same frames."""
+    capture = cv2.VideoCapture(video)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    path = os.path.join(folder, "clip.avi")
+    writer = None
+    for _ in range(int(seconds * fps)):
+        ok, frame = capture.read()
+        if not ok:
+            break
+        if writer is None:
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (frame.shape[1], frame.shape[0]))
+        writer.write(frame)
+    capture.release()
+    if writer is None:
+        raise SystemExit(f"Unable to read video: {video}")
+    writer.release()
+    return path
+
+def _measure_frames(path, args):
+    from app.core.model_registry import warm_up
+    from app.runner.add_image_runner import alignment_size, detect_and_align_faces
+    from app.core.feature_extraction import extract_face_embeddings
+
+    warm_up(model_names=[args.model])
+    align_size = alignment_size(args.model, args.alignment)
+    capture = cv2.VideoCapture(path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    frames = detector_calls = embeddings = 0
+    start = time.perf_counter()
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames += 1
+        detector_calls += 1
+        _, aligned = detect_and_align_faces(frame, detection_max_side=args.max_side, align_size=align_size)
+        if aligned:
+            embeddings += len(extract_face_embeddings(aligned, model_name=args.model, batch_size=args.batch_size))
+    capture.release()
+    return frames, fps, detector_calls, embeddings, time.perf_counter() - start
+
+def _measure_tracked(path, args):
+    from app.core.model_registry import warm_up
+    from app.runner.video_runner import track_video
+
+    warm_up(model_names=[args.model])
+    start = time.perf_counter()
+    _, stats = track_video(path, model_name=args.model, alignment=args.alignment, detection_max_side=args.max_side,
+                           detect_interval=args.detect_interval, track_fps=args.track_fps,
+                           samples_per_track=args.samples_per_track, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - start
+    fps = stats['frames'] / max(stats['duration_s'], 1e-9)
+    return stats['frames'], fps, stats['detection_frames'], stats['embeddings'], elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--video", required=True, help="Sample video with faces.")
+    parser.add_argument("--seconds", type=float, default=60, help="Length of video used.")
+    parser.add_argument("--model", default="Facenet", help="Face recognition model.")
+    parser.add_argument("--alignment", default="roi", choices=["legacy", "roi"], help="Face alignment.")
+    parser.add_argument("--max-side", type=int, default=None, help="Longest frame side used for detection.")
+    parser.add_argument("--batch-size", type=int, default=32, help="Faces embedded per forward pass.")
+    parser.add_argument("--detect-interval", type=float, default=0.5, help="Seconds between detection frames.")
+    parser.add_argument("--track-fps", type=float, default=10, help="Frames/sec of optical-flow tracking.")
+    parser.add_argument("--samples-per-track", type=int, default=3, help="Detections embedded per track.")
+    parser.add_argument("--mode", choices=["frames", "tracked"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        frames, fps, detector_calls, embeddings, elapsed = (_measure_frames if args.mode == "frames"
+                                                             else _measure_tracked)(args.video, args)
+        minutes = frames / fps / 60
+        print(json.dumps({
+            'mode': args.mode,
+            'frames': frames,
+            'seconds': round(elapsed, 2),
+            'frames_per_sec': round(frames / elapsed, 1),
+            'detector_calls': detector_calls,
+            'embeddings': embeddings,
+            'embeddings_per_min': round(embeddings / max(minutes, 1e-9), 1),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }))
+        return
+
+    folder = tempfile.mkdtemp(prefix="photoscan_bench_")
+    try:
+        clip = _clip(args.video, args.seconds, folder)
+        options = ["--video", clip, "--model", args.model, "--alignment", args.alignment,
+                   "--batch-size", str(args.batch_size), "--detect-interval", str(args.detect_interval),
+                   "--track-fps", str(args.track_fps), "--samples-per-track", str(args.samples_per_track)]
+        if args.max_side:
+            options += ["--max-side", str(args.max_side)]
+
+        print(f"{'mode':<10}{'frames':>8}{'seconds':>10}{'frames/s':>10}{'detector':>10}{'embeddings':>12}"
+              f"{'emb./min':>10}{'peak RSS MB':>13}")
+        results = []
+        for mode in ("frames", "tracked"):
+            result = run_isolated("benchmarks.bench_video", options + ["--mode", mode])
+            results.append(result)
+            print(f"{result['mode']:<10}{result['frames']:>8}{result['seconds']:>10.1f}{result['frames_per_sec']:>10.1f}"
+                  f"{result['detector_calls']:>10}{result['embeddings']:>12}{result['embeddings_per_min']:>10.1f}"
+                  f"{result['peak_rss_mb']:>13.1f}")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    print(json.dumps(results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the current process, in MB.
+
+    Note that the value only grows over the life of a process, so each measured variant should
+    run in its own process (see run_isolated).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_isolated(module, args):
+    """
+    Runs a benchmark module in a fresh Python process and returns the JSON it prints last.
+
+    Args:
+        module (str): Module to run with `python -m`, e.g. "benchmarks.bench_detection".
+        args (list): Command-line arguments for the module.
+
+    Returns:
+        dict: The parsed JSON result.
+    """
+    output = subprocess.run([sys.executable, "-m", module] + list(args), cwd=REPO_ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def synthetic_images(folder, count=5, width=6000, height=4000, seed=0):
+    """
+    Writes synthetic JPEG images to a folder, for benchmarks that run without sample photos.
+
+    Args:
+        folder (str): Output folder, created if missing.
+        count (int): Number of images.
+        width (int): Image width in pixels.
+        height (int): Image height in pixels.
+        seed (int): Random seed.
+
+    Returns:
+        list: Paths of the written images.
+    """
+    import cv2
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        # Smooth noise compresses and decodes like a real photo, unlike white noise
+        small = rng.integers(0, 256, size=(height // 50, width // 50, 3), dtype=np.uint8)
+        img = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+        path = os.path.join(folder, f"synthetic_{i:03d}.jpg")
+        cv2.imwrite(path, img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        paths.append(path)
+    return paths
+
+def synthetic_faces(count, width=6000, height=4000, seed=0):
+    """
+    A large random image with faces given by randomly rotated and scaled reference landmarks.
+
+    Args:
+        count (int): Number of faces.
+        width (int): Image width in pixels.
+        height (int): Image height in pixels.
+        seed (int): Random seed.
+
+    Returns:
+        list: One (image, faces) pair, with faces in the detect_faces format (box and keypoints).
+    """
+    from app.core.face_alignment import LANDMARK_NAMES, REFERENCE_LANDMARKS
+
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    faces = []
+    for _ in range(count):
+        angle, scale = np.radians(rng.uniform(-30, 30)), rng.uniform(1.0, 3.0)
+        rotation = scale * np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        offset = rng.uniform([200, 200], [width - 600, height - 600])
+        points = REFERENCE_LANDMARKS @ rotation.T + offset + rng.normal(0, 1.5, size=(5, 2))
+        x0, y0 = (REFERENCE_LANDMARKS.min(axis=0) @ rotation.T + offset - 40 * scale).astype(int)
+        size = int(112 * scale)
+        faces.append({
+            'box': [int(x0), int(y0), size, size],
+            'keypoints': {name: (int(px), int(py)) for name, (px, py) in zip(LANDMARK_NAMES, points)},
+        })
+    return [(img, faces)]
+
+def synthetic_rows(count, faces_per_image, dim, seed=0):
+    """
+    Builds synthetic group images for ingestion benchmarks, with random face embeddings.
+
+    Args:
+        count (int): Number of images.
+        faces_per_image (int): Faces per image.
+        dim (int): Embedding dimension.
+        seed (int): Random seed.
+
+    Returns:
+        list: (manifest file dict, faces) pairs, with faces in the format of insert_group_image.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(count):
+        faces = [{'box': [10, 20, 80, 80], 'confidence': 0.99,
+                  'keypoints': {'left_eye': (30, 40), 'right_eye': (70, 40)},
+                  'embedding': rng.normal(size=dim).astype(np.float32)} for _ in range(faces_per_image)]
+        file = {'path': f"image_{i:06d}.jpg", 'content_hash': f"{i:040x}", 'size': 1, 'mtime_ns': i}
+        rows.append((file, faces))
+    return rows
+
+def synthetic_gallery(path, count, dim, faces_per_identity, noise, seed=0, chunk=65536):
+    """
+    Writes a synthetic gallery matrix of noisy faces around random identity centres to a memory-mapped file.
+
+    Rows are written in chunks, so galleries larger than memory can be generated.
+
+    Args:
+        path (str): Output file of the (count, dim) float32 L2-normalized rows.
+        count (int): Number of faces; face i belongs to identity i % (count // faces_per_identity).
+        dim (int): Embedding dimension.
+        faces_per_identity (int): Average faces per identity.
+        noise (float): Standard deviation of the per-dimension noise around the unit-norm centres.
+        seed (int): Random seed.
+        chunk (int): Number of rows generated at once.
+
+    Returns:
+        tuple: (identities, norms) with the identity of every row and the norms before normalization.
+    """
+    rng = np.random.default_rng(seed)
+    identities = max(1, count // faces_per_identity)
+    centres = rng.normal(size=(identities, dim)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+
+    matrix = np.memmap(path, dtype=np.float32, mode='w+', shape=(count, dim))
+    norms = np.empty(count, dtype=np.float32)
+    for start in range(0, count, chunk):
+        rows = np.arange(start, min(count, start + chunk))
+        block = centres[rows % identities] + rng.normal(0, noise, size=(len(rows), dim)).astype(np.float32)
+        norms[rows] = np.linalg.norm(block, axis=1)
+        matrix[rows] = block / norms[rows, None]
+    matrix.flush()
+    return np.arange(count) % identities, norms
+
+def list_images(folder, extensions=(".jpg", ".jpeg", ".png")):
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(extensions))
@@ -1,16 +1,15 @@
 # main.py
 import os
 from dotenv import load_dotenv
-from app.data.database import init_db, is_image_in_db
-from app.runner.add_image_runner import add_reference_image, add_group_image, add_group_images_from_folder
-from app.runner.search_runner import search_in_group_images
+from app.core.metrics import configure as configure_metrics
+from app.data.database import init_db, is_reference_image_in_db
+
+# Runners are imported by the mode that uses them, so that e.g. a search over stored embeddings
+# does not pay for loading OpenCV, MTCNN or TensorFlow
 
 # Load environment variables
 load_dotenv()
 
-# Initialize the database
-init_db()
-
 # Read environment variables
 MODE = os.getenv("MODE")
 IMAGE_PATH = os.getenv("IMAGE_PATH")
@@ -19,48 +18,234 @@ SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", 0.8))
 MODEL_NAME = os.getenv("MODEL_NAME", "Facenet")
 ADD_MODE = os.getenv("ADD_MODE", "single")
 IMAGE_TYPE = os.getenv("IMAGE_TYPE", "ref")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+RECURSIVE = os.getenv("RECURSIVE", "False").lower() in ["true", "1", "yes"]
+# Longest image side used for face detection (0 = detect at full resolution)
+DETECTION_MAX_SIDE = int(os.getenv("DETECTION_MAX_SIDE", 1600)) or None
+# Tiled detection of group images larger than DETECTION_TILE_SIZE (0 = disabled): full-resolution tiles
+# overlapping by DETECTION_TILE_OVERLAP pixels, DETECTION_TILE_WORKERS at a time, plus one pass at
+# DETECTION_MAX_SIDE for faces larger than the overlap
+DETECTION_TILE_SIZE = int(os.getenv("DETECTION_TILE_SIZE", 0))
+DETECTION_TILE_OVERLAP = int(os.getenv("DETECTION_TILE_OVERLAP", 256))
+DETECTION_TILE_WORKERS = int(os.getenv("DETECTION_TILE_WORKERS", 2))
+DETECTION_TILING = dict(tile_size=DETECTION_TILE_SIZE, tile_overlap=DETECTION_TILE_OVERLAP,
+                        tile_workers=DETECTION_TILE_WORKERS) if DETECTION_TILE_SIZE > 0 else None
+# ALIGNMENT options: legacy, roi (landmark similarity transform straight to the model input size)
+ALIGNMENT = os.getenv("ALIGNMENT", "legacy")
+
+# Pipelined folder ingestion (used when INFERENCE_WORKERS > 0)
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", 2))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 0))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 16))
+
+# Video ingestion (IMAGE_TYPE=video): sampled detection, face tracking, a few embeddings per track
+VIDEO_DETECT_INTERVAL = float(os.getenv("VIDEO_DETECT_INTERVAL", 0.5))
+VIDEO_TRACK_FPS = float(os.getenv("VIDEO_TRACK_FPS", 10))
+VIDEO_SAMPLES_PER_TRACK = int(os.getenv("VIDEO_SAMPLES_PER_TRACK", 3))
+VIDEO_SCENE_CUT = float(os.getenv("VIDEO_SCENE_CUT", 40))
+
+# Batch search: a folder of reference images or a text file listing one image path per line
+REFERENCE_SOURCE = os.getenv("REFERENCE_SOURCE")
+# Output format follows the extension: .csv, .json, .jsonl or .parquet
+RESULTS_PATH = os.getenv("RESULTS_PATH", "results.csv")
+TOP_K = int(os.getenv("TOP_K", 0)) or None
+
+# Local recognition service (MODE=serve); requests are coalesced into micro-batches
+SERVICE_HOST = os.getenv("SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", 8765))
+MICRO_BATCH_SIZE = int(os.getenv("MICRO_BATCH_SIZE", 16))
+MICRO_BATCH_WAIT_MS = float(os.getenv("MICRO_BATCH_WAIT_MS", 5))
+
+# Approximate nearest-neighbour search settings
+ANN_INDEX = os.getenv("ANN_INDEX", "none")
+ANN_NLIST = int(os.getenv("ANN_NLIST", 0)) or None
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", 8))
+
+# Compressed gallery search (GALLERY_QUANTIZATION options: none, float16, int8, pq)
+GALLERY_QUANTIZATION = os.getenv("GALLERY_QUANTIZATION", "none")
+RERANK_FACTOR = int(os.getenv("RERANK_FACTOR", 4))
+PQ_SUBSPACES = int(os.getenv("PQ_SUBSPACES", 0)) or None
+
+# Sharded gallery search: shards are searched in parallel by SEARCH_WORKERS processes (0 = one per CPU)
+GALLERY_SHARDS = int(os.getenv("GALLERY_SHARDS", 0))
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", 0))
+
+# Unknown-face clustering (MODE=cluster); faces are linked when they pass SIMILARITY_THRESHOLD
+CLUSTER_MEMORY_MB = int(os.getenv("CLUSTER_MEMORY_MB", 512))
+CLUSTER_MIN_SIZE = int(os.getenv("CLUSTER_MIN_SIZE", 2))
+CLUSTER_REBUILD = os.getenv("CLUSTER_REBUILD", "False").lower() in ["true", "1", "yes"]
+
+# Identities (MODE=identify): IDENTITY_FOLDER holds one sub-folder of reference images per identity, whose
+# embeddings are aggregated into TEMPLATES_PER_IDENTITY templates (TEMPLATE_AGGREGATION options: mean, medoid)
+IDENTITY_FOLDER = os.getenv("IDENTITY_FOLDER")
+IDENTITY_NAME = os.getenv("IDENTITY_NAME")
+TEMPLATE_AGGREGATION = os.getenv("TEMPLATE_AGGREGATION", "mean")
+TEMPLATES_PER_IDENTITY = int(os.getenv("TEMPLATES_PER_IDENTITY", 1))
+IDENTITY_REBUILD = os.getenv("IDENTITY_REBUILD", "False").lower() in ["true", "1", "yes"]
+
+# Metrics (METRICS_SINK options: none, jsonl, prometheus) and profiling (PROFILER options: none, cprofile, sample)
+METRICS_SINK = os.getenv("METRICS_SINK", "none")
+METRICS_PATH = os.getenv("METRICS_PATH") or None
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", 10))
+PROFILER = os.getenv("PROFILER", "none")
+PROFILE_PATH = os.getenv("PROFILE_PATH") or None
 
 def main():
     if MODE == "add":
+        from app.core.model_registry import warm_up
+        from app.runner.add_image_runner import add_reference_image, add_group_image, add_group_images_from_folder
+
+        # Build the detector and embedding model once, before processing any image. Pipelined ingestion
+        # runs them in its inference workers, which build their own.
+        if not (IMAGE_TYPE == "group" and ADD_MODE == "folder" and INFERENCE_WORKERS > 0):
+            warm_up(model_names=[MODEL_NAME])
+
         if IMAGE_TYPE == "ref":
             if not IMAGE_PATH or not os.path.exists(IMAGE_PATH):
                 print(f"Error: IMAGE_PATH '{IMAGE_PATH}' is invalid or does not exist.")
                 return
-            add_reference_image(IMAGE_PATH, model_name=MODEL_NAME)
+            add_reference_image(IMAGE_PATH, model_name=MODEL_NAME, detection_max_side=DETECTION_MAX_SIDE,
+                                alignment=ALIGNMENT)
 
         elif IMAGE_TYPE == "group":
             if ADD_MODE == "folder":
                 if not FOLDER_PATH or not os.path.isdir(FOLDER_PATH):
                     print(f"Error: FOLDER_PATH '{FOLDER_PATH}' is invalid or does not exist.")
                     return
-                add_group_images_from_folder(FOLDER_PATH)
+                if INFERENCE_WORKERS > 0:
+                    from app.runner.pipeline_runner import add_group_images_pipelined
+
+                    add_group_images_pipelined(FOLDER_PATH, model_name=MODEL_NAME, decode_workers=DECODE_WORKERS,
+                                               inference_workers=INFERENCE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE,
+                                               batch_size=EMBED_BATCH_SIZE, recursive=RECURSIVE,
+                                               detection_max_side=DETECTION_MAX_SIDE, alignment=ALIGNMENT,
+                                               detection_tiling=DETECTION_TILING)
+                else:
+                    add_group_images_from_folder(FOLDER_PATH, model_name=MODEL_NAME, batch_size=EMBED_BATCH_SIZE,
+                                                 recursive=RECURSIVE, detection_max_side=DETECTION_MAX_SIDE,
+                                                 alignment=ALIGNMENT, detection_tiling=DETECTION_TILING)
             elif ADD_MODE == "single":
                 if not IMAGE_PATH or not os.path.exists(IMAGE_PATH):
                     print(f"Error: IMAGE_PATH '{IMAGE_PATH}' is invalid or does not exist.")
                     return
-                add_group_image(IMAGE_PATH)
+                add_group_image(IMAGE_PATH, model_name=MODEL_NAME, batch_size=EMBED_BATCH_SIZE,
+                                detection_max_side=DETECTION_MAX_SIDE, alignment=ALIGNMENT,
+                                detection_tiling=DETECTION_TILING)
+            else:
+                print(f"Error: Invalid ADD_MODE '{ADD_MODE}'. Use 'single' or 'folder'.")
+        elif IMAGE_TYPE == "video":
+            from app.runner.video_runner import add_video, add_videos_from_folder
+
+            options = dict(model_name=MODEL_NAME, alignment=ALIGNMENT, detection_max_side=DETECTION_MAX_SIDE,
+                           detect_interval=VIDEO_DETECT_INTERVAL, track_fps=VIDEO_TRACK_FPS,
+                           samples_per_track=VIDEO_SAMPLES_PER_TRACK, scene_cut=VIDEO_SCENE_CUT,
+                           batch_size=EMBED_BATCH_SIZE)
+            if ADD_MODE == "folder":
+                if not FOLDER_PATH or not os.path.isdir(FOLDER_PATH):
+                    print(f"Error: FOLDER_PATH '{FOLDER_PATH}' is invalid or does not exist.")
+                    return
+                add_videos_from_folder(FOLDER_PATH, recursive=RECURSIVE, **options)
+            elif ADD_MODE == "single":
+                if not IMAGE_PATH or not os.path.exists(IMAGE_PATH):
+                    print(f"Error: IMAGE_PATH '{IMAGE_PATH}' is invalid or does not exist.")
+                    return
+                add_video(IMAGE_PATH, **options)
             else:
                 print(f"Error: Invalid ADD_MODE '{ADD_MODE}'. Use 'single' or 'folder'.")
         else:
-            print(f"Error: Invalid IMAGE_TYPE '{IMAGE_TYPE}'. Use 'ref' or 'group'.")
+            print(f"Error: Invalid IMAGE_TYPE '{IMAGE_TYPE}'. Use 'ref', 'group' or 'video'.")
 
     elif MODE == "search":
         if not IMAGE_PATH or not os.path.exists(IMAGE_PATH):
             print(f"Error: IMAGE_PATH '{IMAGE_PATH}' is invalid or does not exist.")
             return
 
+        from app.runner.search_runner import search_in_group_images
+
         filename = os.path.basename(IMAGE_PATH)
         
-        # Check if reference image is already in the database
-        if not is_image_in_db("reference_images", filename):
+        # Check if reference image is already in the database, embedded with the same model
+        if not is_reference_image_in_db(filename, MODEL_NAME, ALIGNMENT):
+            from app.runner.add_image_runner import add_reference_image
+
             print(f"Reference image '{filename}' not found in the database. Adding it now...")
-            add_reference_image(IMAGE_PATH, model_name=MODEL_NAME)
+            add_reference_image(IMAGE_PATH, model_name=MODEL_NAME, detection_max_side=DETECTION_MAX_SIDE,
+                                alignment=ALIGNMENT)
         
         # Proceed with the search
-        search_in_group_images(IMAGE_PATH, similarity_threshold=SIMILARITY_THRESHOLD)
+        search_in_group_images(IMAGE_PATH, similarity_threshold=SIMILARITY_THRESHOLD,
+                               use_ann=ANN_INDEX == "ivf", nprobe=ANN_NPROBE, nlist=ANN_NLIST,
+                               model_name=MODEL_NAME, alignment=ALIGNMENT, quantization=GALLERY_QUANTIZATION,
+                               rerank=RERANK_FACTOR, pq_subspaces=PQ_SUBSPACES, shards=GALLERY_SHARDS,
+                               search_workers=SEARCH_WORKERS)
+
+    elif MODE == "batch_search":
+        if not REFERENCE_SOURCE or not os.path.exists(REFERENCE_SOURCE):
+            print(f"Error: REFERENCE_SOURCE '{REFERENCE_SOURCE}' is invalid or does not exist.")
+            return
+
+        from app.runner.batch_search_runner import batch_search_in_group_images
+
+        batch_search_in_group_images(REFERENCE_SOURCE, RESULTS_PATH, similarity_threshold=SIMILARITY_THRESHOLD,
+                                     top_k=TOP_K, model_name=MODEL_NAME, alignment=ALIGNMENT,
+                                     batch_size=EMBED_BATCH_SIZE, detection_max_side=DETECTION_MAX_SIDE,
+                                     quantization=GALLERY_QUANTIZATION, rerank=RERANK_FACTOR, pq_subspaces=PQ_SUBSPACES,
+                                     shards=GALLERY_SHARDS, search_workers=SEARCH_WORKERS)
+
+    elif MODE == "serve":
+        from app.runner.service_runner import run_service
+
+        run_service(host=SERVICE_HOST, port=SERVICE_PORT, model_name=MODEL_NAME, alignment=ALIGNMENT,
+                    detection_max_side=DETECTION_MAX_SIDE, similarity_threshold=SIMILARITY_THRESHOLD,
+                    max_batch_size=MICRO_BATCH_SIZE, max_wait_ms=MICRO_BATCH_WAIT_MS, quantization=GALLERY_QUANTIZATION,
+                    rerank=RERANK_FACTOR, pq_subspaces=PQ_SUBSPACES, shards=GALLERY_SHARDS, search_workers=SEARCH_WORKERS,
+                    detection_tiling=DETECTION_TILING)
+
+    elif MODE == "build_index":
+        from app.runner.index_runner import build_ann_index
+
+        build_ann_index(nlist=ANN_NLIST, model_name=MODEL_NAME, alignment=ALIGNMENT)
+
+    elif MODE == "shard":
+        from app.runner.index_runner import rebalance_shards
+
+        rebalance_shards(GALLERY_SHARDS, model_name=MODEL_NAME, alignment=ALIGNMENT)
+
+    elif MODE == "cluster":
+        from app.runner.cluster_runner import cluster_group_faces
+
+        cluster_group_faces(similarity_threshold=SIMILARITY_THRESHOLD, memory_mb=CLUSTER_MEMORY_MB,
+                            rebuild=CLUSTER_REBUILD, min_cluster_size=CLUSTER_MIN_SIZE, model_name=MODEL_NAME,
+                            alignment=ALIGNMENT)
+
+    elif MODE == "identify":
+        from app.runner.identity_runner import add_identities_from_folder, find_identity_photos, label_group_faces
+
+        if IDENTITY_NAME:
+            find_identity_photos(IDENTITY_NAME, similarity_threshold=SIMILARITY_THRESHOLD, model_name=MODEL_NAME,
+                                 alignment=ALIGNMENT)
+            return
+        if IDENTITY_FOLDER:
+            if not os.path.isdir(IDENTITY_FOLDER):
+                print(f"Error: IDENTITY_FOLDER '{IDENTITY_FOLDER}' is invalid or does not exist.")
+                return
+            from app.core.model_registry import warm_up
+
+            warm_up(model_names=[MODEL_NAME])
+            add_identities_from_folder(IDENTITY_FOLDER, model_name=MODEL_NAME, batch_size=EMBED_BATCH_SIZE,
+                                       detection_max_side=DETECTION_MAX_SIDE, alignment=ALIGNMENT)
+        label_group_faces(aggregation=TEMPLATE_AGGREGATION, templates_per_identity=TEMPLATES_PER_IDENTITY,
+                          similarity_threshold=SIMILARITY_THRESHOLD, rebuild=IDENTITY_REBUILD, model_name=MODEL_NAME,
+                          alignment=ALIGNMENT)
 
     else:
-        print(f"Error: Invalid MODE '{MODE}'. Use 'add' or 'search'.")
+        print(f"Error: Invalid MODE '{MODE}'. Use 'add', 'search', 'batch_search', 'serve', 'build_index', "
+              f"'shard', 'cluster' or 'identify'.")
 
 if __name__ == "__main__":
+    # Not at import: spawned worker processes re-import this module as __mp_main__. The pipeline
+    # workers are handed the metrics settings instead.
+    init_db(model_name=MODEL_NAME)
+    configure_metrics(sink=METRICS_SINK, path=METRICS_PATH, interval=METRICS_INTERVAL, profiler=PROFILER,
+                      profile_path=PROFILE_PATH)
     main()
@@ -1,21 +1,31 @@
 import os
 from dotenv import load_dotenv
-from app.converter.convert import convert_to_jpg
+from app.converter.convert import convert_folder, convert_to_jpg
 
 def main():
     load_dotenv()  # Load variables from .env file
 
     input_path = os.getenv('INPUT_PATH')
-    output_path = os.getenv('OUTPUT_PATH')
+    output_path = os.getenv('OUTPUT_PATH') or None
     quality = int(os.getenv('QUALITY', 85))
     optimize = os.getenv('OPTIMIZE', 'True').lower() in ['true', '1', 'yes']
     progressive = os.getenv('PROGRESSIVE', 'False').lower() in ['true', '1', 'yes']
+    # RAW_MODE options: full, half (half-size decode, much faster), thumbnail (embedded JPEG preview)
+    raw_mode = os.getenv('RAW_MODE', 'full')
+    # Folder conversion only: number of processes (0 = one per CPU), sub-folders, re-convert up-to-date files
+    workers = int(os.getenv('CONVERT_WORKERS', 0)) or None
+    recursive = os.getenv('RECURSIVE', 'False').lower() in ['true', '1', 'yes']
+    overwrite = os.getenv('OVERWRITE', 'False').lower() in ['true', '1', 'yes']
 
     if not input_path:
         print("Error: INPUT_PATH not specified in .env file.")
         return
 
-    convert_to_jpg(input_path, output_path, quality, optimize, progressive)
+    if os.path.isdir(input_path):
+        convert_folder(input_path, output_path, workers=workers, quality=quality, optimize=optimize,
+                       progressive=progressive, raw_mode=raw_mode, recursive=recursive, overwrite=overwrite)
+    else:
+        convert_to_jpg(input_path, output_path, quality, optimize, progressive, raw_mode=raw_mode)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,10 @@
+import pytest
+from app.data import database
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """An empty database, with its gallery files, in a temporary directory."""
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "database.db"))
+    database.init_db()
+    yield database
+    database.close_connections()
@@ -0,0 +1,53 @@
+import numpy as np
+from app.core.ann_index import IVFIndex
+from app.core.similarity_matching import GallerySearchEngine
+from app.data.gallery_matrix import load_gallery, load_ivf_index
+from app.runner.add_image_runner import store_group_image
+from app.runner.index_runner import build_ann_index, load_ann_index
+
+def _clusters(rng, count=400, centers=16, dim=32):
+    means = rng.normal(size=(centers, dim))
+    return (means[rng.integers(centers, size=count)] + rng.normal(scale=0.3, size=(count, dim))).astype(np.float32)
+
+def _store(rows, start=0):
+    for i in range(0, len(rows), 2):
+        faces = [{'box': [10 * j, 0, 10, 10], 'confidence': 0.9, 'keypoints': {}} for j in range(2)]
+        assert store_group_image(f"/photos/{start + i}.jpg", faces, rows[i:i + 2])
+
+def _assert_same(hits, expected):
+    assert [row for row, _ in hits] == [row for row, _ in expected]
+    np.testing.assert_allclose([score for _, score in hits], [score for _, score in expected], rtol=1e-6)
+
+def test_probing_every_cell_returns_the_exact_results():
+    rng = np.random.default_rng(0)
+    rows = _clusters(rng)
+    engine = GallerySearchEngine(range(len(rows)), rows)
+    index = IVFIndex.train(engine.matrix, nlist=20)
+    np.testing.assert_array_equal(index.candidates(rows[0], nprobe=20), np.arange(len(rows)))
+
+    for query in rows[:5] + rng.normal(scale=0.1, size=(5, 32)).astype(np.float32):
+        _assert_same(index.search(engine, query, nprobe=20, k=5), engine.search(query, k=5)[0])
+        _assert_same(index.search(engine, query, nprobe=20, threshold=0.7), engine.search(query, threshold=0.7)[0])
+        # The nearest rows lie in the query's own cell, so a few cells already find them, with exact scores
+        _assert_same(index.search(engine, query, nprobe=2, k=3), engine.search(query, k=3)[0])
+
+def test_stored_index_follows_the_gallery(db):
+    rng = np.random.default_rng(1)
+    rows = _clusters(rng, count=200)
+    _store(rows[:160])
+    index = build_ann_index(nlist=8)
+    assert len(index) == 160
+
+    # Images stored afterwards are assigned to the persisted cells as they are added
+    _store(rows[160:], start=160)
+    _, assignments = load_ivf_index()
+    _, _, matrix, norms = load_gallery()
+    assert len(assignments) == len(matrix) == 200
+    np.testing.assert_array_equal(assignments[160:], index.assign(matrix[160:]))
+
+    loaded = load_ann_index(matrix)
+    np.testing.assert_array_equal(loaded.centroids, index.centroids)
+    engine = GallerySearchEngine(range(len(matrix)), matrix, norms=norms)
+    query = rows[180] * 1.1
+    _assert_same(loaded.search(engine, query, nprobe=8, k=3), engine.search(query, k=3)[0])
+    assert loaded.search(engine, query, nprobe=8, k=1)[0][0] == 180
@@ -0,0 +1,57 @@
+import numpy as np
+from app.data import database
+
+def _faces(rng, count=2):
+    return [{'box': [10 * i, 0, 10, 10], 'confidence': 0.9, 'keypoints': {},
+             'embedding': rng.normal(size=16).astype(np.float32)} for i in range(count)]
+
+def _entry(path):
+    return {'path': path, 'content_hash': f"hash-{path}", 'size': 3, 'mtime_ns': 1}
+
+def _stored_filenames(db):
+    cursor = db.get_connection().cursor()
+    return sorted(row[0] for row in cursor.execute("SELECT filename FROM group_images"))
+
+def test_rows_are_committed_in_one_flush(db):
+    rng = np.random.default_rng(0)
+    flushed = []
+    generation, _ = db.get_gallery_state()
+    with db.BulkWriter(batch_size=10, flush_interval=60, on_flush=lambda *args: flushed.append(args)) as writer:
+        first, second = _faces(rng), _faces(rng, 3)
+        writer.add_group_image("/a.jpg", first, "hash-/a.jpg")
+        writer.add_group_image("/b.jpg", second, "hash-/b.jpg")
+        writer.add_manifest_entries([_entry("/a.jpg"), _entry("/b.jpg")])
+        # Nothing is written before the batch is full or the block exits
+        assert _stored_filenames(db) == []
+
+    assert _stored_filenames(db) == ["/a.jpg", "/b.jpg"]
+    assert set(db.get_manifest_entries()) == {"/a.jpg", "/b.jpg"}
+    assert db.get_gallery_state() == (generation + 1, 5)
+    [(images, flushed_generation)] = flushed
+    assert flushed_generation == generation + 1
+    assert [(filename, len(ids)) for filename, ids, _ in images] == [("/a.jpg", 2), ("/b.jpg", 3)]
+    np.testing.assert_allclose(images[1][2], [face['embedding'] for face in second])
+
+def test_failed_flush_rolls_back_and_keeps_the_rows_buffered(db, monkeypatch):
+    rng = np.random.default_rng(1)
+    writer = db.BulkWriter(batch_size=10, flush_interval=60)
+    writer.add_group_image("/a.jpg", _faces(rng), "hash-/a.jpg")
+    writer.add_manifest_entries([_entry("/a.jpg")])
+
+    def fail(cursor, entries):
+        raise RuntimeError("disk full")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(database, "_insert_manifest_entries", fail)
+        assert not writer.flush()
+    # The image was inserted before the manifest failed, but the whole transaction is rolled back
+    assert _stored_filenames(db) == []
+    assert db.get_gallery_state()[1] == 0
+
+    assert writer.flush()
+    assert _stored_filenames(db) == ["/a.jpg"]
+    assert set(db.get_manifest_entries()) == {"/a.jpg"}
+    assert db.get_gallery_state()[1] == 2
+    # The buffer is empty once committed, so the rows are not written twice
+    assert writer.flush()
+    assert db.get_gallery_state()[1] == 2
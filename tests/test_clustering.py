@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from app.core.clustering import cluster_embeddings
+from app.core.similarity_matching import GallerySearchEngine
+from app.data.gallery_matrix import load_gallery
+from app.runner.add_image_runner import store_group_image
+from app.runner.cluster_runner import cluster_group_faces
+
+def _people(rng, count=240, people=12, dim=32):
+    identities = rng.normal(size=(people, dim))
+    return (identities[rng.integers(people, size=count)] + rng.normal(scale=0.35, size=(count, dim))).astype(np.float32)
+
+def _partition(labels):
+    """The clusters as a set of sets of rows, whatever their ids."""
+    clusters = {}
+    for row, label in enumerate(labels):
+        clusters.setdefault(label, set()).add(row)
+    return {frozenset(rows) for rows in clusters.values()}
+
+def _reference_clusters(rows, threshold, metric):
+    """Connected components of the full score matrix."""
+    scores = GallerySearchEngine(range(len(rows)), rows).score(rows, metric=metric)
+    linked = scores >= threshold if metric == "cosine" else scores <= threshold
+    return connected_components(csr_matrix(linked), directed=False)[1]
+
+@pytest.mark.parametrize("metric, threshold", [("cosine", 0.8), ("euclidean", 2.6)])
+def test_blocked_clustering_finds_the_connected_components(metric, threshold):
+    rows = _people(np.random.default_rng(0))
+    engine = GallerySearchEngine(range(len(rows)), rows)
+    expected = _partition(_reference_clusters(rows, threshold, metric))
+    assert 5 < len(expected) < len(rows)
+
+    # A budget of a few rows of scores per block
+    labels = cluster_embeddings(engine.matrix, engine.norms, threshold, metric=metric, memory_bytes=5 * 240 * 7)
+    assert _partition(labels) == expected
+
+    # New rows are merged into the existing clusters, which keep their ids
+    first = cluster_embeddings(engine.matrix[:150], engine.norms[:150], threshold, metric=metric)
+    labels = cluster_embeddings(engine.matrix, engine.norms, threshold, metric=metric, labels=first)
+    assert _partition(labels) == expected
+    for label in set(first.tolist()):
+        merged = labels[:150][first == label]
+        assert len(set(merged.tolist())) == 1 and merged[0] <= label
+
+def _assert_stored_clusters_are_exact(db):
+    """The stored clusters of the gallery faces are the connected components of the whole gallery."""
+    face_ids, _, matrix, norms = load_gallery()
+    labels, state = db.get_face_clusters()
+    assert not state['stale'] and set(labels) == set(face_ids)
+    expected = _reference_clusters(np.asarray(matrix) * np.asarray(norms)[:, None], 0.8, "cosine")
+    assert _partition([labels[face_id] for face_id in face_ids]) == _partition(expected)
+    return labels
+
+def test_stored_clusters_are_extended_with_new_faces(db, capsys):
+    rows = _people(np.random.default_rng(1), count=120)
+
+    def store(start, stop):
+        for i in range(start, stop, 2):
+            faces = [{'box': [10 * j, 0, 10, 10], 'confidence': 0.9, 'keypoints': {}} for j in range(2)]
+            assert store_group_image(f"/photos/{i}.jpg", faces, rows[i:i + 2])
+
+    store(0, 80)
+    cluster_group_faces(similarity_threshold=0.8, min_cluster_size=1)
+    before = _assert_stored_clusters_are_exact(db)
+
+    store(80, 120)
+    capsys.readouterr()
+    clusters = cluster_group_faces(similarity_threshold=0.8, min_cluster_size=1)
+    assert "Assigning 40 new group faces to the clusters of 80 faces" in capsys.readouterr().out
+    after = _assert_stored_clusters_are_exact(db)
+    assert sum(len(faces) for faces in clusters.values()) == 120
+    # Existing clusters keep their id, or the smallest id of the clusters they were merged with
+    for face_id, label in before.items():
+        assert after[face_id] <= label
+        assert all(after[other] == after[face_id] for other, other_label in before.items() if other_label == label)
+
+    # Replacing an image marks the clusters stale, and every face is clustered again
+    store(10, 12)
+    assert db.get_face_clusters()[1]['stale']
+    capsys.readouterr()
+    cluster_group_faces(similarity_threshold=0.8, min_cluster_size=1)
+    assert "Clustering 120 group faces" in capsys.readouterr().out
+    _assert_stored_clusters_are_exact(db)
@@ -0,0 +1,46 @@
+import os
+import cv2
+import numpy as np
+from PIL import Image
+from app.converter.convert import convert_folder, load_image
+
+def _image(rng, height=40, width=60):
+    """A smooth colour gradient, which survives JPEG compression closely."""
+    start, end = rng.uniform(0, 255, size=(2, 3))
+    ramp = np.linspace(0, 1, width)[None, :, None]
+    return np.broadcast_to(start + (end - start) * ramp, (height, width, 3)).astype(np.uint8)
+
+def test_pillow_formats_are_loaded_as_bgr(tmp_path):
+    rgb = np.zeros((8, 8, 3), dtype=np.uint8)
+    rgb[..., 0] = 255
+    Image.fromarray(rgb).save(tmp_path / "red.gif")
+
+    img = load_image(str(tmp_path / "red.gif"))
+    assert img.shape == (8, 8, 3)
+    assert tuple(img[0, 0]) == (0, 0, 255)
+    assert load_image(str(tmp_path / "missing.gif")) is None
+
+def test_folder_conversion_resumes_and_mirrors_sub_folders(tmp_path):
+    rng = np.random.default_rng(0)
+    source, output = tmp_path / "source", tmp_path / "jpg"
+    (source / "trip").mkdir(parents=True)
+    png = _image(rng)
+    cv2.imwrite(str(source / "a.png"), png)
+    cv2.imwrite(str(source / "trip" / "b.bmp"), _image(rng))
+    cv2.imwrite(str(source / "already.jpg"), _image(rng))
+    (source / "trip" / "broken.png").write_bytes(b"not an image")
+
+    stats = convert_folder(str(source), output_dir=str(output), workers=2, quality=95, recursive=True)
+
+    assert (stats['converted'], stats['skipped'], stats['failed']) == (2, 0, 1)
+    converted = sorted(os.path.relpath(os.path.join(root, name), output)
+                       for root, _, names in os.walk(output) for name in names)
+    # JPGs are not converted again, and a failed conversion leaves no partial file behind
+    assert converted == ["a.jpg", os.path.join("trip", "b.jpg")]
+    assert np.abs(load_image(str(output / "a.jpg")).astype(int) - png).mean() < 4
+
+    stats = convert_folder(str(source), output_dir=str(output), workers=2, recursive=True)
+    assert (stats['converted'], stats['skipped'], stats['failed']) == (0, 2, 1)
+    # A source newer than its JPG is converted again
+    os.utime(source / "a.png", ns=(os.stat(output / "a.jpg").st_mtime_ns + 10 ** 9,) * 2)
+    assert convert_folder(str(source), output_dir=str(output), workers=1, recursive=True)['converted'] == 1
@@ -0,0 +1,40 @@
+import cv2
+import numpy as np
+from app.core.face_alignment import LANDMARK_NAMES, REFERENCE_LANDMARKS, REFERENCE_SIZE, align_faces, face_transform
+
+def _face(center, size, angle):
+    """A face whose landmarks are the reference template, scaled, rotated by `angle` degrees and moved to `center`."""
+    template = (REFERENCE_LANDMARKS - REFERENCE_SIZE / 2) * size / REFERENCE_SIZE
+    theta = np.radians(angle)
+    rotation = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+    points = template @ rotation.T + center
+    x, y = center[0] - size / 2, center[1] - size / 2
+    return {'box': [int(x), int(y), size, size], 'confidence': 0.99,
+            'keypoints': {name: tuple(point) for name, point in zip(LANDMARK_NAMES, points)}}
+
+def _mapped(M, face):
+    src = np.array([face['keypoints'][name] for name in LANDMARK_NAMES])
+    return np.c_[src, np.ones(len(src))] @ M.T
+
+def test_landmarks_land_on_the_template_at_any_size_and_roll():
+    for center, size, angle in (((300, 200), 80, 0), ((120, 90), 40, 25), ((500, 400), 200, -40)):
+        face = _face(np.array(center, dtype=np.float64), size, angle)
+        for output_size in ((112, 112), (160, 160), (224, 224)):
+            expected = REFERENCE_LANDMARKS * np.array(output_size) / REFERENCE_SIZE
+            np.testing.assert_allclose(_mapped(face_transform(face, output_size), face), expected, atol=0.05)
+
+def test_faces_are_warped_into_one_batch_array():
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, size=(480, 640, 3), dtype=np.uint8)
+    faces = [_face(np.array([200.0, 150.0]), 100, 10), _face(np.array([450.0, 300.0]), 60, -20)]
+    # Without all five landmarks, the detection box is scaled onto the output
+    faces.append({'box': [20, 300, 80, 120], 'confidence': 0.9, 'keypoints': {'left_eye': (40, 340)}})
+
+    aligned = align_faces(img, faces, (96, 112))
+
+    assert aligned.shape == (3, 112, 96, 3) and aligned.dtype == np.uint8
+    for face, crop in zip(faces, aligned):
+        expected = cv2.warpAffine(img, face_transform(face, (96, 112)), (96, 112), flags=cv2.INTER_LINEAR)
+        np.testing.assert_array_equal(crop, expected)
+    np.testing.assert_allclose(face_transform(faces[2], (96, 112)), [[1.2, 0, -24], [0, 112 / 120, -280]], rtol=1e-6)
+    assert align_faces(img, [], (96, 112)).shape == (0, 112, 96, 3)
@@ -0,0 +1,96 @@
+import sys
+import threading
+import types
+import cv2
+import numpy as np
+import pytest
+from app.core import model_registry
+from app.core.face_detector import detect_faces, detect_faces_tiled, merge_detections
+
+class _SquareDetector:
+    """Finds white squares as faces; a square cut by the image edge is less confident than a whole one."""
+
+    def __init__(self):
+        self._busy = threading.Lock()
+        self.concurrent_calls = 0
+        self.shapes = []
+
+    def detect_faces(self, img):
+        if not self._busy.acquire(blocking=False):
+            self.concurrent_calls += 1
+            return []
+        try:
+            self.shapes.append(img.shape)
+            mask = (img[..., 0] > 127).astype(np.uint8)
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            faces = []
+            for contour in contours:
+                x, y, w, h = cv2.boundingRect(contour)
+                faces.append({'box': [x, y, w, h], 'confidence': min(w, h) / max(w, h),
+                              'keypoints': {'nose': (x + w // 2, y + h // 2)}})
+            return faces
+        finally:
+            self._busy.release()
+
+@pytest.fixture
+def detectors(monkeypatch):
+    created = []
+
+    def build():
+        created.append(_SquareDetector())
+        return created[-1]
+
+    monkeypatch.setitem(sys.modules, "mtcnn", types.SimpleNamespace(MTCNN=build))
+    monkeypatch.setattr(model_registry, "_detector", None)
+    monkeypatch.setattr(model_registry, "_idle_detectors", [])
+    return created
+
+def _face(x, y, size, confidence=0.9):
+    return {'box': [x, y, size, size], 'confidence': confidence, 'keypoints': {}}
+
+def test_merge_keeps_the_most_confident_of_overlapping_detections():
+    whole, shifted, apart = _face(100, 100, 40, 0.95), _face(104, 102, 40, 0.9), _face(300, 100, 40, 0.5)
+    # A piece of a face cut by a seam overlaps it too little by IoU, but lies inside it
+    piece = {'box': [100, 100, 15, 40], 'confidence': 0.6, 'keypoints': {}}
+    assert merge_detections([shifted, apart, piece, whole]) == [whole, apart]
+    assert merge_detections([piece, whole], containment=1.0) == [whole, piece]
+    assert merge_detections([shifted, whole], iou_threshold=0.95, containment=1.0) == [whole, shifted]
+    assert merge_detections([]) == []
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_tiled_detection_finds_each_face_once_in_full_image_coordinates(detectors, workers):
+    img = np.zeros((600, 900, 3), dtype=np.uint8)
+    # Faces astride the tile seams, in a corner and one larger than a tile (found on the downscaled copy)
+    faces = [(180, 30, 40), (400, 180, 60), (860, 560, 30), (480, 300, 260)]
+    for x, y, size in faces:
+        img[y:y + size, x:x + size] = 255
+
+    found = detect_faces_tiled(img, 256, overlap=80, workers=workers)
+
+    boxes = sorted(face['box'] for face in found)
+    assert len(boxes) == len(faces)
+    for box, (x, y, size) in zip(boxes, sorted(faces)):
+        # The large face is mapped back from the copy downscaled 3.5 times, to within a pixel of it
+        np.testing.assert_allclose(box, [x, y, size, size], atol=5 if size > 256 else 0)
+    assert all(detector.concurrent_calls == 0 for detector in detectors)
+    assert len(detectors) <= workers + 1
+
+def test_downscaled_detection_maps_faces_back_to_full_resolution(detectors):
+    img = np.zeros((1200, 3000, 3), dtype=np.uint8)
+    img[300:500, 1000:1200] = 255
+    img[800:1000, 2500:2700] = 255
+
+    faces = detect_faces(img, max_side=750)
+
+    [detector] = detectors
+    assert detector.shapes == [(300, 750, 3)]
+    boxes = sorted(face['box'] for face in faces)
+    # A pixel of the detection image is 4 pixels of the full image
+    np.testing.assert_allclose(boxes, [[1000, 300, 200, 200], [2500, 800, 200, 200]], atol=4)
+    for face in faces:
+        x, y, w, h = face['box']
+        assert abs(face['keypoints']['nose'][0] - (x + w / 2)) <= 4 and abs(face['keypoints']['nose'][1] - (y + h / 2)) <= 4
+
+    # Images within max_side are detected as they are
+    assert [face['box'] for face in detect_faces(img[250:550, 950:1250], max_side=750)] == [[50, 50, 200, 200]]
+    assert detector.shapes[1] == (300, 300, 3)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from app.core import feature_extraction, metrics
+from app.core.feature_extraction import extract_face_embedding, extract_face_embeddings
+
+class _StubModel:
+    """A Keras-style client: a linear map of the flattened input, with a per-face forward pass too."""
+    input_shape = (4, 4)
+    output_shape = 3
+
+    def __init__(self):
+        self.weights = np.random.default_rng(0).normal(size=(4 * 4 * 3, 3)).astype(np.float32)
+        self.batch_shapes = []
+
+    def model(self, batch, training=False):
+        self.batch_shapes.append(batch.shape)
+        return batch.reshape(len(batch), -1) @ self.weights
+
+    def forward(self, img):
+        return self.model(img)[0]
+
+@pytest.fixture
+def model(monkeypatch):
+    stub = _StubModel()
+    monkeypatch.setattr(feature_extraction, "get_embedding_model", lambda model_name: stub)
+    monkeypatch.setattr(feature_extraction, "_preprocess",
+                        lambda face, model: face[None, :4, :4].astype(np.float32) / 255)
+    return stub
+
+def _faces(count):
+    rng = np.random.default_rng(1)
+    return [rng.integers(0, 256, size=(4, 4, 3), dtype=np.uint8) for _ in range(count)]
+
+@pytest.mark.parametrize("sink", ["none", "jsonl"])
+def test_batched_embeddings_match_single_faces(model, sink, tmp_path):
+    metrics.configure(sink=sink, path=str(tmp_path / "metrics.jsonl"), interval=0)
+    try:
+        faces = _faces(5)
+        embeddings = extract_face_embeddings(faces, batch_size=2)
+        expected = np.array([extract_face_embedding(face) for face in faces])
+    finally:
+        metrics.configure()
+    assert embeddings.shape == (5, 3) and embeddings.dtype == np.float32
+    np.testing.assert_allclose(embeddings, expected, rtol=1e-5)
+    # The last batch is padded to the batch size
+    assert {shape[0] for shape in model.batch_shapes[:3]} == {2}
+
+def test_no_faces_give_an_empty_matrix(model):
+    assert extract_face_embeddings([]).shape == (0, 3)
@@ -0,0 +1,28 @@
+import os
+import numpy as np
+from app.data.gallery_matrix import gallery_paths, load_gallery
+from app.runner.add_image_runner import store_group_image
+
+def _store(filename, rng, faces=2):
+    boxes = [{'box': [10 * i, 0, 10, 10], 'confidence': 0.9, 'keypoints': {}} for i in range(faces)]
+    embeddings = rng.normal(size=(faces, 16)).astype(np.float32)
+    assert store_group_image(filename, boxes, embeddings)
+    return embeddings
+
+def test_gallery_rows_stay_aligned_with_unusual_file_names(db):
+    rng = np.random.default_rng(0)
+    names = ["/photos/plain.jpg", "/photos/carriage\rreturn.jpg", "/photos/sep\x1cand line.jpg"]
+    expected = {}
+    # The first image builds the matrix from the database, the others are appended to it
+    for filename in names:
+        expected[filename] = _store(filename, rng)
+        load_gallery()
+
+    for rebuilt in (False, True):
+        if rebuilt:
+            os.remove(gallery_paths()['state'])
+        face_ids, filenames, matrix, norms = load_gallery()
+        assert len(filenames) == len(matrix) == 6
+        assert filenames == [filename for filename in names for _ in range(2)]
+        np.testing.assert_allclose(matrix * np.asarray(norms)[:, None],
+                                   np.concatenate([expected[filename] for filename in names]), rtol=1e-5, atol=1e-6)
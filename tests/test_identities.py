@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from app.core.identities import aggregate_templates
+from app.runner.add_image_runner import store_group_image
+from app.runner.identity_runner import find_identity_photos, label_group_faces
+
+DIM = 32
+
+def _faces_of(rng, centre, count, noise=0.35):
+    return (centre + rng.normal(scale=noise, size=(count, DIM))).astype(np.float32)
+
+def test_templates_aggregate_the_references():
+    rng = np.random.default_rng(0)
+    centre = rng.normal(size=DIM)
+    references = _faces_of(rng, centre, 6)
+    np.testing.assert_allclose(aggregate_templates(references)[0], references.mean(axis=0), rtol=1e-5)
+
+    # The medoid is one of the references, never an outlier photo
+    outlier = rng.normal(size=(1, DIM)).astype(np.float32)
+    medoid = aggregate_templates(np.vstack([references, outlier]), method="medoid")
+    assert medoid.shape == (1, DIM)
+    assert any(np.array_equal(medoid[0], reference) for reference in references)
+
+    # Several templates split the references into their modes (e.g. with and without glasses)
+    glasses = centre + 3 * rng.normal(size=DIM)
+    modes = np.vstack([_faces_of(rng, centre, 4, noise=0.1), _faces_of(rng, glasses, 4, noise=0.1)])
+    templates = aggregate_templates(modes, count=2)
+    expected = np.array([modes[:4].mean(axis=0), modes[4:].mean(axis=0)])
+    order = np.argsort([np.linalg.norm(template - expected[0]) for template in templates])
+    np.testing.assert_allclose(templates[order], expected, rtol=1e-4, atol=1e-4)
+
+    # Identities with fewer references get one template per reference
+    assert aggregate_templates(modes[:3], count=5).shape == (3, DIM)
+    with pytest.raises(ValueError):
+        aggregate_templates(modes, method="max")
+
+def test_group_faces_are_labelled_with_their_identity(db, capsys):
+    rng = np.random.default_rng(1)
+    people = {'alice': rng.normal(size=DIM), 'bob': rng.normal(size=DIM)}
+    for name, centre in people.items():
+        filenames = [f"{name}/{i}.jpg" for i in range(3)]
+        db.insert_reference_images(list(zip(filenames, _faces_of(rng, centre, 3))))
+        db.add_identity_references(name, filenames)
+
+    expected = {'alice': set(), 'bob': set()}
+
+    def store(start, stop):
+        for i in range(start, stop):
+            filename = f"/photos/{i}.jpg"
+            # Every image shows one of the identities, next to a stranger
+            name = 'alice' if i % 3 else 'bob'
+            expected[name].add(filename)
+            embeddings = np.vstack([_faces_of(rng, people[name], 1), rng.normal(size=(1, DIM)).astype(np.float32)])
+            faces = [{'box': [20 * j, 0, 20, 20], 'confidence': 0.9, 'keypoints': {}} for j in range(2)]
+            assert store_group_image(filename, faces, embeddings)
+
+    def labelled(name):
+        faces = find_identity_photos(name, similarity_threshold=0.8)
+        assert [score for _, _, _, score in faces] == sorted((score for _, _, _, score in faces), reverse=True)
+        assert len(faces) == len({filename for filename, _, _, _ in faces})
+        return {filename for filename, _, _, _ in faces}
+
+    store(0, 12)
+    counts = label_group_faces(similarity_threshold=0.8)
+    assert "Labelling 24 group faces with 2 identities (2 templates)" in capsys.readouterr().out
+    assert counts == {'alice': 8, 'bob': 4}
+    assert labelled('alice') == expected['alice'] and labelled('bob') == expected['bob']
+
+    # Only the faces added since are labelled
+    store(12, 15)
+    counts = label_group_faces(similarity_threshold=0.8)
+    assert "Labelling 6 group faces" in capsys.readouterr().out
+    assert counts == {'alice': 10, 'bob': 5}
+    assert labelled('alice') == expected['alice']
+    label_group_faces(similarity_threshold=0.8)
+    assert "Labelling 0 group faces" in capsys.readouterr().out
+
+    # A new reference changes the templates, and every face is labelled again
+    db.insert_reference_image("bob/3.jpg", _faces_of(rng, people['bob'], 1)[0])
+    db.add_identity_references('bob', ["bob/3.jpg"])
+    version = db.get_face_identities()[1]['version']
+    counts = label_group_faces(similarity_threshold=0.8)
+    assert "Labelling 30 group faces" in capsys.readouterr().out
+    assert db.get_face_identities()[1] == {'version': version + 1, 'labels_version': version + 1, 'metric': 'cosine'}
+    assert counts == {'alice': 10, 'bob': 5}
+    assert labelled('bob') == expected['bob']
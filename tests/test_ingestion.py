@@ -0,0 +1,140 @@
+import queue
+import threading
+import cv2
+import numpy as np
+from app.data.manifest import image_key
+from app.runner import add_image_runner, pipeline_runner
+from app.runner.add_image_runner import add_group_images_from_folder, files_missing_embeddings
+
+def _face(x=0):
+    return {'box': [x, 0, 10, 10], 'confidence': 0.9, 'keypoints': {'left_eye': [x + 3, 3], 'right_eye': [x + 7, 3]},
+            'embedding': np.ones(8, dtype=np.float32)}
+
+def test_files_missing_embeddings_leaves_videos_out(db, tmp_path):
+    folder = tmp_path / "media"
+    folder.mkdir()
+    photo, clip = folder / "photo.jpg", folder / "clip.mp4"
+    photo.write_bytes(b"jpg")
+    clip.write_bytes(b"mp4")
+    db.insert_group_image(image_key(str(photo)), [_face()], model_name="Other", detector="mtcnn")
+    db.insert_video(image_key(str(clip)), [dict(_face(), start_ms=0, end_ms=500, detections=3, samples=2)],
+                    model_name="Other", detector="mtcnn")
+    # Both are missing Facenet embeddings, but only the photo can be re-embedded from its cached faces
+    assert set(db.get_faces_missing_embeddings()) == {image_key(str(photo)), image_key(str(clip))}
+    files = files_missing_embeddings(str(folder), [], detector="mtcnn")
+    assert [(file['path'], len(file['faces'])) for file in files] == [(image_key(str(photo)), 1)]
+
+def test_switching_models_reuses_detections_of_the_current_detector(db, tmp_path):
+    folder = tmp_path / "photos"
+    folder.mkdir()
+    same, older = (image_key(str(folder / name)) for name in ("same.jpg", "older.jpg"))
+    for key in (same, older):
+        with open(key, "wb") as f:
+            f.write(key.encode())
+    db.insert_group_image(same, [_face(), _face(20)], "hash-same", model_name="Other", detector="mtcnn@1600")
+    db.insert_group_image(older, [_face()], "hash-older", model_name="Other", detector="mtcnn@800")
+
+    files = {file['path']: file for file in files_missing_embeddings(str(folder), [], detector="mtcnn@1600")}
+
+    # Faces of the current detector are embedded from the cache; the others are detected again
+    assert [face['box'] for face in files[same]['faces']] == [[0, 0, 10, 10], [20, 0, 10, 10]]
+    assert files[older]['replace'] and files[older]['content_hash'] == "hash-older" and 'faces' not in files[older]
+
+    # Once re-detected, the image's faces replace the stale ones for every model
+    with db.BulkWriter() as writer:
+        writer.add_group_image(older, [_face(5)], "hash-older", detector="mtcnn@1600")
+    stored = db.get_all_group_embeddings(model_name="Other")
+    assert (same, 1) in stored and (older, 0) not in stored
+    assert [file['path'] for file in files_missing_embeddings(str(folder), [], detector="mtcnn@1600")] == [same]
+
+def _detect_squares(img, save_output=False, max_side=None, **tiling):
+    """Finds the grey squares of the test images as faces, with landmarks where a face has them."""
+    contours, _ = cv2.findContours((img[..., 0] > 0).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    faces = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        points = {'left_eye': (0.3, 0.4), 'right_eye': (0.7, 0.4), 'nose': (0.5, 0.55),
+                  'mouth_left': (0.35, 0.75), 'mouth_right': (0.65, 0.75)}
+        faces.append({'box': [x, y, w, h], 'confidence': 0.99,
+                      'keypoints': {name: (int(x + px * w), int(y + py * h)) for name, (px, py) in points.items()}})
+    return faces
+
+LAYOUT = {"a.png": [60, 70, 80], "b.png": [], "c.png": [90, 100], "d.png": [110, 120, 130]}
+
+def _square_images(folder, layout=LAYOUT):
+    """Writes images whose faces are squares of their own grey level, which the stub model returns as embedding."""
+    folder.mkdir()
+    for name, greys in layout.items():
+        img = np.zeros((120, 400, 3), dtype=np.uint8)
+        for i, grey in enumerate(greys):
+            img[40:80, 40 + 120 * i:80 + 120 * i] = grey
+        cv2.imwrite(str(folder / name), img)
+
+def _embed_greys(calls):
+    def embed(faces, model_name="Facenet", batch_size=32):
+        calls.append((len(faces), batch_size))
+        return np.array([[face.max()] * 4 for face in faces], dtype=np.float32)
+    return embed
+
+def _embedded_greys(db, alignment):
+    embedded = {}
+    for (filename, _), embedding in db.get_all_group_embeddings(alignment=alignment).items():
+        embedded.setdefault(filename.rsplit("/", 1)[1], []).append(embedding[0])
+    return {name: sorted(values) for name, values in embedded.items()}
+
+def test_faces_of_several_images_are_embedded_together(db, tmp_path, monkeypatch):
+    folder = tmp_path / "photos"
+    _square_images(folder)
+    calls = []
+    monkeypatch.setattr(add_image_runner, "detect_faces", _detect_squares)
+    monkeypatch.setattr(add_image_runner, "extract_face_embeddings", _embed_greys(calls))
+    monkeypatch.setattr(add_image_runner, "get_input_size", lambda model_name: (16, 16))
+    add_group_images_from_folder(str(folder), batch_size=4, alignment="roi")
+
+    # Faces accumulate across images until a batch is full, and the rest are embedded at the end
+    assert calls == [(5, 4), (3, 4)]
+    assert _embedded_greys(db, "roi") == {name: greys for name, greys in LAYOUT.items() if greys}
+    # The image without faces is recorded, so the next scan skips every file
+    assert len(db.get_manifest_entries()) == 4
+    add_group_images_from_folder(str(folder), batch_size=4, alignment="roi")
+    assert len(calls) == 2
+
+class _ThreadContext:
+    """Runs the pipeline stages as threads of the test process, where the models are stubbed."""
+    Queue = queue.Queue
+
+    @staticmethod
+    def Process(target, args, daemon):
+        return threading.Thread(target=target, args=args, daemon=daemon)
+
+def test_pipelined_ingestion_stores_new_and_cached_images(db, tmp_path, monkeypatch):
+    folder = tmp_path / "photos"
+    _square_images(folder)
+    (folder / "broken.png").write_bytes(b"not an image")
+    # An image stored for another model already: its faces are aligned from the cache, not detected
+    cached = image_key(str(folder / "a.png"))
+    faces = _detect_squares(cv2.imread(cached))
+    db.insert_group_image(cached, [dict(face, embedding=np.zeros(4, dtype=np.float32)) for face in faces],
+                          "hash-a", model_name="Other", alignment="roi", detector="mtcnn")
+    db.record_manifest_entries([{'path': cached, 'content_hash': "hash-a", 'size': (folder / "a.png").stat().st_size,
+                                 'mtime_ns': (folder / "a.png").stat().st_mtime_ns}])
+
+    detected = []
+
+    def detect(img, **kwargs):
+        detected.append(img.shape)
+        return _detect_squares(img)
+
+    monkeypatch.setattr(pipeline_runner.mp, "get_context", lambda method: _ThreadContext)
+    monkeypatch.setattr(pipeline_runner, "warm_up", lambda model_names: None)
+    monkeypatch.setattr(pipeline_runner, "extract_face_embeddings", _embed_greys([]))
+    monkeypatch.setattr(add_image_runner, "detect_faces", detect)
+    monkeypatch.setattr(add_image_runner, "get_input_size", lambda model_name: (16, 16))
+    pipeline_runner.add_group_images_pipelined(str(folder), decode_workers=2, inference_workers=2, queue_size=2,
+                                               alignment="roi")
+
+    assert _embedded_greys(db, "roi") == {name: greys for name, greys in LAYOUT.items() if greys}
+    assert len(detected) == 3
+    # The unreadable file is not recorded, so it is tried again by the next scan
+    manifest = db.get_manifest_entries()
+    assert sorted(path.rsplit("/", 1)[1] for path in manifest) == sorted(LAYOUT)
@@ -0,0 +1,61 @@
+import os
+import numpy as np
+from app.data.manifest import hash_file, image_key, scan_folder
+
+def _face():
+    return {'box': [0, 0, 10, 10], 'confidence': 0.9, 'keypoints': {}, 'embedding': np.ones(8, dtype=np.float32)}
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+def _commit(db, files):
+    """Records the scanned files as ingested, like the bulk writer does once they are stored."""
+    for file in files:
+        db.insert_group_image(file['path'], [_face()], file['content_hash'])
+    db.record_manifest_entries(files)
+
+def test_rescans_only_return_new_or_changed_contents(db, tmp_path):
+    folder = tmp_path / "photos"
+    a, b = _write(folder / "a.jpg", b"first"), _write(folder / "b.jpg", b"second")
+    _write(folder / "copy of a.jpg", b"first")
+
+    new_files, total = scan_folder(str(folder))
+    # Only one of the two copies of the same contents is ingested
+    assert total == 3
+    assert sorted(os.path.basename(file['path']) for file in new_files) == ["a.jpg", "b.jpg"]
+    _commit(db, new_files)
+
+    # The remaining copy is recorded without being ingested, then every file is skipped unread
+    assert scan_folder(str(folder)) == ([], 3)
+    assert image_key(str(folder / "copy of a.jpg")) in db.get_manifest_entries()
+    assert scan_folder(str(folder)) == ([], 3)
+
+    # A touched file is hashed again but skipped; changed contents are ingested again
+    os.utime(a, ns=(1, 1))
+    b.write_bytes(b"edited")
+    _write(folder / "renamed.jpg", b"second")
+    new_files, _ = scan_folder(str(folder))
+    assert [file['path'] for file in new_files] == [image_key(str(b))]
+    assert new_files[0]['content_hash'] == hash_file(str(b))
+    assert db.get_manifest_entries()[image_key(str(a))][1] == 1
+
+def test_relative_keys_are_only_adopted_by_files_with_the_same_contents(db, tmp_path):
+    folder = tmp_path / "photos"
+    same = _write(folder / "trip" / "same.jpg", b"same contents")
+    other = _write(folder / "trip" / "other.jpg", b"edited contents")
+    # Stored by an older version under paths relative to the ingested folder
+    for rel_path, data in (("trip/same.jpg", b"same contents"), ("trip/other.jpg", b"original contents")):
+        content_hash = hash_file(str(_write(tmp_path / "old" / rel_path, data)))
+        db.insert_group_image(rel_path, [_face()], content_hash)
+        db.record_manifest_entries([{'path': rel_path, 'content_hash': content_hash, 'size': len(data), 'mtime_ns': 1}])
+
+    new_files, total = scan_folder(str(folder), recursive=True)
+
+    assert total == 2
+    assert [file['path'] for file in new_files] == [image_key(str(other))]
+    stored = db.get_existing_filenames("group_images", [image_key(str(same)), "trip/same.jpg", "trip/other.jpg"])
+    assert set(stored) == {image_key(str(same)), "trip/other.jpg"}
+    manifest = db.get_manifest_entries()
+    assert image_key(str(same)) in manifest and "trip/same.jpg" not in manifest
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from app.core.quantization import ROW_ARRAYS, QuantizedGallery, QuantizedSearchEngine
+from app.core.similarity_matching import GallerySearchEngine
+from app.data.gallery_matrix import load_gallery, load_quantized_arrays
+from app.runner.add_image_runner import store_group_image
+from app.runner.index_runner import build_search_engine
+
+MODES = ["float16", "int8", "pq"]
+
+def _gallery(seed=0, count=600, dim=64):
+    rng = np.random.default_rng(seed)
+    queries = rng.normal(size=(3, dim)).astype(np.float32)
+    rows = rng.normal(size=(count, dim)).astype(np.float32)
+    # A few neighbours of every query, at increasing distances, so the exact ranking is clear
+    for i, query in enumerate(queries):
+        rows[10 * i:10 * i + 10] = query + np.linspace(0.1, 1.0, 10)[:, None] * rng.normal(size=(10, dim))
+    rows *= rng.uniform(0.5, 4, size=(count, 1)).astype(np.float32)
+    return queries, rows
+
+def _engines(rows, mode):
+    exact = GallerySearchEngine(range(len(rows)), rows)
+    quantized = QuantizedGallery.encode(exact.matrix, mode)
+    return exact, QuantizedSearchEngine(exact.ids, exact.matrix, exact.norms, quantized)
+
+def _assert_same(results, expected):
+    assert [[row for row, _ in hits] for hits in results] == [[row for row, _ in hits] for hits in expected]
+    for hits, expected_hits in zip(results, expected):
+        np.testing.assert_allclose([score for _, score in hits], [score for _, score in expected_hits], rtol=1e-6)
+
+@pytest.mark.parametrize("mode", MODES)
+def test_error_bounds_hold_for_every_row(mode):
+    queries, rows = _gallery()
+    exact, engine = _engines(rows, mode)
+    normalized = queries / np.linalg.norm(queries, axis=1)[:, None]
+    error = np.abs(engine.quantized.scores(normalized) - exact.score(queries))
+    assert np.all(error <= engine.quantized.errors[None, :] + 1e-5)
+    # Per row, without the PQ codebooks, which do not grow with the gallery
+    arrays = engine.quantized.arrays
+    row_bytes = sum(arrays[name].nbytes for name in ROW_ARRAYS if name in arrays)
+    assert row_bytes < exact.matrix.nbytes / {'float16': 1.9, 'int8': 3.5, 'pq': 10}[mode]
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("metric, threshold", [("cosine", 0.3), ("euclidean", 10.0)])
+def test_threshold_search_misses_no_match(mode, metric, threshold):
+    queries, rows = _gallery()
+    exact, engine = _engines(rows, mode)
+    expected = exact.search(queries, threshold=threshold, metric=metric)
+    assert all(expected)
+    _assert_same(engine.search(queries, threshold=threshold, metric=metric), expected)
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("metric", ["cosine", "euclidean"])
+def test_top_k_after_rerank_matches_exact_search(mode, metric):
+    queries, rows = _gallery()
+    exact, engine = _engines(rows, mode)
+    _assert_same(engine.search(queries, k=5, metric=metric), exact.search(queries, k=5, metric=metric))
+
+def test_stored_gallery_is_compressed_once_and_extended_with_new_rows(db):
+    _, rows = _gallery(count=60)
+    for i in range(0, 40, 4):
+        assert store_group_image(f"/photos/{i}.jpg", [{'box': [j, 0, 10, 10], 'confidence': 0.9, 'keypoints': {}}
+                                                      for j in range(4)], rows[i:i + 4])
+    for step in range(2):
+        ids, _, matrix, norms = load_gallery()
+        engine = build_search_engine(ids, matrix, norms, quantization="int8")
+        assert isinstance(engine, QuantizedSearchEngine)
+        assert len(load_quantized_arrays("int8")['codes']) == len(ids) == 40 + 20 * step
+        query = rows[:1] * 1.01
+        _assert_same(engine.search(query, k=3), GallerySearchEngine(ids, matrix, norms=norms).search(query, k=3))
+        assert engine.search(query, k=1)[0][0][0] == 0
+        if not step:
+            # Appended rows are compressed and added to the stored copy, which is not encoded again
+            for i in range(40, 60, 4):
+                assert store_group_image(f"/photos/{i}.jpg", [{'box': [j, 0, 10, 10], 'confidence': 0.9,
+                                                               'keypoints': {}} for j in range(4)], rows[i:i + 4])
@@ -0,0 +1,54 @@
+import asyncio
+import json
+from http import HTTPStatus
+import pytest
+from app.runner.service_runner import RecognitionService
+
+NAN = b'{"image_path": "query.jpg", "threshold": NaN}'
+NEGATIVE = b'{"image_path": "query.jpg", "threshold": -0.5}'
+
+async def _answer(request):
+    return {'matches': []}
+
+@pytest.fixture
+def service():
+    """Returns a factory of services whose batcher answers without running the models."""
+    services = []
+
+    def make(**kwargs):
+        service = RecognitionService(**kwargs)
+        service.batcher.submit = _answer
+        services.append(service)
+        return service
+
+    yield make
+    for service in services:
+        service.executor.shutdown()
+
+def _post(service, body):
+    return asyncio.run(service.handle("POST", "/search", body))
+
+@pytest.mark.parametrize("fields", [
+    {'top_k': "5"},
+    {'top_k': 0},
+    {'top_k': -3},
+    {'top_k': 2.5},
+    {'top_k': True},
+    {'top_k': [1]},
+    {'threshold': "0.8"},
+    {'threshold': True},
+])
+def test_invalid_search_options_are_rejected(service, fields):
+    status, payload = _post(service(), json.dumps(dict({'image_path': "query.jpg"}, **fields)).encode())
+
+    assert status == HTTPStatus.BAD_REQUEST
+    assert 'error' in payload
+
+def test_thresholds_are_checked_against_the_metric(service):
+    cosine, euclidean = service(), service(metric="euclidean")
+
+    assert _post(cosine, NAN)[0] == HTTPStatus.BAD_REQUEST
+    assert _post(euclidean, NEGATIVE)[0] == HTTPStatus.BAD_REQUEST
+    # A negative cosine similarity is a valid threshold
+    assert _post(cosine, NEGATIVE)[0] == HTTPStatus.OK
+    assert _post(cosine, b'{"image_path": "query.jpg", "top_k": 3, "threshold": 1}')[0] == HTTPStatus.OK
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from app.core import sharded_search
+from app.core.sharded_search import ShardedSearchEngine, shard_of
+from app.core.similarity_matching import GallerySearchEngine
+from app.data.gallery_matrix import load_gallery, load_shards
+from app.runner.add_image_runner import store_group_image
+from app.runner.index_runner import build_search_engine, rebalance_shards
+
+SEARCHES = [{'k': 5}, {'threshold': 0.3}, {'k': 3, 'threshold': 0.35}, {'k': 4, 'metric': "euclidean"},
+            {'threshold': 9.0, 'metric': "euclidean"}]
+
+@pytest.fixture
+def gallery(db):
+    rng = np.random.default_rng(0)
+
+    def store(i, faces=None):
+        faces = faces or int(rng.integers(1, 5))
+        boxes = [{'box': [10 * j, 0, 10, 10], 'confidence': 0.9, 'keypoints': {}} for j in range(faces)]
+        assert store_group_image(f"/photos/{i}.jpg", boxes, rng.normal(size=(faces, 64)).astype(np.float32))
+
+    for i in range(60):
+        store(i)
+    yield store, rng
+    if sharded_search._pool is not None:
+        sharded_search._pool.terminate()
+        sharded_search._pool = None
+    sharded_search._open_shards.clear()
+
+def _assert_same_as_exact(rng, shards, workers=1):
+    _, filenames, matrix, norms = load_gallery()
+    engine = build_search_engine(filenames, matrix, norms, shards=shards, search_workers=workers)
+    assert isinstance(engine, ShardedSearchEngine)
+    exact = GallerySearchEngine(filenames, matrix, norms=norms)
+    queries = np.concatenate([matrix[:3] * 2, rng.normal(size=(4, 64)).astype(np.float32)])
+    for search in SEARCHES:
+        results, expected = engine.search(queries, **search), exact.search(queries, **search)
+        assert [[row for row, _ in hits] for hits in results] == [[row for row, _ in hits] for hits in expected]
+        np.testing.assert_allclose([score for hits in results for _, score in hits],
+                                   [score for hits in expected for _, score in hits], rtol=1e-6)
+    return engine
+
+def test_shards_hold_whole_images():
+    filenames = [f"/photos/{i // 3}.jpg" for i in range(300)]
+    assignment = shard_of(filenames, 4)
+    assert all(len(set(assignment[i:i + 3])) == 1 for i in range(0, 300, 3))
+    assert set(assignment) == {0, 1, 2, 3}
+
+def test_sharded_search_matches_exact_search_as_the_gallery_changes(gallery):
+    store, rng = gallery
+    engine = _assert_same_as_exact(rng, 3)
+    assert len(engine.shards) == 3
+
+    # Appended images are routed to their shards
+    for i in range(60, 70):
+        store(i)
+    descriptors, count = load_shards()
+    assert count == sum(shard['count'] for shard in descriptors) == len(load_gallery()[0])
+    _assert_same_as_exact(rng, 3)
+
+    # Replacing an image rewrites the split with the same counts: the cached shards must not be reused
+    split = descriptors[0]['split']
+    store(5, faces=2)
+    store(6, faces=2)
+    _assert_same_as_exact(rng, 3)
+    assert load_shards()[0][0]['split'] != split
+
+    # A new number of shards replaces the files and the cached shards the split no longer has
+    rebalance_shards(5)
+    engine = _assert_same_as_exact(rng, 3)
+    assert len(engine.shards) == 5
+    assert {shard for _, shard in sharded_search._open_shards} == set(range(5))
+
+def test_search_workers_return_the_same_results(gallery):
+    _, rng = gallery
+    _assert_same_as_exact(rng, 3, workers=2)
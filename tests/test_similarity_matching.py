@@ -0,0 +1,73 @@
+import warnings
+import numpy as np
+import pytest
+from app.core.similarity_matching import (GallerySearchEngine, compute_cosine_similarity, compute_euclidean_distance,
+                                          match_embeddings)
+
+def _reference_matches(group_embeddings, reference_embedding, metric, threshold):
+    """The scipy loop match_embeddings used to run, on the float64 embeddings the database used to return."""
+    compute = compute_cosine_similarity if metric == "cosine" else compute_euclidean_distance
+    matches = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for group_id, group_embedding in group_embeddings.items():
+            score = compute(np.asarray(group_embedding, dtype=np.float64),
+                            np.asarray(reference_embedding, dtype=np.float64))
+            if threshold is None or (score >= threshold if metric == "cosine" else score <= threshold):
+                matches[group_id] = score
+    return matches
+
+def _gallery(seed=0, count=300, dim=128):
+    rng = np.random.default_rng(seed)
+    query = (rng.normal(size=dim) * 3).astype(np.float32)
+    rows = (rng.normal(size=(count, dim)) * rng.uniform(0.5, 12, size=(count, 1))).astype(np.float32)
+    # Near-identical copies of the query, where the float32 Euclidean form cancels out
+    rows[:5] = query + rng.normal(scale=1e-6, size=(5, dim)).astype(np.float32)
+    rows[5:10] = query * np.float32(1.0001)
+    rows[10] = 0
+    return query, {f"image_{i}.jpg": row for i, row in enumerate(rows)}
+
+def _assert_same(matches, expected):
+    assert list(matches) == list(expected)
+    for group_id, score in expected.items():
+        if np.isnan(score):
+            assert np.isnan(matches[group_id])
+        else:
+            assert matches[group_id] == pytest.approx(score, rel=1e-6, abs=1e-6)
+
+@pytest.mark.parametrize("metric", ["cosine", "euclidean"])
+def test_match_embeddings_matches_scipy_at_the_threshold(metric):
+    query, gallery = _gallery()
+    exact = _reference_matches(gallery, query, metric, None)
+    scores = sorted(score for score in exact.values() if not np.isnan(score))
+    # Thresholds just around actual scores, where float32 rounding would flip matches
+    thresholds = [None] + [score + offset for score in scores[:12] + scores[-12:] + scores[140:160]
+                           for offset in (-1e-6, 1e-6)]
+    for threshold in thresholds:
+        expected = _reference_matches(gallery, query, metric, threshold)
+        _assert_same(match_embeddings(gallery, query, metric=metric, threshold=threshold), expected)
+
+def test_near_identical_euclidean_distances_are_exact():
+    query, gallery = _gallery()
+    matches = match_embeddings(gallery, query, metric="euclidean", threshold=1e-3)
+    for group_id in ("image_0.jpg", "image_1.jpg"):
+        expected = compute_euclidean_distance(gallery[group_id].astype(np.float64), query.astype(np.float64))
+        assert matches[group_id] == pytest.approx(expected, rel=1e-9)
+        assert matches[group_id] < 1e-4
+
+def test_zero_vector_cosine_is_nan():
+    query, gallery = _gallery()
+    assert np.isnan(match_embeddings(gallery, query)["image_10.jpg"])
+    assert "image_10.jpg" not in match_embeddings(gallery, query, threshold=-1.0)
+
+@pytest.mark.parametrize("metric", ["cosine", "euclidean"])
+def test_top_k_matches_exact_ranking(metric):
+    query, gallery = _gallery(seed=1)
+    engine = GallerySearchEngine.from_dict(gallery)
+    expected = np.array(list(_reference_matches(gallery, query, metric, None).values()))
+    best = np.sort(expected[~np.isnan(expected)])
+    best = best[::-1][:20] if metric == "cosine" else best[:20]
+    top = engine.search(query, k=20, metric=metric)[0]
+    # Rows with equal scores (up to float64 rounding) may come in either order
+    assert [score for _, score in top] == pytest.approx(list(best), rel=1e-12)
+    assert [score for _, score in top] == pytest.approx([expected[row] for row, _ in top], rel=1e-12)
@@ -0,0 +1,124 @@
+import json
+import sqlite3
+import numpy as np
+import pytest
+from app.data import database
+from app.data.gallery_matrix import load_gallery
+
+def _baseline_db(path, references, groups):
+    """A database as written by the first version: one JSON embedding per reference and group image."""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE reference_images (id INTEGER PRIMARY KEY, filename TEXT UNIQUE, embedding BLOB)")
+    conn.execute("CREATE TABLE group_images (id INTEGER PRIMARY KEY, filename TEXT UNIQUE, embedding BLOB)")
+    for table, rows in (("reference_images", references), ("group_images", groups)):
+        conn.executemany(f"INSERT INTO {table} (filename, embedding) VALUES (?, ?)",
+                         [(filename, json.dumps(np.asarray(embedding).tolist())) for filename, embedding in rows.items()])
+    conn.commit()
+    conn.close()
+
+@pytest.fixture
+def baseline(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    reference = rng.normal(size=128)
+    groups = {"match.jpg": reference + rng.normal(scale=0.05, size=128), "other.jpg": rng.normal(size=128)}
+    path = tmp_path / "database.db"
+    _baseline_db(path, {"ref.jpg": reference}, groups)
+    monkeypatch.setattr(database, "DB_PATH", str(path))
+    database.init_db()
+    yield tmp_path, reference, groups
+    database.close_connections()
+
+def test_legacy_embeddings_stay_searchable(baseline):
+    _, reference, groups = baseline
+    assert set(database.get_all_group_embeddings()) == {(filename, 0) for filename in groups}
+    np.testing.assert_allclose(database.get_reference_embedding("ref.jpg"), reference, rtol=1e-6)
+    face_ids, filenames, matrix, _ = load_gallery()
+    assert sorted(filenames) == sorted(groups) and matrix.shape == (2, 128)
+    assert database.count_stale_embeddings() == (2, 1)
+    # Legacy references are embedded again when they are next added
+    assert not database.is_reference_image_in_db("ref.jpg")
+
+def test_legacy_faces_without_boxes_are_detected_again(baseline):
+    tmp_path, _, groups = baseline
+    from app.data.manifest import scan_folder
+    from app.runner.add_image_runner import files_missing_embeddings
+
+    missing = database.get_faces_missing_embeddings()
+    assert set(missing) == set(groups)
+    assert all(face['box'] is None and face['detector'] is None for faces in missing.values() for face in faces)
+
+    folder = tmp_path / "photos"
+    folder.mkdir()
+    for filename in groups:
+        (folder / filename).write_bytes(filename.encode())
+    new_files, total = scan_folder(str(folder))
+    assert total == 2 and not new_files
+    files = files_missing_embeddings(str(folder), new_files, detector="mtcnn")
+    assert sorted(file['path'].rsplit('/', 1)[1] for file in files) == sorted(groups)
+    assert all(file.get('replace') and 'faces' not in file for file in files)
+
+def test_reembedding_replaces_legacy_embeddings(baseline):
+    _, _, groups = baseline
+    face_ids, filenames, _, _ = load_gallery()
+    generation, _ = database.get_gallery_state()
+    embeddings = np.random.default_rng(1).normal(size=(len(face_ids), 128)).astype(np.float32)
+    assert database.add_face_embeddings(face_ids, embeddings) == generation + 2
+
+    assert database.count_stale_embeddings() == (0, 1)
+    assert not database.get_faces_missing_embeddings()
+    # The gallery holds the new embeddings only, in their new insertion order
+    new_ids, _, matrix, norms = load_gallery()
+    assert new_ids == face_ids
+    np.testing.assert_allclose(matrix * np.asarray(norms)[:, None], embeddings, rtol=1e-5, atol=1e-6)
+
+def test_json_embeddings_migrate_to_exact_float32(baseline):
+    _, reference, groups = baseline
+    conn = database.get_connection()
+    assert conn.execute("SELECT DISTINCT dtype FROM reference_images").fetchall() == [(database.EMBEDDING_DTYPE,)]
+    stored = database.get_all_group_embeddings()
+    for filename, embedding in groups.items():
+        np.testing.assert_array_equal(stored[(filename, 0)], np.asarray(embedding, dtype=np.float32))
+
+def test_search_after_upgrade_returns_the_pre_upgrade_matches(baseline):
+    from app.core.similarity_matching import match_embeddings
+    from app.runner.search_runner import search_in_group_images
+
+    _, reference, groups = baseline
+    expected = match_embeddings(groups, reference, metric="cosine", threshold=0.8)
+    assert list(expected) == ["match.jpg"]
+    hits = search_in_group_images("photos/ref.jpg", similarity_threshold=0.8)
+    assert [filename for filename, _, _ in hits] == list(expected)
+    assert hits[0][2] == pytest.approx(expected["match.jpg"], abs=1e-6)
+
+def test_group_images_migrate_to_one_face_and_gain_more(baseline):
+    from app.runner.add_image_runner import store_group_image
+    from app.runner.search_runner import search_in_group_images
+
+    _, reference, _ = baseline
+    conn = database.get_connection()
+    assert conn.execute("SELECT COUNT(*) FROM group_images WHERE embedding IS NOT NULL").fetchone() == (0,)
+    assert conn.execute("SELECT face_index, box_x FROM group_faces").fetchall() == [(0, None), (0, None)]
+
+    # A new image stores every face; only the matching one is reported, with its box
+    rng = np.random.default_rng(2)
+    faces = [{'box': [10 * i, 0, 10, 10], 'confidence': 0.9, 'keypoints': {}} for i in range(3)]
+    embeddings = rng.normal(size=(3, 128)).astype(np.float32)
+    embeddings[1] = reference
+    assert store_group_image("/photos/new.jpg", faces, embeddings)
+    hits = search_in_group_images("ref.jpg", similarity_threshold=0.8)
+    assert [(filename, box) for filename, box, _ in hits] == [("match.jpg", None), ("/photos/new.jpg", [10, 0, 10, 10])]
+
+def test_first_version_embeddings_migrate_under_the_configured_model(tmp_path, monkeypatch):
+    reference = np.ones(4)
+    _baseline_db(tmp_path / "database.db", {"ref.jpg": reference}, {"group.jpg": reference})
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "database.db"))
+    database.init_db(model_name="ArcFace")
+    try:
+        np.testing.assert_allclose(database.get_reference_embedding("ref.jpg", model_name="ArcFace"), reference)
+        assert database.get_reference_embedding("ref.jpg") is None
+        assert list(database.get_all_group_embeddings(model_name="ArcFace")) == [("group.jpg", 0)]
+        # The default model has no embeddings yet, only the stored face to embed again
+        assert not database.get_all_group_embeddings()
+        assert list(database.get_faces_missing_embeddings()) == ["group.jpg"]
+    finally:
+        database.close_connections()
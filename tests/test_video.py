@@ -0,0 +1,82 @@
+import cv2
+import numpy as np
+import pytest
+from app.data.gallery_matrix import load_gallery
+from app.runner import add_image_runner, video_runner
+from app.runner.video_runner import add_videos_from_folder, track_video
+
+FPS = 10
+SIZE = 60
+
+def _write_video(path, rng):
+    """Two scenes: a face moving 8 pixels per frame, then, after a cut to another background, a face standing still."""
+    texture = rng.integers(0, 256, size=(SIZE, SIZE, 3), dtype=np.uint8)
+    texture[..., 2] = 255
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), FPS, (320, 240))
+    for frame_index in range(40):
+        frame = np.zeros((240, 320, 3), dtype=np.uint8)
+        if frame_index < 20:
+            x, y = 20 + 8 * frame_index, 60
+        else:
+            frame[..., 1] = 160
+            x, y = 200, 150
+        frame[y:y + SIZE, x:x + SIZE] = texture
+        writer.write(frame)
+    writer.release()
+
+def _detect_red(img, save_output=False, max_side=None):
+    """Finds the red squares of the test video as faces."""
+    contours, _ = cv2.findContours((img[..., 2] > 200).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    faces = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w > 20 and h > 20:
+            faces.append({'box': [x, y, w, h], 'confidence': 0.99,
+                          'keypoints': {'left_eye': (x + 0.3 * w, y + 0.4 * h), 'right_eye': (x + 0.7 * w, y + 0.4 * h),
+                                        'nose': (x + 0.5 * w, y + 0.55 * h), 'mouth_left': (x + 0.35 * w, y + 0.75 * h),
+                                        'mouth_right': (x + 0.65 * w, y + 0.75 * h)}})
+    return faces
+
+@pytest.fixture
+def stubs(monkeypatch):
+    embedded = []
+
+    def embed(faces, model_name="Facenet", batch_size=32):
+        embedded.append(len(faces))
+        return np.array([face.reshape(-1, 3).mean(axis=0) for face in faces], dtype=np.float32)
+
+    monkeypatch.setattr(video_runner, "detect_faces", _detect_red)
+    monkeypatch.setattr(video_runner, "extract_face_embeddings", embed)
+    monkeypatch.setattr(add_image_runner, "get_input_size", lambda model_name: (32, 32))
+    return embedded
+
+def test_faces_are_tracked_across_detections_and_scene_cuts(stubs, tmp_path):
+    _write_video(tmp_path / "clip.avi", np.random.default_rng(0))
+
+    tracks, stats = track_video(str(tmp_path / "clip.avi"), alignment="roi", detect_interval=0.5, samples_per_track=3)
+
+    # The moving face overlaps its last detection too little to be matched by IoU alone; optical flow keeps one track
+    assert stats['frames'] == 40 and len(tracks) == 2
+    first, second = tracks
+    assert (first['start_ms'], first['detections']) == (0, 4) and 1500 <= first['end_ms'] < 2000
+    # The cut starts a detection on its first frame, ending the first track
+    assert (second['start_ms'], second['end_ms']) == (2000, 3900) and second['box'] == pytest.approx([200, 150, 60, 60], abs=2)
+    assert first['samples'] == second['samples'] == 3 and stats['embeddings'] == 6
+
+    without_flow, _ = track_video(str(tmp_path / "clip.avi"), alignment="roi", detect_interval=0.5, track_fps=0)
+    assert len(without_flow) > 2
+
+def test_video_tracks_are_stored_as_searchable_faces(db, stubs, tmp_path):
+    folder = tmp_path / "videos"
+    folder.mkdir()
+    _write_video(folder / "clip.avi", np.random.default_rng(0))
+
+    add_videos_from_folder(str(folder), alignment="roi", detect_interval=0.5)
+
+    face_ids, filenames, matrix, _ = load_gallery(alignment="roi")
+    assert len(face_ids) == 2 and {filename.rsplit("/", 1)[1] for filename in filenames} == {"clip.avi"}
+    assert sorted(db.get_video_tracks(face_ids).values())[1][0] == 2000
+    # Recorded in the manifest, so the next scan does not decode it again
+    calls = len(stubs)
+    add_videos_from_folder(str(folder), alignment="roi", detect_interval=0.5)
+    assert len(stubs) == calls